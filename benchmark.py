@@ -0,0 +1,776 @@
+"""
+Benchmarks for the make.py helpers
+
+Generates synthetic archives (a zip shaped like the NDK and a tar.bz2
+shaped like wxWidgets), serves them from a local HTTP server and measures
+the download, extraction and patch helpers. Each benchmark runs in a fresh
+process, so its peak RSS and I/O counters are its own.
+"""
+
+import os
+import sys
+import random
+import re
+import tarfile
+import threading
+import time
+import zipfile
+import multiprocessing
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+
+import make
+
+from simple_zip import ZipFileWithPermissions
+
+BENCHMARK_SEED = 1234
+
+# allowed increase over the baseline before a metric is a regression
+BENCHMARK_TOLERANCE = {
+    "seconds": 0.25,
+    "peak_rss": 0.10,
+    "syscalls": 0.10,
+}
+
+# synthetic source with the text the patch rules replace
+BOSSAC_SOURCE = """#include <stdio.h>
+#include <stdarg.h>
+
+class BossaObserver : public FlasherObserver
+{
+public:
+    BossaObserver() : _lastTicks(-1) {}
+
+    virtual void onStatus(const char *message, ...);
+    virtual void onProgress(int num, int div);
+private:
+    int _lastTicks;
+};
+
+void
+BossaObserver::onStatus(const char *message, ...)
+{
+    va_list ap;
+
+    va_start(ap, message);
+    vprintf(message, ap);
+    va_end(ap);
+}
+
+void
+BossaObserver::onProgress(int num, int div)
+{
+    int ticks;
+    int bars = 30;
+
+    ticks = num * bars / div;
+
+    if (ticks == _lastTicks)
+        return;
+
+    printf("\\r[");
+    while (ticks-- > 0)
+    {
+        putchar('=');
+        bars--;
+    }
+    while (bars-- > 0)
+    {
+        putchar(' ');
+    }
+    printf("] %d%% (%d/%d pages)", num * 100 / div, num, div);
+    fflush(stdout);
+
+    _lastTicks = 0;
+}
+
+static BossaConfig config;
+static Option opts[] =
+{
+};
+
+static struct timeval start_time;
+
+int
+main(int argc, char* argv[])
+{
+    int args;
+    CmdOpts cmd(argc, argv, sizeof(opts) / sizeof(opts[0]), opts);
+
+    args = cmd.parse();
+
+    if (config.version)
+    {
+        printf("Basic Open Source SAM-BA Application (BOSSA) Version " VERSION "\\n");
+        return 0;
+    }
+
+    if (args != argc)
+    {
+        fprintf(stderr, "%s: extra arguments found\\n", argv[0]);
+        return 1;
+    }
+
+    try
+    {
+        Samba samba;
+
+        bool res;
+        res = samba.connect(portFactory.create(config.portArg));
+
+        Device device(samba);
+        Device::FlashPtr& flash = device.getFlash();
+
+        if (config.erase)
+            flasher.erase(config.offsetArg);
+
+        if (config.write)
+            flasher.write(argv[args], config.offsetArg);
+
+        if (config.verify)
+        {
+            if (!flasher.verify(argv[args], pageErrors, totalErrors, config.offsetArg))
+                return 2;
+        }
+
+        if (config.read)
+            flasher.read(argv[args], config.readArg, config.offsetArg);
+    }
+    catch (exception& e)
+    {
+        fprintf(stderr, "\\n%s\\n", e.what());
+        return 1;
+    }
+
+    return 0;
+}
+"""
+
+CMDOPTS_SOURCE = """#include <getopt.h>
+
+bool CmdOpts::parse(int argc, char* argv[])
+{
+    struct option long_opts[_numOpts + 1];
+
+    return true;
+}
+"""
+
+
+def get_synthetic_lines(rng, count=512):
+    words = [
+        "wxWindow",
+        "const",
+        "int",
+        "return",
+        "virtual",
+        "void",
+        "class",
+        "#define",
+        "wxString",
+        "static",
+        "bool",
+        "if",
+        "else",
+        "NULL",
+        "wxEvent",
+        "{",
+        "}",
+        "//",
+    ]
+    lines = []
+
+    for i in range(count):
+        lines.append(
+            " ".join([rng.choice(words) for j in range(rng.randint(2, 12))]) + "\n"
+        )
+
+    return lines
+
+
+def get_text_content(rng, lines, size):
+    content = []
+    length = 0
+
+    while length < size:
+        line = rng.choice(lines)
+        content.append(line)
+        length += len(line)
+
+    return "".join(content)[:size].encode("utf-8")
+
+
+def get_binary_content(rng, size):
+    # half random, half zeros, like the compressible parts of a binary
+    random_size = size // 2
+
+    return rng.getrandbits(random_size * 8).to_bytes(random_size, "little") + bytes(
+        size - random_size
+    )
+
+
+def generate_ndk_zip(file, scale, rng):
+    """
+    Generate a zip with many small headers and a few large binaries.
+    """
+    lines = get_synthetic_lines(rng)
+    size = 0
+    count = 0
+
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED) as zip:
+        for i in range(max(1, int(8000 * scale))):
+            info = zipfile.ZipInfo(
+                "android-ndk-bench/sysroot/usr/include/dir{0}/file{1}.h".format(
+                    i % 200, i
+                )
+            )
+            info.external_attr = 0o100644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            content = get_text_content(rng, lines, rng.randint(512, 16 * 1024))
+            zip.writestr(info, content)
+            size += len(content)
+            count += 1
+
+        for i in range(max(1, int(8 * scale))):
+            info = zipfile.ZipInfo("android-ndk-bench/bin/tool{0}".format(i))
+            info.external_attr = 0o100755 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            content = get_binary_content(rng, 4 * 1024 * 1024)
+            zip.writestr(info, content)
+            size += len(content)
+            count += 1
+
+    return {"bytes": size, "files": count}
+
+
+def generate_wx_tar(file, scale, rng):
+    """
+    Generate a tar.bz2 with headers and sources, like wxWidgets.
+    """
+    lines = get_synthetic_lines(rng)
+    size = 0
+    count = 0
+    source_dir = file + ".src"
+
+    make.remove_dir(source_dir)
+
+    for i in range(max(1, int(3000 * scale))):
+        if i % 3:
+            name = "include/wx/dir{0}/file{1}.h".format(i % 40, i)
+        else:
+            name = "src/dir{0}/file{1}.cpp".format(i % 40, i)
+
+        content = get_text_content(rng, lines, rng.randint(1024, 24 * 1024))
+        path = os.path.join(source_dir, "wxWidgets-bench", name)
+
+        make.create_dir(os.path.dirname(path))
+
+        with open(path, "wb") as f:
+            f.write(content)
+
+        size += len(content)
+        count += 1
+
+    with tarfile.open(file, "w:bz2") as tar:
+        tar.add(os.path.join(source_dir, "wxWidgets-bench"), "wxWidgets-bench")
+
+    make.remove_dir(source_dir)
+
+    return {"bytes": size, "files": count}
+
+
+def generate_data(data_dir, scale):
+    """
+    Generate the synthetic archives, reusing them when they were generated
+    with the same scale.
+    """
+    manifest_file = os.path.join(data_dir, "manifest.json")
+    manifest = make.read_json_file(manifest_file)
+
+    if manifest and manifest["scale"] == scale and manifest["seed"] == BENCHMARK_SEED:
+        return manifest
+
+    make.debug("Generating benchmark data (scale: {0})...".format(scale))
+
+    make.remove_dir(data_dir)
+    make.create_dir(data_dir)
+
+    rng = random.Random(BENCHMARK_SEED)
+
+    manifest = {
+        "scale": scale,
+        "seed": BENCHMARK_SEED,
+        "zip": generate_ndk_zip(os.path.join(data_dir, "ndk.zip"), scale, rng),
+        "tar": generate_wx_tar(os.path.join(data_dir, "wx.tar.bz2"), scale, rng),
+    }
+
+    make.write_json_file(manifest_file, manifest)
+
+    return manifest
+
+
+class BenchmarkRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the benchmark data with range requests. Files under /stream/ are
+    served without ranges, like a server that doesn't support them.
+    """
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def send_file(self, body):
+        accept_ranges = not self.path.startswith("/stream/")
+        file = os.path.join(self.server.directory, os.path.basename(self.path))
+
+        if not os.path.isfile(file):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(file)
+        start = 0
+        end = size - 1
+        range_header = self.headers.get("Range")
+
+        if accept_ranges and range_header and range_header.startswith("bytes="):
+            first, last = range_header[6:].split("-", 1)
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {0}-{1}/{2}".format(start, end, size)
+            )
+        else:
+            self.send_response(200)
+
+        if accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        if not body:
+            return
+
+        with open(file, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+
+                if not chunk:
+                    break
+
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(directory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BenchmarkRequestHandler)
+    server.directory = directory
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, "http://127.0.0.1:{0}".format(server.server_address[1])
+
+
+def benchmark_download_ranges(context):
+    make.download_file(
+        context["url"] + "/ndk.zip", context["work_dir"], "ndk.zip", connections=4
+    )
+
+    return {"bytes": os.path.getsize(os.path.join(context["work_dir"], "ndk.zip"))}
+
+
+def benchmark_download_stream(context):
+    make.download_file(
+        context["url"] + "/stream/ndk.zip", context["work_dir"], "ndk.zip"
+    )
+
+    return {"bytes": os.path.getsize(os.path.join(context["work_dir"], "ndk.zip"))}
+
+
+def benchmark_tar_extract(context):
+    with open(os.path.join(context["data_dir"], "wx.tar.bz2"), "rb") as f:
+        make.extract_tar_stream(f, context["work_dir"])
+
+    return {"bytes": context["manifest"]["tar"]["bytes"]}
+
+
+def benchmark_zip_extractall(context):
+    with ZipFileWithPermissions(os.path.join(context["data_dir"], "ndk.zip")) as zip:
+        zip.extractall(context["work_dir"])
+
+    return {"bytes": context["manifest"]["zip"]["bytes"]}
+
+
+def benchmark_zip_extract_parallel(context):
+    with ZipFileWithPermissions(os.path.join(context["data_dir"], "ndk.zip")) as zip:
+        zip.extractall_parallel(context["work_dir"], workers=os.cpu_count() or 1)
+
+    return {"bytes": context["manifest"]["zip"]["bytes"]}
+
+
+def write_patch_sources(source_dir):
+    make.create_dir(source_dir)
+
+    with open(os.path.join(source_dir, "bossac.cpp"), "w") as f:
+        f.write(BOSSAC_SOURCE)
+
+    with open(os.path.join(source_dir, "CmdOpts.cpp"), "w") as f:
+        f.write(CMDOPTS_SOURCE)
+
+
+def replace_regex_in_file(filename, pattern, new_string):
+    content = make.get_file_content(filename)
+
+    with open(filename, "w") as f:
+        f.write(re.sub(pattern, lambda match: new_string, content, flags=re.DOTALL))
+
+
+def benchmark_replace_in_file(context):
+    # the android patch rules, one helper call (and file rewrite) at a time
+    source_dir = os.path.join(context["work_dir"], "src")
+    rules = make.get_patch_rules(["bossa", "android"])
+    iterations = 200
+
+    for i in range(iterations):
+        write_patch_sources(source_dir)
+
+        for rule in rules:
+            source_file = os.path.join(source_dir, rule["file"])
+
+            for old_string, new_string in rule.get("replace", []):
+                make.replace_in_file(source_file, old_string, new_string)
+
+            for pattern, new_string in rule.get("regex", []):
+                replace_regex_in_file(source_file, pattern, new_string)
+
+            if "prepend" in rule:
+                make.prepend_to_file(source_file, rule["prepend"])
+
+            if "prepend_file" in rule:
+                make.prepend_to_file(
+                    source_file,
+                    make.get_file_content(
+                        os.path.join("patches", rule["prepend_file"])
+                    ),
+                )
+
+            if "append" in rule:
+                make.append_to_file(source_file, rule["append"])
+
+            if "append_file" in rule:
+                make.append_to_file(
+                    source_file,
+                    make.get_file_content(os.path.join("patches", rule["append_file"])),
+                )
+
+    return {"items": iterations}
+
+
+def benchmark_apply_patch_set(context):
+    source_dir = os.path.join(context["work_dir"], "src")
+    rules = make.get_patch_rules(["bossa", "android"])
+    iterations = 200
+
+    for i in range(iterations):
+        write_patch_sources(source_dir)
+        result = make.apply_patch_set(source_dir, rules)
+
+        # a failed rule would time the failure path
+        if result["failed"]:
+            raise RuntimeError("Patch failed: {0}".format(", ".join(result["failed"])))
+
+    return {"items": iterations}
+
+
+def setup_find_files(context):
+    with ZipFileWithPermissions(os.path.join(context["data_dir"], "ndk.zip")) as zip:
+        zip.extractall_parallel(
+            os.path.join(context["work_dir"], "ndk"), workers=os.cpu_count() or 1
+        )
+
+
+def benchmark_find_files(context):
+    iterations = 5
+
+    for i in range(iterations):
+        make.find_files(os.path.join(context["work_dir"], "ndk"), ".h")
+
+    return {"items": iterations}
+
+
+BENCHMARKS = {
+    "download-ranges": benchmark_download_ranges,
+    "download-stream": benchmark_download_stream,
+    "tar-extract": benchmark_tar_extract,
+    "zip-extractall": benchmark_zip_extractall,
+    "zip-extract-parallel": benchmark_zip_extract_parallel,
+    "replace-in-file": benchmark_replace_in_file,
+    "apply-patch-set": benchmark_apply_patch_set,
+    "find-files": benchmark_find_files,
+}
+
+# run before the benchmark, without being measured
+BENCHMARK_SETUP = {
+    "find-files": setup_find_files,
+}
+
+
+def read_proc_io():
+    """
+    Return the I/O counters of the process (linux only).
+    """
+    counters = {}
+
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                counters[key.strip()] = int(value)
+    except (IOError, ValueError):
+        pass
+
+    return counters
+
+
+def get_peak_rss():
+    import resource
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on linux, bytes on macos
+    if sys.platform != "darwin":
+        maxrss *= 1024
+
+    return maxrss
+
+
+def run_benchmark(name, context):
+    """
+    Run a benchmark in this (worker) process and return its metrics.
+    """
+    work_dir = context["work_dir"]
+
+    make.remove_dir(work_dir)
+    make.create_dir(work_dir)
+
+    # keep the progress bars and messages of the helpers out of the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    stdout = os.dup(1)
+    stderr = os.dup(2)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    try:
+        if name in BENCHMARK_SETUP:
+            BENCHMARK_SETUP[name](context)
+
+        io_before = read_proc_io()
+        started = time.perf_counter()
+
+        result = BENCHMARKS[name](context)
+
+        seconds = time.perf_counter() - started
+        io_after = read_proc_io()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        os.close(devnull)
+
+    result["seconds"] = seconds
+    result["peak_rss"] = get_peak_rss()
+
+    if io_after:
+        result["syscr"] = io_after["syscr"] - io_before["syscr"]
+        result["syscw"] = io_after["syscw"] - io_before["syscw"]
+        result["syscalls"] = result["syscr"] + result["syscw"]
+        result["rchar"] = io_after["rchar"] - io_before["rchar"]
+        result["wchar"] = io_after["wchar"] - io_before["wchar"]
+
+    if "bytes" in result:
+        result["throughput"] = result["bytes"] / result["seconds"]
+
+    make.remove_dir(work_dir)
+
+    return result
+
+
+def run_benchmarks(names, context, repeat):
+    """
+    Run each benchmark repeat times, each time in a new (spawned) process,
+    keeping the fastest run.
+    """
+    results = {}
+
+    for name in names:
+        runs = []
+
+        for i in range(repeat):
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                runs.append(executor.submit(run_benchmark, name, context).result())
+
+        results[name] = min(runs, key=lambda result: result["seconds"])
+
+        make.debug("Benchmark: {0} ({1:.3f}s)".format(name, results[name]["seconds"]))
+
+    return results
+
+
+def compare_results(results, baseline):
+    """
+    Return the metrics that increased over the baseline more than their
+    tolerance, as (benchmark, metric, value, baseline value) tuples.
+    """
+    regressions = []
+
+    for name in results:
+        if name not in baseline:
+            continue
+
+        for metric in BENCHMARK_TOLERANCE:
+            value = results[name].get(metric)
+            base_value = baseline[name].get(metric)
+
+            if value is None or not base_value:
+                continue
+
+            if value > base_value * (1 + BENCHMARK_TOLERANCE[metric]):
+                regressions.append((name, metric, value, base_value))
+
+    return regressions
+
+
+def format_change(value, base_value):
+    if value is None or not base_value:
+        return ""
+
+    return "{0:+.0f}%".format((value - base_value) * 100.0 / base_value)
+
+
+def format_metric(metric, value):
+    if metric == "seconds":
+        return "{0:.3f}s".format(value)
+
+    if metric == "peak_rss":
+        return make.format_size(value)
+
+    return str(value)
+
+
+def show_results(results, baseline):
+    make.message("")
+    make.message(
+        "  {0:<22} {1:>9} {2:>7} {3:>12} {4:>10} {5:>7} {6:>9} {7:>7}".format(
+            "benchmark", "time", "", "throughput", "peak rss", "", "syscalls", ""
+        )
+    )
+
+    for name in results:
+        result = results[name]
+        base = baseline.get(name, {})
+        throughput = ""
+
+        if "throughput" in result:
+            throughput = "{0}/s".format(make.format_size(result["throughput"]))
+
+        make.message(
+            "  {0:<22} {1:>8.3f}s {2:>7} {3:>12} {4:>10} {5:>7} {6:>9} {7:>7}".format(
+                name,
+                result["seconds"],
+                format_change(result["seconds"], base.get("seconds")),
+                throughput,
+                make.format_size(result["peak_rss"]),
+                format_change(result["peak_rss"], base.get("peak_rss")),
+                result.get("syscalls", ""),
+                format_change(result.get("syscalls"), base.get("syscalls")),
+            )
+        )
+
+    make.message("")
+
+
+def run(benchmark_options):
+    """
+    Run the benchmarks and compare them with the stored baseline. The
+    baseline is written when it doesn't exist or update is set.
+    """
+    scale = benchmark_options["scale"]
+    baseline_file = benchmark_options["baseline"]
+
+    bench_dir = os.path.abspath(os.path.join("build", "benchmark"))
+    data_dir = os.path.join(bench_dir, "data")
+
+    manifest = generate_data(data_dir, scale)
+    server, url = start_server(data_dir)
+
+    context = {
+        "url": url,
+        "data_dir": data_dir,
+        "work_dir": os.path.join(bench_dir, "work"),
+        "manifest": manifest,
+    }
+
+    try:
+        results = run_benchmarks(list(BENCHMARKS), context, benchmark_options["repeat"])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    baseline = make.read_json_file(baseline_file)
+
+    if baseline and baseline["scale"] != scale:
+        make.error(
+            "Baseline {0} was recorded with scale {1}".format(
+                baseline_file, baseline["scale"]
+            )
+        )
+
+    show_results(results, baseline["results"] if baseline else {})
+
+    if not baseline or benchmark_options["update"]:
+        make.write_json_file(
+            baseline_file,
+            {
+                "scale": scale,
+                "platform": sys.platform,
+                "python": sys.version.split()[0],
+                "results": results,
+            },
+        )
+        make.debug("Baseline saved: {0}".format(baseline_file))
+        return
+
+    regressions = compare_results(results, baseline["results"])
+
+    for name, metric, value, base_value in regressions:
+        make.debug(
+            "Regression: {0} {1}: {2} (baseline: {3}, {4})".format(
+                name,
+                metric,
+                format_metric(metric, value),
+                format_metric(metric, base_value),
+                format_change(value, base_value),
+            )
+        )
+
+    if regressions:
+        make.error("Benchmarks regressed: {0}".format(len(regressions)))
@@ -0,0 +1,419 @@
+"""
+Flash benchmarks for the host library
+
+Runs bossa_main from the built host library against the SAM-BA emulator,
+erasing, writing and verifying a synthetic image, and reports the time of
+each phase and the write and verify throughput. Each run loads the library
+in a new process, like a new call from the dart projects. The image is also
+written with each log mode of the library, to measure the cost of logging.
+
+It also compares a read, write and verify flow made of bossa_main calls,
+that connect and identify the device on each call, with the same flow in
+one session.
+"""
+
+import os
+import sys
+import json
+import random
+import subprocess
+import time
+
+import make
+
+from samba_emulator import SambaEmulator
+
+FLASH_SEED = 1234
+
+# device modes: Arduino bootloader extensions or the plain SAM-BA monitor
+FLASH_MODES = {
+    "arduino": "XYZ",
+    "samba": "",
+}
+
+FLASH_SCRIPT = """
+import ctypes
+import sys
+
+lib = ctypes.CDLL(sys.argv[1])
+args = ctypes.create_string_buffer(sys.argv[2].encode("utf-8"))
+
+if len(sys.argv) > 3:
+    lib.bossa_log_set_level(int(sys.argv[3]))
+    lib.bossa_log_set_echo(int(sys.argv[4]))
+
+sys.exit(lib.bossa_main(0, args))
+"""
+
+# log modes of the library: level and echo
+FLASH_LOG_MODES = {
+    # every message, written to stdout as it is logged
+    "log-echo": (0, 1),
+    # progress and results, kept in the ring buffer
+    "log-buffer": (1, 0),
+    "log-off": (4, 0),
+}
+
+# times one bossa_main call, after the library is loaded
+FLASH_MAIN_SCRIPT = """
+import ctypes
+import json
+import sys
+import time
+
+lib = ctypes.CDLL(sys.argv[1])
+args = ctypes.create_string_buffer(sys.argv[2].encode("utf-8"))
+
+started = time.perf_counter()
+code = lib.bossa_main(0, args)
+
+print(json.dumps({"code": code, "seconds": time.perf_counter() - started}))
+"""
+
+# times each call of a session: open, the operations and close
+FLASH_SESSION_SCRIPT = """
+import ctypes
+import json
+import sys
+import time
+
+lib = ctypes.CDLL(sys.argv[1])
+lib.bossa_session_create.restype = ctypes.c_void_p
+lib.bossa_session_error.restype = ctypes.c_char_p
+
+session = ctypes.c_void_p(lib.bossa_session_create())
+port = sys.argv[2].encode("utf-8")
+size = int(sys.argv[3])
+image = sys.argv[4].encode("utf-8")
+calls = [
+    ("open", lambda: lib.bossa_session_open(session, port, 1)),
+    ("read", lambda: lib.bossa_session_read(session, b"read.bin", size, 0)),
+    ("write", lambda: lib.bossa_session_write(session, image, 0)),
+    ("verify", lambda: lib.bossa_session_verify(session, image, 0)),
+    ("close", lambda: lib.bossa_session_close(session)),
+]
+results = {}
+
+for name, call in calls:
+    started = time.perf_counter()
+    code = call()
+    results[name] = time.perf_counter() - started
+
+    if name != "close" and code != 0:
+        error = lib.bossa_session_error(session).decode("utf-8", "replace")
+        print(json.dumps({"error": "{0}: {1}".format(name, error)}))
+        sys.exit(1)
+
+print(json.dumps(results))
+"""
+
+# read, modify and verify flow, as bossa_main arguments
+FLASH_SESSION_FLOW = {
+    "read": "--read={size} read.bin",
+    "write": "--write {image}",
+    "verify": "--verify {image}",
+}
+
+FLASH_HEADER_ROW = (
+    "  {0:<10} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>11} {8:>11} {9:>9}"
+)
+FLASH_RESULT_ROW = "  {0:<10} {1:>7.3f}s {2:>7.3f}s {3:>7.3f}s {4:>7.3f}s {5:>7.3f}s {6:>7.3f}s {7:>11} {8:>11} {9:>9}"
+FLASH_SESSION_ROW = "  {0:<10} {1:>10} {2:>9} {3:>9}"
+
+
+def get_host_library():
+    if sys.platform == "darwin":
+        return os.path.join("dist", "macos", "x86_64", "libbossac.dylib")
+
+    return os.path.join("dist", "linux", "x86_64", "libbossac.so")
+
+
+def generate_image(file, size):
+    # half random, half zeros, like a firmware with padding
+    rng = random.Random(FLASH_SEED)
+    random_size = size // 2
+    content = rng.getrandbits(random_size * 8).to_bytes(random_size, "little")
+    content += bytes(size - random_size)
+
+    make.create_dir(os.path.dirname(file))
+
+    with open(file, "wb") as f:
+        f.write(content)
+
+    return content
+
+
+def run_bossa_main(library, args, cwd, log=None):
+    """
+    Call bossa_main with the args in a new process, with the log level and
+    echo when given, and return the exit code, the output and the time.
+    """
+    log_args = [str(value) for value in log] if log else []
+
+    started = time.monotonic()
+    process = subprocess.run(
+        [sys.executable, "-c", FLASH_SCRIPT, os.path.abspath(library), args] + log_args,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+    return (
+        process.returncode,
+        process.stdout.decode("utf-8", "replace"),
+        time.monotonic() - started,
+    )
+
+
+def run_flash(emulator, library, image_file, image, log=None):
+    emulator.reset_stats()
+
+    args = "bossac -e -w -v --port={0} --usb-port=1 {1}".format(
+        emulator.port, os.path.basename(image_file)
+    )
+    code, output, seconds = run_bossa_main(
+        library, args, os.path.dirname(image_file), log
+    )
+
+    if code != 0:
+        make.message(output)
+        make.error("Flash failed with exit code {0}".format(code))
+
+    if bytes(emulator.flash[: len(image)]) != image:
+        make.message(output)
+        make.error("Flash content doesn't match the image")
+
+    phases = emulator.stats["phases"]
+
+    result = {
+        "seconds": seconds,
+        # process start, library load and port setup before the first command
+        "startup": seconds - sum(phases.values()),
+        "phases": dict(phases),
+        "commands": sum(emulator.stats["commands"].values()),
+        "bytes_in": emulator.stats["bytes_in"],
+        "bytes_out": emulator.stats["bytes_out"],
+    }
+
+    for phase in ["write", "verify"]:
+        if phases.get(phase):
+            result[phase + "_throughput"] = len(image) / phases[phase]
+
+    return result
+
+
+def show_results(results, size):
+    make.message("")
+    make.message(
+        FLASH_HEADER_ROW.format(
+            "mode",
+            "total",
+            "startup",
+            "connect",
+            "erase",
+            "write",
+            "verify",
+            "write/s",
+            "verify/s",
+            "commands",
+        )
+    )
+
+    for mode in results:
+        result = results[mode]
+        phases = result["phases"]
+
+        make.message(
+            FLASH_RESULT_ROW.format(
+                mode,
+                result["seconds"],
+                result["startup"],
+                phases.get("connect", 0.0),
+                phases.get("erase", 0.0),
+                phases.get("write", 0.0),
+                phases.get("verify", 0.0),
+                make.format_size(result.get("write_throughput", 0)),
+                make.format_size(result.get("verify_throughput", 0)),
+                result["commands"],
+            )
+        )
+
+    make.message("")
+    make.debug("Image: {0}".format(make.format_size(size)))
+
+
+def run_json_script(script, args, cwd):
+    process = subprocess.run(
+        [sys.executable, "-c", script] + args,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = process.stdout.decode("utf-8", "replace").strip()
+    lines = output.splitlines()
+
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        make.message(output)
+        make.error(
+            "Session benchmark failed with exit code {0}".format(process.returncode)
+        )
+
+    if "error" in result:
+        make.message(output)
+        make.error("Session benchmark failed: {0}".format(result["error"]))
+
+    return result
+
+
+def run_session_flow(emulator, library, image_file, size):
+    """
+    Return the time of each operation of the flow with bossa_main calls
+    and with a session.
+    """
+    cwd = os.path.dirname(image_file)
+    image = os.path.basename(image_file)
+    library = os.path.abspath(library)
+    main_times = {}
+
+    for name in FLASH_SESSION_FLOW:
+        args = "bossac --port={0} --usb-port=1 {1}".format(
+            emulator.port, FLASH_SESSION_FLOW[name].format(size=size, image=image)
+        )
+        result = run_json_script(FLASH_MAIN_SCRIPT, [library, args], cwd)
+
+        if result["code"] != 0:
+            make.error(
+                "bossa_main {0} failed with exit code {1}".format(name, result["code"])
+            )
+
+        main_times[name] = result["seconds"]
+
+    session_times = run_json_script(
+        FLASH_SESSION_SCRIPT, [library, emulator.port, str(size), image], cwd
+    )
+
+    return main_times, session_times
+
+
+def format_seconds(seconds):
+    return "{0:.3f}s".format(seconds) if seconds is not None else ""
+
+
+def show_session_results(main_times, session_times):
+    make.message("")
+    make.message(
+        FLASH_SESSION_ROW.format("operation", "bossa_main", "session", "saved")
+    )
+
+    for name in ["open"] + list(FLASH_SESSION_FLOW) + ["close"]:
+        main_time = main_times.get(name)
+        session_time = session_times[name]
+        saved = main_time - session_time if main_time is not None else None
+
+        make.message(
+            FLASH_SESSION_ROW.format(
+                name,
+                format_seconds(main_time),
+                format_seconds(session_time),
+                format_seconds(saved),
+            )
+        )
+
+    main_total = sum(main_times.values())
+    session_total = sum(session_times.values())
+
+    make.message(
+        FLASH_SESSION_ROW.format(
+            "total",
+            format_seconds(main_total),
+            format_seconds(session_total),
+            format_seconds(main_total - session_total),
+        )
+    )
+    make.message("")
+    make.debug(
+        "Saved per operation: {0}".format(
+            format_seconds((main_total - session_total) / len(FLASH_SESSION_FLOW))
+        )
+    )
+
+
+def run(benchmark_options):
+    """
+    Erase, write and verify the image in each device mode, repeat times,
+    keeping the fastest run.
+    """
+    library = get_host_library()
+
+    if not os.path.isfile(library):
+        make.error("Library not found: {0}".format(library))
+
+    size = benchmark_options["flash_size"]
+    image_file = os.path.abspath(
+        os.path.join("build", "benchmark", "flash", "image.bin")
+    )
+    image = generate_image(image_file, size)
+
+    # device modes with the default log, then log modes with the Arduino
+    # extensions
+    runs = [(mode, FLASH_MODES[mode], None) for mode in FLASH_MODES]
+    runs += [
+        (mode, FLASH_MODES["arduino"], FLASH_LOG_MODES[mode])
+        for mode in FLASH_LOG_MODES
+    ]
+    results = {}
+
+    for mode, extensions, log in runs:
+        emulator = SambaEmulator(
+            latency=benchmark_options["flash_latency"],
+            baud=benchmark_options["flash_baud"],
+            extensions=extensions,
+        )
+
+        if size > emulator.device["flash_size"]:
+            make.error("Image is larger than the flash: {0}".format(size))
+
+        emulator.start()
+
+        try:
+            mode_results = []
+
+            for i in range(benchmark_options["repeat"]):
+                with make.trace_span("flash {0}".format(mode), "benchmark"):
+                    mode_results.append(
+                        run_flash(emulator, library, image_file, image, log)
+                    )
+        finally:
+            emulator.stop()
+
+        results[mode] = min(mode_results, key=lambda result: result["seconds"])
+
+        make.debug("Flash: {0} ({1:.3f}s)".format(mode, results[mode]["seconds"]))
+
+    show_results(results, size)
+
+    # session against separate bossa_main calls
+    emulator = SambaEmulator(
+        latency=benchmark_options["flash_latency"],
+        baud=benchmark_options["flash_baud"],
+    )
+    emulator.start()
+
+    main_times = {}
+    session_times = {}
+
+    try:
+        for i in range(benchmark_options["repeat"]):
+            with make.trace_span("flash session", "benchmark"):
+                times = run_session_flow(emulator, library, image_file, size)
+
+            # fastest time of each operation
+            for best, run_times in zip([main_times, session_times], times):
+                for name in run_times:
+                    best[name] = min(best.get(name, run_times[name]), run_times[name])
+    finally:
+        emulator.stop()
+
+    show_session_results(main_times, session_times)
@@ -0,0 +1,217 @@
+"""
+Flash several devices at the same time
+
+Loads the host library once and calls bossa_main for each port on its own
+thread, erasing, writing and verifying the image, and reports the result
+and throughput of each device and of all of them. The emulated run flashes
+emulated devices one after the other and then all at the same time, and
+checks the flash of each one.
+"""
+
+import os
+import ctypes
+import time
+
+import make
+
+from flash_benchmark import generate_image, get_host_library
+from samba_emulator import SambaEmulator
+
+# bossa_log level of the messages kept while flashing
+FLASH_LOG_LEVEL = 3
+
+FLASH_LOG_BUFFER = 64 * 1024
+
+FLASH_DEVICES_ARGS = "bossac -e -w -v --port={0} --usb-port=1 {1}"
+FLASH_DEVICES_ROW = "  {0:<24} {1:>8} {2:>9} {3:>12}"
+
+
+def load_library(library):
+    if not os.path.isfile(library):
+        make.error("Library not found: {0}".format(library))
+
+    lib = ctypes.CDLL(os.path.abspath(library))
+    lib.bossa_log_drain.restype = ctypes.c_uint32
+
+    # the messages of all the devices are drained after the flash, instead
+    # of mixed on stdout
+    lib.bossa_log_set_echo(0)
+    lib.bossa_log_set_level(FLASH_LOG_LEVEL)
+
+    return lib
+
+
+def drain_log(lib):
+    buffer = ctypes.create_string_buffer(FLASH_LOG_BUFFER)
+    messages = []
+
+    while True:
+        size = lib.bossa_log_drain(buffer, FLASH_LOG_BUFFER)
+
+        if not size:
+            break
+
+        for record in buffer.raw[:size].split(b"\0")[:-1]:
+            messages.append(record[1:].decode("utf-8", "replace").strip())
+
+    return messages
+
+
+def flash_device(lib, port, image_file):
+    args = ctypes.create_string_buffer(
+        FLASH_DEVICES_ARGS.format(port, image_file).encode("utf-8")
+    )
+
+    started = time.monotonic()
+    code = lib.bossa_main(0, args)
+
+    return {"port": port, "code": code, "seconds": time.monotonic() - started}
+
+
+def flash_devices(lib, ports, image_file, jobs):
+    """
+    Flash the image to the ports, jobs at the same time, and return the
+    result of each port and the total time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    # bossa_main splits its arguments on spaces
+    if " " in image_file:
+        make.error("Image path can't have spaces: {0}".format(image_file))
+
+    started = time.monotonic()
+
+    # ctypes releases the GIL while bossa_main runs
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(
+            executor.map(lambda port: flash_device(lib, port, image_file), ports)
+        )
+
+    return results, time.monotonic() - started
+
+
+def show_results(results, seconds, size):
+    make.message("")
+    make.message(FLASH_DEVICES_ROW.format("port", "result", "time", "throughput"))
+
+    for result in results:
+        make.message(
+            FLASH_DEVICES_ROW.format(
+                result["port"],
+                "ok" if result["code"] == 0 else "code {0}".format(result["code"]),
+                "{0:.3f}s".format(result["seconds"]),
+                make.format_size(size / result["seconds"]) + "/s",
+            )
+        )
+
+    flashed = len([result for result in results if result["code"] == 0])
+
+    make.message("")
+    make.debug(
+        "Devices: {0} | ok: {1} | time: {2:.3f}s | throughput: {3}/s".format(
+            len(results), flashed, seconds, make.format_size(size * flashed / seconds)
+        )
+    )
+
+
+def run(flash_options):
+    """
+    Flash the image to all the ports at the same time.
+    """
+    ports = flash_options["ports"]
+    image_file = flash_options["image"]
+
+    if not ports:
+        make.error("No ports to flash, use --ports")
+
+    if not image_file or not os.path.isfile(image_file):
+        make.error("Image not found: {0}".format(image_file))
+
+    lib = load_library(get_host_library())
+
+    results, seconds = flash_devices(lib, ports, image_file, len(ports))
+
+    for line in drain_log(lib):
+        make.message(line)
+
+    show_results(results, seconds, os.path.getsize(image_file))
+
+    failed = [result["port"] for result in results if result["code"] != 0]
+
+    if failed:
+        make.error("Flash failed: {0}".format(", ".join(failed)))
+
+
+def run_emulated(benchmark_options):
+    """
+    Flash the emulated devices one after the other and all at the same
+    time, repeat times, keeping the fastest run of each.
+    """
+    size = benchmark_options["flash_size"]
+    count = benchmark_options["flash_devices"]
+    image_file = os.path.abspath(
+        os.path.join("build", "benchmark", "flash-devices", "image.bin")
+    )
+    image = generate_image(image_file, size)
+
+    lib = load_library(get_host_library())
+
+    emulators = [
+        SambaEmulator(
+            latency=benchmark_options["flash_latency"],
+            baud=benchmark_options["flash_baud"],
+        )
+        for i in range(count)
+    ]
+
+    if size > emulators[0].device["flash_size"]:
+        make.error("Image is larger than the flash: {0}".format(size))
+
+    times = {}
+
+    try:
+        ports = [emulator.start() for emulator in emulators]
+
+        for mode, jobs in [("sequential", 1), ("parallel", count)]:
+            runs = []
+
+            for i in range(benchmark_options["repeat"]):
+                for emulator in emulators:
+                    emulator.erase_flash(
+                        emulator.device["flash_addr"], len(emulator.flash)
+                    )
+
+                with make.trace_span("flash {0}".format(mode), "benchmark"):
+                    results, seconds = flash_devices(lib, ports, image_file, jobs)
+
+                for line in drain_log(lib):
+                    make.message(line)
+
+                for emulator, result in zip(emulators, results):
+                    if result["code"] != 0:
+                        make.error(
+                            "Flash failed on {0} with exit code {1}".format(
+                                result["port"], result["code"]
+                            )
+                        )
+
+                    if bytes(emulator.flash[: len(image)]) != image:
+                        make.error(
+                            "Flash content doesn't match the image on {0}".format(
+                                result["port"]
+                            )
+                        )
+
+                runs.append((results, seconds))
+
+            results, seconds = min(runs, key=lambda run: run[1])
+            times[mode] = seconds
+
+            make.debug("Flash: {0} ({1:.3f}s)".format(mode, seconds))
+
+            show_results(results, seconds, size)
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+    make.debug("Speedup: {0:.2f}x".format(times["sequential"] / times["parallel"]))
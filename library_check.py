@@ -0,0 +1,552 @@
+"""
+Checks for the built libraries
+
+Parses the ELF and Mach-O headers of each library in-process, checks the
+architecture and the exported FFI symbols, reports the section sizes and,
+when the library can run on this host, measures the time to load it and
+look up the FFI symbols. The results are compared with a stored baseline.
+"""
+
+import os
+import sys
+import struct
+import subprocess
+
+import make
+
+# functions the dart projects look up through ffi
+LIBRARY_SYMBOLS = [
+    "bossa_main",
+    "tokeniseToArgcArgv",
+    "test_flutter_void",
+    "test_flutter_pointer",
+    "bossa_session_create",
+    "bossa_session_open",
+    "bossa_session_device",
+    "bossa_session_flash_size",
+    "bossa_session_page_size",
+    "bossa_session_erase",
+    "bossa_session_write",
+    "bossa_session_verify",
+    "bossa_session_read",
+    "bossa_session_reset",
+    "bossa_session_error",
+    "bossa_session_close",
+    "bossa_main_async",
+    "bossa_async_poll",
+    "bossa_async_cancel",
+    "bossa_async_wait",
+    "bossa_async_free",
+    "bossa_log_set_level",
+    "bossa_log_set_echo",
+    "bossa_log_drain",
+    "bossa_log_dropped_count",
+]
+
+# arch reported by the headers for each arch name used by the builds
+LIBRARY_ARCHS = {
+    "arm64-v8a": "aarch64",
+    "armeabi-v7a": "arm",
+    "x86": "x86",
+    "x86_64": "x86_64",
+}
+
+# allowed increase over the baseline before a metric is a regression
+LIBRARY_TOLERANCE = {
+    "size": 0.05,
+    "text": 0.05,
+    "data": 0.05,
+    "load_seconds": 0.50,
+}
+
+# load time changes below this are noise
+LIBRARY_MIN_LOAD_CHANGE = 0.002
+
+LIBRARY_LOAD_RUNS = 5
+
+LIBRARY_REPORT_ROW = "  {0:<12} {1:<8} {2:>10} {3:>6} {4:>10} {5:>6} {6:>10} {7:>10} {8:>8} {9:>10} {10:>6}"
+
+# loads the library in a fresh process, so it isn't already mapped
+LIBRARY_LOAD_SCRIPT = """
+import ctypes
+import sys
+import time
+
+started = time.perf_counter()
+lib = ctypes.CDLL(sys.argv[1])
+
+for name in sys.argv[2:]:
+    getattr(lib, name)
+
+print(time.perf_counter() - started)
+"""
+
+ELF_MACHINES = {
+    3: "x86",
+    40: "arm",
+    62: "x86_64",
+    183: "aarch64",
+}
+
+ELF_SHT_NOBITS = 8
+ELF_SHT_DYNSYM = 11
+ELF_SHF_WRITE = 0x1
+ELF_SHF_ALLOC = 0x2
+
+MACHO_CPU_TYPES = {
+    7: "x86",
+    12: "arm",
+    0x01000007: "x86_64",
+    0x0100000C: "aarch64",
+}
+
+MACHO_LC_SEGMENT_64 = 0x19
+MACHO_LC_SYMTAB = 0x2
+MACHO_S_ZEROFILL = 0x1
+
+
+def read_c_string(data, offset):
+    end = data.index(b"\0", offset)
+
+    return data[offset:end].decode("utf-8", "replace")
+
+
+def parse_elf(data):
+    """
+    Return the arch, the sections (name: (size, kind)) and the exported
+    symbols of an ELF shared library.
+    """
+    is_64 = data[4] == 2
+    endian = "<" if data[5] == 1 else ">"
+
+    if is_64:
+        header = struct.unpack_from(endian + "HHIQQQIHHHHHH", data, 16)
+        section_format = endian + "IIQQQQIIQQ"
+        symbol_format = endian + "IBBHQQ"
+    else:
+        header = struct.unpack_from(endian + "HHIIIIIHHHHHH", data, 16)
+        section_format = endian + "IIIIIIIIII"
+        symbol_format = endian + "IIIBBH"
+
+    machine = header[1]
+    section_offset, section_size, section_count, names_index = (
+        header[5],
+        header[10],
+        header[11],
+        header[12],
+    )
+
+    headers = []
+
+    for i in range(section_count):
+        fields = struct.unpack_from(
+            section_format, data, section_offset + i * section_size
+        )
+        name, kind, flags, addr, offset, size, link = fields[:7]
+        headers.append((name, kind, flags, offset, size, link))
+
+    names_offset = headers[names_index][3] if headers else 0
+    sections = {}
+    symbols = []
+
+    for name, kind, flags, offset, size, link in headers:
+        if flags & ELF_SHF_ALLOC:
+            if kind == ELF_SHT_NOBITS:
+                section_kind = "bss"
+            elif flags & ELF_SHF_WRITE:
+                section_kind = "data"
+            else:
+                section_kind = "text"
+        else:
+            section_kind = "other"
+
+        sections[read_c_string(data, names_offset + name)] = (size, section_kind)
+
+        if kind != ELF_SHT_DYNSYM:
+            continue
+
+        strings_offset = headers[link][3]
+        symbol_size = struct.calcsize(symbol_format)
+
+        for symbol_offset in range(offset, offset + size, symbol_size):
+            fields = struct.unpack_from(symbol_format, data, symbol_offset)
+
+            if is_64:
+                symbol_name, info, other, section_index = fields[:4]
+            else:
+                symbol_name, info, other, section_index = (
+                    fields[0],
+                    fields[3],
+                    fields[4],
+                    fields[5],
+                )
+
+            bind = info >> 4
+            visibility = other & 0x3
+
+            # defined, global or weak, default or protected visibility
+            if section_index != 0 and bind in [1, 2] and visibility in [0, 3]:
+                symbols.append(read_c_string(data, strings_offset + symbol_name))
+
+    return {
+        "format": "elf",
+        "arch": ELF_MACHINES.get(machine, "unknown ({0})".format(machine)),
+        "sections": sections,
+        "symbols": symbols,
+        "stripped": ".symtab" not in sections,
+    }
+
+
+def parse_macho(data, offset=0):
+    """
+    Return the arch, the sections (name: (size, kind)) and the exported
+    symbols of a 64-bit Mach-O library.
+    """
+    magic, cpu_type, cpu_subtype, file_type, command_count = struct.unpack_from(
+        "<IiiII", data, offset
+    )
+
+    if magic != 0xFEEDFACF:
+        make.error("Only 64-bit Mach-O libraries are supported")
+
+    sections = {}
+    symbols = []
+    stripped = True
+    command_offset = offset + 32
+
+    for i in range(command_count):
+        command, command_size = struct.unpack_from("<II", data, command_offset)
+
+        if command == MACHO_LC_SEGMENT_64:
+            section_count = struct.unpack_from("<I", data, command_offset + 64)[0]
+
+            for j in range(section_count):
+                section_offset = command_offset + 72 + j * 80
+                section_name, segment_name, addr, size = struct.unpack_from(
+                    "<16s16sQQ", data, section_offset
+                )
+                flags = struct.unpack_from("<I", data, section_offset + 64)[0]
+                segment_name = segment_name.rstrip(b"\0").decode("utf-8")
+
+                if flags & 0xFF == MACHO_S_ZEROFILL:
+                    section_kind = "bss"
+                elif segment_name == "__TEXT":
+                    section_kind = "text"
+                elif segment_name.startswith("__DATA"):
+                    section_kind = "data"
+                else:
+                    section_kind = "other"
+
+                name = "{0},{1}".format(
+                    segment_name, section_name.rstrip(b"\0").decode("utf-8")
+                )
+                sections[name] = (size, section_kind)
+        elif command == MACHO_LC_SYMTAB:
+            symbol_offset, symbol_count, strings_offset = struct.unpack_from(
+                "<III", data, command_offset + 8
+            )
+
+            for j in range(symbol_count):
+                name, kind = struct.unpack_from(
+                    "<IB", data, offset + symbol_offset + j * 16
+                )
+
+                if kind & 0xE0:
+                    # debugging entries are only kept in unstripped libraries
+                    stripped = False
+                elif kind & 0x01 and kind & 0x0E == 0x0E:
+                    symbol = read_c_string(data, offset + strings_offset + name)
+                    symbols.append(symbol[1:] if symbol.startswith("_") else symbol)
+
+        command_offset += command_size
+
+    return {
+        "format": "macho",
+        "arch": MACHO_CPU_TYPES.get(cpu_type, "unknown ({0})".format(cpu_type)),
+        "sections": sections,
+        "symbols": symbols,
+        "stripped": stripped,
+    }
+
+
+def parse_library(file):
+    """
+    Parse an ELF, Mach-O or universal (fat) Mach-O library. A universal
+    library returns the list of its slices in "slices".
+    """
+    with open(file, "rb") as f:
+        data = f.read()
+
+    if data[:4] == b"\x7fELF":
+        return parse_elf(data)
+
+    if data[:4] == b"\xcf\xfa\xed\xfe":
+        return parse_macho(data)
+
+    if data[:4] == b"\xca\xfe\xba\xbe":
+        slice_count = struct.unpack_from(">I", data, 4)[0]
+        slices = []
+
+        for i in range(slice_count):
+            offset = struct.unpack_from(">I", data, 8 + i * 20 + 8)[0]
+            slices.append(parse_macho(data, offset))
+
+        return {"format": "macho-fat", "slices": slices}
+
+    make.error("Unknown library format: {0}".format(file))
+
+
+def get_host_format():
+    if sys.platform.startswith("linux"):
+        return "elf"
+
+    if sys.platform == "darwin":
+        return "macho"
+
+    return None
+
+
+def get_host_arch():
+    import platform
+
+    machine = platform.machine().lower()
+
+    return {"amd64": "x86_64", "arm64": "aarch64", "i686": "x86", "i386": "x86"}.get(
+        machine, machine
+    )
+
+
+def measure_load_time(file, symbols):
+    """
+    Return the fastest time, over a few fresh processes, to load the library
+    and look up the symbols.
+    """
+    times = []
+
+    for i in range(LIBRARY_LOAD_RUNS):
+        output = subprocess.check_output(
+            [sys.executable, "-c", LIBRARY_LOAD_SCRIPT, os.path.abspath(file)] + symbols
+        )
+        times.append(float(output.decode("utf-8").strip()))
+
+    return min(times)
+
+
+def check_library(file, arch, can_load):
+    """
+    Check a library and return its report and the list of problems found.
+    """
+    library = parse_library(file)
+    expected_arch = LIBRARY_ARCHS.get(arch, arch)
+    problems = []
+
+    if library["format"] == "macho-fat":
+        slices = [item for item in library["slices"] if item["arch"] == expected_arch]
+        library = slices[0] if slices else library["slices"][0]
+
+    if library["arch"] != expected_arch:
+        problems.append(
+            "arch is {0}, expected {1}".format(library["arch"], expected_arch)
+        )
+
+    missing = [name for name in LIBRARY_SYMBOLS if name not in library["symbols"]]
+
+    if missing:
+        problems.append("missing symbols: {0}".format(", ".join(missing)))
+
+    report = {
+        "format": library["format"],
+        "arch": library["arch"],
+        "size": os.path.getsize(file),
+        "stripped": library["stripped"],
+        "exported": len(library["symbols"]),
+        "sections": {},
+    }
+
+    for kind in ["text", "data", "bss"]:
+        report[kind] = 0
+
+    for name, (size, kind) in library["sections"].items():
+        if name:
+            report["sections"][name] = size
+
+        if kind in report:
+            report[kind] += size
+
+    if (
+        can_load
+        and not problems
+        and library["format"] == get_host_format()
+        and library["arch"] == get_host_arch()
+    ):
+        report["load_seconds"] = measure_load_time(file, LIBRARY_SYMBOLS)
+
+    return report, problems
+
+
+def compare_reports(reports, baseline):
+    """
+    Return the metrics that increased over the baseline more than their
+    tolerance, as (arch, metric, value, baseline value) tuples.
+    """
+    regressions = []
+
+    for arch in reports:
+        if arch not in baseline:
+            continue
+
+        for metric in LIBRARY_TOLERANCE:
+            value = reports[arch].get(metric)
+            base_value = baseline[arch].get(metric)
+
+            if value is None or not base_value:
+                continue
+
+            if (
+                metric == "load_seconds"
+                and value - base_value < LIBRARY_MIN_LOAD_CHANGE
+            ):
+                continue
+
+            if value > base_value * (1 + LIBRARY_TOLERANCE[metric]):
+                regressions.append((arch, metric, value, base_value))
+
+    return regressions
+
+
+def format_change(value, base_value):
+    if value is None or not base_value:
+        return ""
+
+    return "{0:+.0f}%".format((value - base_value) * 100.0 / base_value)
+
+
+def format_metric(metric, value):
+    if metric == "load_seconds":
+        return "{0:.2f}ms".format(value * 1000)
+
+    return make.format_size(value)
+
+
+def show_reports(reports, baseline):
+    make.message("")
+    make.message(
+        LIBRARY_REPORT_ROW.format(
+            "arch",
+            "",
+            "size",
+            "",
+            "text",
+            "",
+            "data",
+            "bss",
+            "symbols",
+            "load",
+            "",
+        )
+    )
+
+    for arch in reports:
+        report = reports[arch]
+        base = baseline.get(arch, {})
+        load = ""
+
+        if "load_seconds" in report:
+            load = format_metric("load_seconds", report["load_seconds"])
+
+        make.message(
+            LIBRARY_REPORT_ROW.format(
+                arch,
+                report["arch"],
+                make.format_size(report["size"]),
+                format_change(report["size"], base.get("size")),
+                make.format_size(report["text"]),
+                format_change(report["text"], base.get("text")),
+                make.format_size(report["data"]),
+                make.format_size(report["bss"]),
+                report["exported"],
+                load,
+                format_change(report.get("load_seconds"), base.get("load_seconds")),
+            )
+        )
+
+    make.message("")
+
+
+def run(platform, builds, test_options):
+    """
+    Check the library of each build (dicts with arch, install_dir and
+    lib_file) and compare the reports with the baseline of the platform.
+    The baseline is written only when update is set.
+    """
+    baseline_file = test_options["baseline"]
+    can_load = platform in ["linux", "macos"]
+
+    reports = {}
+    failed = []
+
+    for build in builds:
+        arch = build["arch"]
+        file = os.path.join(build["install_dir"], build["lib_file"])
+
+        if not os.path.isfile(file):
+            make.error("Library not found: {0}".format(file))
+
+        with make.trace_span("check {0}".format(arch), "test", {"arch": arch}):
+            report, problems = check_library(file, arch, can_load)
+
+        reports[arch] = report
+
+        for problem in problems:
+            make.debug("Problem: {0}: {1}".format(arch, problem))
+
+        if problems:
+            failed.append(arch)
+
+        make.debug(
+            "Checked: {0} ({1}, {2}, {3} exported symbols{4})".format(
+                arch,
+                report["format"],
+                report["arch"],
+                report["exported"],
+                ", stripped" if report["stripped"] else "",
+            )
+        )
+
+    baseline = make.read_json_file(baseline_file) or {}
+
+    show_reports(reports, baseline.get(platform, {}))
+
+    if failed:
+        make.error("Library check failed for: {0}".format(", ".join(failed)))
+
+    if test_options["update"]:
+        baseline[platform] = reports
+        make.write_json_file(baseline_file, baseline)
+        make.debug("Baseline saved: {0}".format(baseline_file))
+        return
+
+    # a baseline written here would only be compared with itself
+    if platform not in baseline:
+        make.debug(
+            "No baseline for {0} in {1}, not compared, save one with --library-update".format(
+                platform, baseline_file
+            )
+        )
+        return
+
+    regressions = compare_reports(reports, baseline[platform])
+
+    for arch, metric, value, base_value in regressions:
+        make.debug(
+            "Regression: {0} {1}: {2} (baseline: {3}, {4})".format(
+                arch,
+                metric,
+                format_metric(metric, value),
+                format_metric(metric, base_value),
+                format_change(value, base_value),
+            )
+        )
+
+    if regressions:
+        make.error("Library regressed: {0}".format(len(regressions)))
@@ -5,72 +5,329 @@
 Make tool
 
 Usage:
-  make.py run <task-name>
+  make.py run <task-name>... [options]
   make.py [options]
-  make.py -h | --help  
+  make.py -h | --help
 
 Options:
   -h --help                         Show this screen.
   -d --debug                        Enable debug mode.
+  -j --jobs=<jobs>                  Number of archs to build in parallel [default: 1].
+  -k --keep-going                   Keep building other archs when one fails.
+  -G --generator=<generator>        CMake generator: auto, ninja or make [default: auto].
+  --compile-jobs=<jobs>             Number of compile jobs per arch [default: auto].
+  --clean                           Remove build and dist dirs before building.
+  --profile=<profile>               Build profile: debug, release, minsize or lto [default: debug].
+  --split-debug                     Move the debug info of the library to a separate file.
+  --unity                           Compile the BOSSA sources as a unity build.
+  --pch                             Precompile the common headers.
+  --compiler-cache=<tool>           Compiler cache: auto, ccache, sccache or none [default: auto].
+  --cache-dir=<dir>                 Compiler cache directory.
+  --cache-size=<size>               Compiler cache size limit (ex: 5G).
+  --download-cache=<dir>            Download cache directory shared by checkouts.
+  --download-cache-size=<size>      Download cache size limit [default: 5G].
+  --offline                         Fail when a download is not in the cache.
+  --extract-jobs=<jobs>             Number of extraction workers [default: auto].
+  --extract-all                     Extract archives in full, ignoring the manifest.
+  --task-jobs=<jobs>                Number of independent tasks run at the same time [default: 4].
+  --no-deps                         Run only the given tasks, without their dependencies.
+  --trace=<file>                    Write a Chrome trace of the tasks, downloads and commands.
+  --usage=<file>                    Write the resources used by each command as JSON.
+  --benchmark-scale=<scale>         Size of the benchmark data [default: 1].
+  --benchmark-repeat=<count>        Runs of each benchmark, the fastest is kept [default: 3].
+  --benchmark-baseline=<file>       Benchmark baseline file [default: benchmark.json].
+  --benchmark-update                Save the benchmark results as the baseline.
+  --flash-size=<size>               Size of the flash benchmark image [default: 64K].
+  --flash-latency=<ms>              Latency of each emulated device command [default: 0].
+  --flash-baud=<baud>               Baud rate of the emulated device, 0 for no limit [default: 0].
+  --flash-devices=<count>           Number of emulated devices flashed at the same time [default: 4].
+  --ports=<ports>                   Serial ports to flash, separated by commas.
+  --image=<file>                    Image to flash.
+  --library-baseline=<file>         Library check baseline file [default: library.json].
+  --library-update                  Save the library check results as the baseline.
   --version                         Show version.
-  
+
 Examples:
   python make.py -h
+  python make.py run build-android --jobs=4
+  python make.py run get-wx get-bossa get-ndk
 
 Tasks:
-  - clear
-  - get-wx
-  - get-bossa
-  - get-ndk
-
-  - patch-bossa
-  - remove-bossa
-  
-  - patch-android
-  - build-android
-  - test-android
-  - install-android
-  
-  - patch-macos
-  - build-macos
-  - test-macos
-  - install-macos
-  - run-macos
-
-  - patch-linux
-  - build-linux
-  - test-linux
-  - install-linux
-  - run-linux
+{tasks}
 """
 
 import os
 import shutil
 import stat
 import sys
-import tarfile
-import zipfile
-import glob
+import fnmatch
+import hashlib
+import json
 import pwd
-import platform
-import pathlib
-
-from simple_zip import ZipFileWithPermissions
+import re
+import threading
+import time
 
-from docopt import docopt
-from slugify import slugify
-from tqdm import tqdm
-
-from subprocess import call, check_call
+from contextlib import contextmanager
 from shutil import copyfile, copytree, copy2
 
-import urllib.request as urllib2
-import urllib.parse as urlparse
+# members extracted from each dependency archive, only what the build uses
+EXTRACT_MANIFEST = {
+    "BOSSA-master": {
+        "include": [],
+        "exclude": [],
+        "patched": [
+            "BOSSA-master/src/bossac.cpp",
+            "BOSSA-master/src/CmdOpts.cpp",
+        ],
+    },
+    "wxWidgets-3.1.4": {
+        "include": ["wxWidgets-3.1.4/include/*"],
+        "exclude": [],
+        "patched": [],
+    },
+    "android-ndk-r21d": {
+        "include": [],
+        "exclude": [
+            "android-ndk-r21d/prebuilt/*",
+            "android-ndk-r21d/python-packages/*",
+            "android-ndk-r21d/shader-tools/*",
+            "android-ndk-r21d/simpleperf/*",
+            "android-ndk-r21d/sources/third_party/*",
+            "android-ndk-r21d/toolchains/renderscript/*",
+            "android-ndk-r21d/wrap.sh/*",
+        ],
+        "patched": [],
+    },
+}
+
+# patch rules appended to the BOSSA sources by every platform set
+PLATFORM_PATCH_RULES = [
+    {
+        "name": "Bossac Session Functions",
+        "file": "bossac.cpp",
+        "guard": "bossa_session_open",
+        "append_file": "bossac_session.cpp",
+    },
+    {
+        "name": "Bossac Async Functions",
+        "file": "bossac.cpp",
+        "guard": "bossa_main_async",
+        "append_file": "bossac_async.cpp",
+    },
+]
+
+# patch rules of each patch task, applied in order to the BOSSA sources; a rule
+# is skipped when its guard is already in the file, its regex patterns match
+# across lines
+PATCH_SETS = {
+    "bossa": [
+        {
+            "name": "Bossac Version",
+            "file": "bossac.cpp",
+            "guard": "Version 1.9.1",
+            "replace": [('Version " VERSION "', "Version 1.9.1")],
+        },
+        {
+            "name": "Extra arguments found",
+            "file": "bossac.cpp",
+            "guard": "extra arguments found (parsed: %d | sent: %d)",
+            "replace": [
+                (
+                    'fprintf(stderr, "%s: extra arguments found\\n", argv[0]);',
+                    'fprintf(stderr, "%s: extra arguments found (parsed: %d | sent: %d)\\n", argv[0], args, argc);',
+                )
+            ],
+        },
+        {
+            "name": "Reset cmd parse",
+            "file": "CmdOpts.cpp",
+            "guard": "optind = 1;",
+            "replace": [
+                (
+                    "struct option long_opts[_numOpts + 1];",
+                    "optind = 1;\n    struct option long_opts[_numOpts + 1];",
+                )
+            ],
+        },
+        {
+            "name": "Bossac Progress Hooks",
+            "file": "bossac.cpp",
+            "guard": "bossa_async_progress",
+            "replace": [
+                (
+                    "class BossaObserver : public FlasherObserver",
+                    "enum BossaPhase\n"
+                    "{\n"
+                    "    BOSSA_PHASE_CONNECT = 1,\n"
+                    "    BOSSA_PHASE_ERASE,\n"
+                    "    BOSSA_PHASE_WRITE,\n"
+                    "    BOSSA_PHASE_VERIFY,\n"
+                    "    BOSSA_PHASE_READ,\n"
+                    "    BOSSA_PHASE_DONE,\n"
+                    "};\n\n"
+                    "void bossa_async_phase(int phase);\n"
+                    "void bossa_async_page_size(uint32_t size);\n"
+                    "void bossa_async_progress(int num, int div);\n\n"
+                    "class BossaObserver : public FlasherObserver",
+                ),
+                (
+                    "ticks = num * bars / div;",
+                    "bossa_async_progress(num, div);\n\n    ticks = num * bars / div;",
+                ),
+                (
+                    "bool res;",
+                    "bossa_async_phase(BOSSA_PHASE_CONNECT);\n\n        bool res;",
+                ),
+                (
+                    "Device::FlashPtr& flash = device.getFlash();",
+                    "Device::FlashPtr& flash = device.getFlash();\n"
+                    "        bossa_async_page_size(flash->pageSize());",
+                ),
+                (
+                    "flasher.erase(config.offsetArg);",
+                    "bossa_async_phase(BOSSA_PHASE_ERASE);\n"
+                    "            flasher.erase(config.offsetArg);",
+                ),
+                (
+                    "flasher.write(argv[args], config.offsetArg);",
+                    "bossa_async_phase(BOSSA_PHASE_WRITE);\n"
+                    "            flasher.write(argv[args], config.offsetArg);",
+                ),
+                (
+                    "if (!flasher.verify(",
+                    "bossa_async_phase(BOSSA_PHASE_VERIFY);\n"
+                    "            if (!flasher.verify(",
+                ),
+                (
+                    "flasher.read(argv[args], config.readArg, config.offsetArg);",
+                    "bossa_async_phase(BOSSA_PHASE_READ);\n"
+                    "            flasher.read(argv[args], config.readArg, config.offsetArg);",
+                ),
+            ],
+        },
+        {
+            # one progress line per tick of the bar instead of one per page
+            "name": "Bossac Progress Line",
+            "file": "bossac.cpp",
+            "guard": "_lastTicks = ticks;",
+            "regex": [
+                (
+                    r'printf\("\\r\["\);.*?_lastTicks = 0;',
+                    'bossa_log(BOSSA_LOG_INFO, "\\r[%-*.*s] %d%% (%d/%d pages)", bars, ticks,\n'
+                    '        "==============================", num * 100 / div, num, div);\n'
+                    "\n"
+                    "    _lastTicks = ticks;",
+                )
+            ],
+        },
+        {
+            "name": "Bossac Log",
+            "file": "bossac.cpp",
+            "guard": "bossa_log_drain",
+            "replace": [
+                ("fprintf(stderr,", "bossa_log(BOSSA_LOG_ERROR,"),
+                (" printf(", " bossa_log(BOSSA_LOG_INFO, "),
+                ("vprintf(message, ap);", "bossa_vlog(BOSSA_LOG_INFO, message, ap);"),
+            ],
+            "prepend_file": "bossac_log.cpp",
+        },
+        {
+            "name": "Bossac Reentrant",
+            "file": "bossac.cpp",
+            "guard": "bossa_parse_mutex",
+            "replace": [
+                (
+                    "static BossaConfig config;",
+                    "// getopt keeps its state in globals, one thread parses at a time\n"
+                    "static mutex bossa_parse_mutex;\n\n"
+                    "// each thread running bossa_main has its own options\n"
+                    "static thread_local BossaConfig config;",
+                ),
+                ("static Option opts[] =", "static thread_local Option opts[] ="),
+                (
+                    "static struct timeval start_time;",
+                    "static thread_local struct timeval start_time;",
+                ),
+                (
+                    "CmdOpts cmd(argc, argv, sizeof(opts) / sizeof(opts[0]), opts);",
+                    "CmdOpts cmd(argc, argv, sizeof(opts) / sizeof(opts[0]), opts);\n\n"
+                    "    // clear the options of the previous call on this thread\n"
+                    "    config = BossaConfig();",
+                ),
+                (
+                    "args = cmd.parse();",
+                    "{\n"
+                    "        lock_guard<mutex> lock(bossa_parse_mutex);\n"
+                    "        args = cmd.parse();\n"
+                    "    }",
+                ),
+            ],
+            "prepend": "#include <mutex>",
+        },
+    ],
+    "android": [
+        {
+            "name": "Bossac Flutter Functions",
+            "file": "bossac.cpp",
+            "guard": "test_flutter_void",
+            "append_file": "bossac_android.cpp",
+        },
+    ]
+    + PLATFORM_PATCH_RULES,
+    "macos": [
+        {
+            "name": "Bossac Flutter Functions",
+            "file": "bossac.cpp",
+            "guard": "test_flutter_void",
+            "append_file": "bossac_macos.cpp",
+        },
+    ]
+    + PLATFORM_PATCH_RULES,
+    "linux": [
+        {
+            "name": "Bossac Flutter Functions",
+            "file": "bossac.cpp",
+            "guard": "test_flutter_void",
+            "append_file": "bossac_linux.cpp",
+        },
+    ]
+    + PLATFORM_PATCH_RULES,
+}
 
 
 def main(options):
     make_debug = False
-    make_task = ""
+    make_tasks = []
+    make_jobs = 1
+    make_keep_going = False
+    make_generator = "auto"
+    make_compile_jobs = "auto"
+    make_clean = False
+    make_profile = "debug"
+    make_split_debug = False
+    make_unity = False
+    make_pch = False
+    make_compiler_cache = "auto"
+    make_cache_dir = None
+    make_cache_size = None
+    make_download_cache = get_download_cache_dir()
+    make_download_cache_size = "5G"
+    make_offline = False
+    make_extract_jobs = "auto"
+    make_extract_all = False
+    make_benchmark_scale = "1"
+    make_benchmark_repeat = "3"
+    make_benchmark_baseline = "benchmark.json"
+    make_benchmark_update = False
+    make_flash_size = "64K"
+    make_flash_latency = "0"
+    make_flash_baud = "0"
+    make_flash_devices = "4"
+    make_ports = []
+    make_image = None
+    make_library_baseline = "library.json"
+    make_library_update = False
 
     # show all params for debug
     if ("--debug" in options and options["--debug"]) or (
@@ -84,101 +341,490 @@ def main(options):
         message("")
 
     # bind options
-    if "<task-name>" in options:
-        make_task = options["<task-name>"]
+    if "<task-name>" in options and options["<task-name>"]:
+        make_tasks = options["<task-name>"]
+
+    if "--jobs" in options and options["--jobs"]:
+        make_jobs = options["--jobs"]
+
+    if "--keep-going" in options and options["--keep-going"]:
+        make_keep_going = True
+
+    if "--generator" in options and options["--generator"]:
+        make_generator = options["--generator"]
+
+    if "--compile-jobs" in options and options["--compile-jobs"]:
+        make_compile_jobs = options["--compile-jobs"]
+
+    if "--clean" in options and options["--clean"]:
+        make_clean = True
+
+    if "--profile" in options and options["--profile"]:
+        make_profile = options["--profile"]
+
+    if "--split-debug" in options and options["--split-debug"]:
+        make_split_debug = True
+
+    if "--unity" in options and options["--unity"]:
+        make_unity = True
+
+    if "--pch" in options and options["--pch"]:
+        make_pch = True
+
+    if "--compiler-cache" in options and options["--compiler-cache"]:
+        make_compiler_cache = options["--compiler-cache"]
+
+    if "--cache-dir" in options and options["--cache-dir"]:
+        make_cache_dir = os.path.abspath(options["--cache-dir"])
+
+    if "--cache-size" in options and options["--cache-size"]:
+        make_cache_size = options["--cache-size"]
+
+    if "--download-cache" in options and options["--download-cache"]:
+        make_download_cache = os.path.abspath(options["--download-cache"])
+
+    if "--download-cache-size" in options and options["--download-cache-size"]:
+        make_download_cache_size = options["--download-cache-size"]
+
+    if "--offline" in options and options["--offline"]:
+        make_offline = True
+
+    if "--extract-jobs" in options and options["--extract-jobs"]:
+        make_extract_jobs = options["--extract-jobs"]
+
+    if "--extract-all" in options and options["--extract-all"]:
+        make_extract_all = True
+
+    if "--benchmark-scale" in options and options["--benchmark-scale"]:
+        make_benchmark_scale = options["--benchmark-scale"]
+
+    if "--benchmark-repeat" in options and options["--benchmark-repeat"]:
+        make_benchmark_repeat = options["--benchmark-repeat"]
+
+    if "--benchmark-baseline" in options and options["--benchmark-baseline"]:
+        make_benchmark_baseline = os.path.abspath(options["--benchmark-baseline"])
+
+    if "--benchmark-update" in options and options["--benchmark-update"]:
+        make_benchmark_update = True
+
+    if "--flash-size" in options and options["--flash-size"]:
+        make_flash_size = options["--flash-size"]
+
+    if "--flash-latency" in options and options["--flash-latency"]:
+        make_flash_latency = options["--flash-latency"]
+
+    if "--flash-baud" in options and options["--flash-baud"]:
+        make_flash_baud = options["--flash-baud"]
+
+    if "--flash-devices" in options and options["--flash-devices"]:
+        make_flash_devices = options["--flash-devices"]
+
+    if "--ports" in options and options["--ports"]:
+        make_ports = [port for port in options["--ports"].split(",") if port]
+
+    if "--image" in options and options["--image"]:
+        make_image = os.path.abspath(options["--image"])
+
+    if "--library-baseline" in options and options["--library-baseline"]:
+        make_library_baseline = os.path.abspath(options["--library-baseline"])
+
+    if "--library-update" in options and options["--library-update"]:
+        make_library_update = True
 
     # validate data
     debug("Validating data...")
 
-    # validate task
-    if not make_task:
+    # validate tasks
+    if not make_tasks:
         error("Task is invalid")
 
-    # clear
-    if make_task == "clear":
-        run_task_clear()
+    for make_task in make_tasks:
+        if make_task not in TASKS:
+            error("Invalid task name: {0}".format(make_task))
+
+    # validate task jobs
+    try:
+        make_task_jobs = int(options.get("--task-jobs") or 4)
+    except ValueError:
+        error("Task jobs is invalid: {0}".format(options["--task-jobs"]))
 
-    # patch android library
-    elif make_task == "patch-android":
-        run_task_patch_android()
+    if make_task_jobs < 1:
+        error("Task jobs is invalid: {0}".format(make_task_jobs))
 
-    # build android library
-    elif make_task == "build-android":
-        run_task_build_android()
+    # validate jobs
+    try:
+        make_jobs = int(make_jobs)
+    except ValueError:
+        error("Jobs is invalid: {0}".format(make_jobs))
 
-    # test android
-    elif make_task == "test-android":
-        run_task_test_android()
+    if make_jobs < 1:
+        error("Jobs is invalid: {0}".format(make_jobs))
 
-    # install android
-    elif make_task == "install-android":
-        run_task_install_android()
+    # validate generator
+    if make_generator not in ["auto", "ninja", "make"]:
+        error("Generator is invalid: {0}".format(make_generator))
+
+    # validate compile jobs
+    if make_compile_jobs != "auto":
+        try:
+            make_compile_jobs = int(make_compile_jobs)
+        except ValueError:
+            error("Compile jobs is invalid: {0}".format(make_compile_jobs))
+
+        if make_compile_jobs < 1:
+            error("Compile jobs is invalid: {0}".format(make_compile_jobs))
+
+    # validate profile
+    if make_profile not in ["debug", "release", "minsize", "lto"]:
+        error("Profile is invalid: {0}".format(make_profile))
+
+    # validate compiler cache
+    if make_compiler_cache not in ["auto", "ccache", "sccache", "none"]:
+        error("Compiler cache is invalid: {0}".format(make_compiler_cache))
+
+    # validate download cache size
+    try:
+        make_download_cache_size = parse_size(make_download_cache_size)
+    except ValueError:
+        error("Download cache size is invalid: {0}".format(make_download_cache_size))
+
+    # validate extract jobs
+    if make_extract_jobs == "auto":
+        make_extract_jobs = os.cpu_count() or 1
+    else:
+        try:
+            make_extract_jobs = int(make_extract_jobs)
+        except ValueError:
+            error("Extract jobs is invalid: {0}".format(make_extract_jobs))
+
+        if make_extract_jobs < 1:
+            error("Extract jobs is invalid: {0}".format(make_extract_jobs))
+
+    # validate benchmark scale
+    try:
+        make_benchmark_scale = float(make_benchmark_scale)
+    except ValueError:
+        error("Benchmark scale is invalid: {0}".format(make_benchmark_scale))
+
+    if make_benchmark_scale <= 0:
+        error("Benchmark scale is invalid: {0}".format(make_benchmark_scale))
+
+    # validate benchmark repeat
+    try:
+        make_benchmark_repeat = int(make_benchmark_repeat)
+    except ValueError:
+        error("Benchmark repeat is invalid: {0}".format(make_benchmark_repeat))
+
+    if make_benchmark_repeat < 1:
+        error("Benchmark repeat is invalid: {0}".format(make_benchmark_repeat))
+
+    # validate flash size
+    try:
+        make_flash_size = parse_size(make_flash_size)
+    except ValueError:
+        error("Flash size is invalid: {0}".format(make_flash_size))
+
+    if make_flash_size < 1:
+        error("Flash size is invalid: {0}".format(make_flash_size))
+
+    # validate flash latency
+    try:
+        make_flash_latency = float(make_flash_latency) / 1000
+    except ValueError:
+        error("Flash latency is invalid: {0}".format(make_flash_latency))
+
+    if make_flash_latency < 0:
+        error("Flash latency is invalid: {0}".format(make_flash_latency))
+
+    # validate flash baud
+    try:
+        make_flash_baud = int(make_flash_baud)
+    except ValueError:
+        error("Flash baud is invalid: {0}".format(make_flash_baud))
+
+    if make_flash_baud < 0:
+        error("Flash baud is invalid: {0}".format(make_flash_baud))
+
+    # validate flash devices
+    try:
+        make_flash_devices = int(make_flash_devices)
+    except ValueError:
+        error("Flash devices is invalid: {0}".format(make_flash_devices))
+
+    if make_flash_devices < 1:
+        error("Flash devices is invalid: {0}".format(make_flash_devices))
+
+    # build options
+    build_options = {
+        "jobs": make_jobs,
+        "keep_going": make_keep_going,
+        "generator": make_generator,
+        "compile_jobs": make_compile_jobs,
+        "clean": make_clean,
+        "profile": make_profile,
+        "split_debug": make_split_debug,
+        "unity": make_unity,
+        "pch": make_pch,
+        "compiler_cache": make_compiler_cache,
+        "cache_dir": make_cache_dir,
+        "cache_size": make_cache_size,
+    }
+
+    # download options
+    download_options = {
+        "cache_dir": make_download_cache,
+        "cache_size": make_download_cache_size,
+        "offline": make_offline,
+        "pin_checksums": not os.environ.get("CI"),
+        "extract_jobs": make_extract_jobs,
+        "extract_all": make_extract_all,
+    }
+
+    # benchmark options
+    benchmark_options = {
+        "scale": make_benchmark_scale,
+        "repeat": make_benchmark_repeat,
+        "baseline": make_benchmark_baseline,
+        "update": make_benchmark_update,
+        "flash_size": make_flash_size,
+        "flash_latency": make_flash_latency,
+        "flash_baud": make_flash_baud,
+        "flash_devices": make_flash_devices,
+    }
+
+    # flash options
+    flash_options = {
+        "ports": make_ports,
+        "image": make_image,
+    }
+
+    # test options
+    test_options = {
+        "baseline": make_library_baseline,
+        "update": make_library_update,
+    }
+
+    task_options = {
+        "build": build_options,
+        "download": download_options,
+        "benchmark": benchmark_options,
+        "test": test_options,
+        "flash": flash_options,
+    }
+
+    # trace
+    make_trace = options.get("--trace")
+
+    if make_trace:
+        start_trace()
+
+    # run
+    try:
+        if options.get("--no-deps"):
+            for make_task in make_tasks:
+                run_task(make_task, task_options)
+        else:
+            run_tasks(make_tasks, task_options, make_task_jobs)
+    finally:
+        if make_trace:
+            write_trace(make_trace)
+
+        show_command_usage(COMMAND_USAGE)
+
+        if options.get("--usage"):
+            write_json_file(options["--usage"], COMMAND_USAGE)
+            debug("Usage: {0}".format(options["--usage"]))
 
-    # patch macos library
-    elif make_task == "patch-macos":
-        run_task_patch_macos()
+    message("")
+    debug("FINISHED!")
 
-    # build macos library
-    elif make_task == "build-macos":
-        run_task_build_macos()
 
-    # test macos
-    elif make_task == "test-macos":
-        run_task_test_macos()
+def run_task(name, task_options):
+    task = TASKS[name]
 
-    # install macos
-    elif make_task == "install-macos":
-        run_task_install_macos()
+    with trace_span(name, "task"):
+        if task["options"]:
+            task["func"](task_options[task["options"]])
+        else:
+            task["func"]()
 
-    # run macos
-    elif make_task == "run-macos":
-        run_task_run_macos()
 
-    # patch linux library
-    elif make_task == "patch-linux":
-        run_task_patch_linux()
+def get_task_graph(targets):
+    """
+    Return the targets and all their dependencies in dependency order.
+    """
+    order = []
+    visiting = set()
 
-    # build linux library
-    elif make_task == "build-linux":
-        run_task_build_linux()
+    def visit(name):
+        if name in order:
+            return
 
-    # test linux
-    elif make_task == "test-linux":
-        run_task_test_linux()
+        if name in visiting:
+            error("Dependency cycle found at task: {0}".format(name))
 
-    # install linux
-    elif make_task == "install-linux":
-        run_task_install_linux()
+        visiting.add(name)
 
-    # run linux
-    elif make_task == "run-linux":
-        run_task_run_linux()
+        for dep in TASKS[name]["deps"]:
+            visit(dep)
 
-    # get wxwidgets
-    elif make_task == "get-wx":
-        run_task_get_wx()
+        visiting.remove(name)
+        order.append(name)
 
-    # get bossa
-    elif make_task == "get-bossa":
-        run_task_get_bossa()
+    for target in targets:
+        visit(target)
 
-    # patch bossa
-    elif make_task == "patch-bossa":
-        run_task_patch_bossa()
+    return order
 
-    # remove bossa
-    elif make_task == "remove-bossa":
-        run_task_remove_bossa()
 
-    # get ndk
-    elif make_task == "get-ndk":
-        run_task_get_ndk()
+def run_tasks(targets, task_options, jobs=4):
+    """
+    Run the targets and their dependencies, starting each task as soon as
+    its dependencies are done, with up to jobs tasks at the same time.
+    Dependencies whose outputs are up to date are skipped; the targets
+    always run.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-    else:
-        error("Invalid task name: {0}".format(make_task))
+    order = get_task_graph(targets)
+
+    # the platform patch sets replace each other in the same BOSSA sources,
+    # so a build could compile the sources patched for another platform
+    platforms = [
+        name
+        for name in PATCH_SETS
+        if name != "bossa" and "patch-{0}".format(name) in order
+    ]
+
+    if len(platforms) > 1:
+        error(
+            "Run the tasks of one platform at a time, found: {0}".format(
+                ", ".join(platforms)
+            )
+        )
+
+    state = {}
+    durations = {}
+    started = {}
+    locks = {}
+
+    for name in order:
+        lock = TASKS[name].get("lock")
+
+        if lock and lock not in locks:
+            locks[lock] = threading.Lock()
+
+    def execute(name):
+        lock = TASKS[name].get("lock")
+
+        if lock:
+            with locks[lock]:
+                run_task(name, task_options)
+        else:
+            run_task(name, task_options)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+
+        while futures or len(state) < len(order):
+            for name in order:
+                if name in state:
+                    continue
+
+                deps = TASKS[name]["deps"]
+                deps_state = [state.get(dep) for dep in deps]
+
+                if any(
+                    [dep_state in ["failed", "blocked"] for dep_state in deps_state]
+                ):
+                    state[name] = "blocked"
+                    continue
+
+                if not all(
+                    [dep_state in ["done", "skipped"] for dep_state in deps_state]
+                ):
+                    continue
+
+                up_to_date = TASKS[name].get("up_to_date")
+
+                if (
+                    name not in targets
+                    and up_to_date
+                    and "done" not in deps_state
+                    and up_to_date(task_options)
+                ):
+                    debug("Up to date: {0}".format(name))
+                    state[name] = "skipped"
+                    durations[name] = 0.0
+                    continue
+
+                debug("Task: {0}".format(name))
+                state[name] = "running"
+                started[name] = time.monotonic()
+                futures[executor.submit(execute, name)] = name
+
+            if not futures:
+                continue
+
+            done, not_done = wait(list(futures), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = futures.pop(future)
+                durations[name] = time.monotonic() - started[name]
+
+                try:
+                    future.result()
+                    state[name] = "done"
+                except BaseException as e:
+                    # error() exits with SystemExit, keep the other tasks running
+                    if not isinstance(e, SystemExit):
+                        message("ERROR: {0}: {1}".format(name, e))
+
+                    state[name] = "failed"
+
+    show_task_summary(order, state, durations)
+
+    failed = [name for name in order if state[name] in ["failed", "blocked"]]
+
+    if failed:
+        error("Tasks failed: {0}".format(", ".join(failed)))
+
+
+def show_task_summary(order, state, durations):
+    """
+    Show the time of each task and the critical path, the chain of
+    dependent tasks that took the longest.
+    """
+    finish = {}
+    previous = {}
+
+    for name in order:
+        finish[name] = durations.get(name, 0.0)
+        previous[name] = None
+
+        for dep in TASKS[name]["deps"]:
+            if dep in finish and finish[dep] + durations.get(name, 0.0) > finish[name]:
+                finish[name] = finish[dep] + durations.get(name, 0.0)
+                previous[name] = dep
 
     message("")
-    debug("FINISHED!")
+    debug("Tasks:")
+
+    for name in order:
+        message(
+            "  {0:<20} {1:<8} {2:8.2f}s".format(
+                name, state.get(name, ""), durations.get(name, 0.0)
+            )
+        )
+
+    last = max(order, key=lambda name: finish[name])
+    path = []
+
+    while last:
+        path.insert(0, last)
+        last = previous[last]
+
+    debug("Critical path: {0} ({1:.2f}s)".format(" -> ".join(path), finish[path[-1]]))
 
 
 def debug(msg):
@@ -194,11 +840,136 @@ def error(msg):
     sys.exit(1)
 
 
-def download_file(url, dest=None, filename=None):
+# chrome trace events, None when tracing is disabled
+TRACE_EVENTS = None
+TRACE_THREADS = set()
+TRACE_LOCK = threading.Lock()
+
+
+# resources used by the commands run
+COMMAND_USAGE = []
+COMMAND_USAGE_LOCK = threading.Lock()
+
+
+def start_trace():
+    global TRACE_EVENTS
+
+    TRACE_EVENTS = []
+    TRACE_THREADS.clear()
+
+
+@contextmanager
+def trace_span(name, category, args=None):
+    """
+    Record the time spent in the block as a trace event. It does nothing
+    when tracing is disabled.
+    """
+    if TRACE_EVENTS is None:
+        yield
+        return
+
+    started = time.monotonic()
+
+    try:
+        yield
+    finally:
+        add_trace_event(name, category, started, time.monotonic() - started, args)
+
+
+def add_trace_event(name, category, started, duration, args=None):
+    if TRACE_EVENTS is None:
+        return
+
+    pid = os.getpid()
+    thread = threading.current_thread()
+
+    with TRACE_LOCK:
+        if (pid, thread.ident) not in TRACE_THREADS:
+            TRACE_THREADS.add((pid, thread.ident))
+            TRACE_EVENTS.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": thread.ident,
+                    "args": {"name": thread.name},
+                }
+            )
+
+        TRACE_EVENTS.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int(started * 1000000),
+                "dur": int(duration * 1000000),
+                "pid": pid,
+                "tid": thread.ident,
+                "args": args or {},
+            }
+        )
+
+
+def add_trace_phases(category, started, timings, args=None):
+    """
+    Record sequential phases, measured as durations, as trace events.
+    """
+    for phase in timings:
+        if phase == "total":
+            continue
+
+        add_trace_event(phase, category, started, timings[phase], args)
+        started += timings[phase]
+
+
+def add_trace_events(events):
+    """
+    Add the events recorded in another process.
+    """
+    if TRACE_EVENTS is None:
+        return
+
+    with TRACE_LOCK:
+        TRACE_EVENTS.extend(events)
+
+
+def write_trace(file):
+    with TRACE_LOCK:
+        events = list(TRACE_EVENTS)
+
+    with open(file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    debug("Trace: {0} ({1} events)".format(file, len(events)))
+
+
+# startup budget in seconds for importing make and for python -m make --help
+STARTUP_BUDGET = {"import": 0.05, "help": 0.15}
+STARTUP_RUNS = 5
+
+# mode, unity build, precompiled headers
+BUILD_BENCHMARK_MODES = [
+    ("default", False, False),
+    ("unity", True, False),
+    ("pch", False, True),
+    ("unity+pch", True, True),
+]
+
+DOWNLOAD_MIN_BLOCK_SIZE = 64 * 1024
+DOWNLOAD_MAX_BLOCK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+def download_file(url, dest=None, filename=None, checksum=None, connections=4):
     """
-    Download and save a file specified by url to dest directory,
+    Download and save a file specified by url to dest directory.
+
+    The file is written to "<filename>.part" and renamed into place only
+    after its length (and checksum, when given) is verified. When the
+    server supports range requests an interrupted download is resumed and
+    large files are split across several connections.
     """
-    u = urllib2.urlopen(url)
+    import urllib.parse as urlparse
 
     scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
 
@@ -213,172 +984,2093 @@ def download_file(url, dest=None, filename=None):
     if dest:
         dest_filename = os.path.join(dest, dest_filename)
 
-    with open(dest_filename, "wb") as f:
-        debug("Downloading...")
-        message("")
+    part_file = dest_filename + ".part"
+    state_file = dest_filename + ".part.json"
+
+    debug("Downloading...")
+    message("")
+
+    with trace_span(os.path.basename(dest_filename), "download", {"url": url}):
+        file_size, accept_ranges = get_download_info(url)
+
+        if accept_ranges and file_size:
+            download_file_ranges(url, part_file, state_file, file_size, connections)
+        else:
+            remove_file(state_file)
+            download_file_stream(url, part_file, file_size)
+
+    message("")
+
+    # verify
+    part_size = os.path.getsize(part_file)
+
+    if file_size and part_size != file_size:
+        raise IOError(
+            "Incomplete download of {0}: {1} of {2} bytes".format(
+                url, part_size, file_size
+            )
+        )
+
+    if checksum:
+        with trace_span("checksum", "download"):
+            part_checksum = get_file_hash(part_file)
+
+        if part_checksum != checksum:
+            remove_file(part_file)
+            remove_file(state_file)
 
-        meta = u.info()
-        meta_func = meta.getheaders if hasattr(meta, "getheaders") else meta.get_all
-        meta_length = meta_func("Content-Length")
-        file_size = None
-        pbar = None
+            raise IOError(
+                "Checksum mismatch for {0}: expected {1}, got {2}".format(
+                    url, checksum, part_checksum
+                )
+            )
 
-        if meta_length:
-            file_size = int(meta_length[0])
+    os.replace(part_file, dest_filename)
+    remove_file(state_file)
 
-        if file_size:
-            pbar = tqdm(total=file_size)
+    return dest_filename
 
-        file_size_dl = 0
-        block_sz = 8192
 
-        while True:
-            dbuffer = u.read(block_sz)
+def get_download_info(url):
+    """
+    Return the file size and if the server accepts range requests, asking
+    for the first byte only.
+    """
+    import urllib.request as urllib2
+
+    request = urllib2.Request(url, headers={"Range": "bytes=0-0"})
+
+    with urllib2.urlopen(request, timeout=60) as u:
+        content_range = u.headers.get("Content-Range")
+
+        if u.status == 206 and content_range and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1].strip()
+
+            if total.isdigit():
+                return int(total), True
+
+        content_length = u.headers.get("Content-Length")
+
+        if content_length and content_length.isdigit():
+            return int(content_length), False
+
+    return None, False
+
+
+def read_download_response(u, f, on_data=None):
+    """
+    Copy a response to a file, growing the block size while reads are fast
+    and shrinking it when they are slow.
+    """
+    block_sz = DOWNLOAD_MIN_BLOCK_SIZE
+
+    while True:
+        started = time.monotonic()
+        dbuffer = u.read(block_sz)
+        elapsed = time.monotonic() - started
+
+        if not dbuffer:
+            break
+
+        f.write(dbuffer)
 
-            if not dbuffer:
-                break
+        if on_data:
+            on_data(len(dbuffer))
 
-            dbuffer_len = len(dbuffer)
-            file_size_dl += dbuffer_len
-            f.write(dbuffer)
+        if len(dbuffer) == block_sz and elapsed < 0.1:
+            block_sz = min(block_sz * 2, DOWNLOAD_MAX_BLOCK_SIZE)
+        elif elapsed > 1.0:
+            block_sz = max(block_sz // 2, DOWNLOAD_MIN_BLOCK_SIZE)
 
-            if pbar:
-                pbar.update(dbuffer_len)
 
+def download_file_stream(url, part_file, file_size):
+    """
+    Download the whole file over a single connection.
+    """
+    import urllib.request as urllib2
+    from tqdm import tqdm
+
+    pbar = tqdm(total=file_size, unit="B", unit_scale=True) if file_size else None
+
+    try:
+        with urllib2.urlopen(url, timeout=60) as u, open(part_file, "wb") as f:
+            read_download_response(u, f, pbar.update if pbar else None)
+    finally:
         if pbar:
             pbar.close()
-            message("")
 
-        return dest_filename
 
+def download_file_ranges(url, part_file, state_file, file_size, connections):
+    """
+    Download the file with range requests into a preallocated part file.
+    Each segment progress is saved in the state file, so an interrupted
+    download continues where it stopped.
+    """
+    import urllib.request as urllib2
+    from concurrent.futures import ThreadPoolExecutor
+    from tqdm import tqdm
+
+    state = read_json_file(state_file)
+
+    if (
+        not state
+        or state.get("url") != url
+        or state.get("size") != file_size
+        or not os.path.isfile(part_file)
+        or os.path.getsize(part_file) != file_size
+    ):
+        segment_count = max(1, min(connections, file_size // DOWNLOAD_MIN_SEGMENT_SIZE))
+        segment_size = -(-file_size // segment_count)
+        segments = []
+
+        for start in range(0, file_size, segment_size):
+            segments.append([start, min(start + segment_size, file_size), 0])
+
+        state = {"url": url, "size": file_size, "segments": segments}
+
+        with open(part_file, "wb") as f:
+            f.truncate(file_size)
+
+        write_json_file(state_file, state)
+    else:
+        debug("Resuming download...")
+
+    segments = state["segments"]
+    lock = threading.Lock()
+    stopped = threading.Event()
+    saved = [time.monotonic()]
+    pbar = tqdm(
+        total=file_size,
+        initial=sum([segment[2] for segment in segments]),
+        unit="B",
+        unit_scale=True,
+    )
+
+    def download_segment(segment):
+        start, end, done = segment
+
+        if start + done >= end:
+            return
+
+        request = urllib2.Request(
+            url, headers={"Range": "bytes={0}-{1}".format(start + done, end - 1)}
+        )
+
+        def on_data(size):
+            if stopped.is_set():
+                raise IOError("Download stopped")
+
+            with lock:
+                segment[2] += size
+                pbar.update(size)
+
+                # save the progress from time to time to resume after a crash
+                if time.monotonic() - saved[0] > 2.0:
+                    write_json_file(state_file, state)
+                    saved[0] = time.monotonic()
+
+        with urllib2.urlopen(request, timeout=60) as u:
+            if u.status != 206:
+                raise IOError("Server ignored the range request for {0}".format(url))
+
+            # unbuffered, so the saved progress never gets ahead of the file
+            with open(part_file, "r+b", buffering=0) as f:
+                f.seek(start + done)
+                read_download_response(u, f, on_data)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [
+                executor.submit(download_segment, segment) for segment in segments
+            ]
+
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # stop the other segments instead of waiting for them
+                stopped.set()
+                raise
+    finally:
+        pbar.close()
+
+        with lock:
+            write_json_file(state_file, state)
+
+    for start, end, done in segments:
+        if start + done != end:
+            raise IOError("Incomplete segment {0}-{1} of {2}".format(start, end, url))
+
+
+def get_download_cache_dir():
+    """
+    Return the default download cache directory, shared by all checkouts.
+    """
+    if os.environ.get("BOSSA_MOBILE_CACHE"):
+        return os.path.abspath(os.environ["BOSSA_MOBILE_CACHE"])
+
+    return os.path.join(os.path.expanduser("~"), ".cache", "bossa-mobile")
+
+
+def parse_size(size):
+    """
+    Parse a size like 512M or 5G into bytes.
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = str(size).strip().upper().rstrip("B")
+
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
+
+def read_checksums(checksums_file="checksums.txt"):
+    """
+    Read the pinned SHA-256 checksums (sha256sum format) of the artifacts.
+    """
+    checksums = {}
+
+    if not os.path.isfile(checksums_file):
+        return checksums
+
+    with open(checksums_file) as f:
+        for line in f:
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            checksum, filename = line.split(None, 1)
+            checksums[filename.lstrip("*")] = checksum.lower()
+
+    return checksums
+
+
+def pin_checksum(filename, checksum, checksums_file="checksums.txt"):
+    with open(checksums_file, "a") as f:
+        f.write("{0}  {1}\n".format(checksum, filename))
+
+
+def get_pinned_checksum(filename, download_options):
+    """
+    Return the pinned checksum of the artifact. Without a pin the first
+    download is pinned, except on CI, where nothing would commit the pin;
+    offline, only pinned artifacts are used.
+    """
+    checksum = read_checksums().get(filename)
+
+    if not checksum and download_options["offline"]:
+        error(
+            "No pinned checksum for {0} in checksums.txt, pin it before using offline mode".format(
+                filename
+            )
+        )
+
+    return checksum
+
+
+def pin_file_checksum(filename, file, download_options):
+    return pin_new_checksum(filename, get_file_hash(file), download_options)
+
+
+def pin_new_checksum(filename, checksum, download_options):
+    if not download_options["pin_checksums"]:
+        debug("Not pinned on CI: {0} {1}".format(filename, checksum))
+        return checksum
+
+    pin_checksum(filename, checksum)
+    debug("Pinned checksum: {0} {1}".format(filename, checksum))
+
+    return checksum
+
+
+def get_download_cache_blob(cache_dir, checksum):
+    return os.path.join(cache_dir, "sha256", checksum)
+
+
+def get_download_cache_index(cache_dir, url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, "urls", "{0}.json".format(key))
+
+
+def get_cached_download(url, cache_dir, checksum=None):
+    """
+    Return the verified cache entry for url or None. Without a pinned
+    checksum the entry is found by the checksum recorded for the url.
+    """
+    if not checksum:
+        index = read_json_file(get_download_cache_index(cache_dir, url))
+
+        if not index:
+            return None
+
+        checksum = index["sha256"]
+
+    blob = get_download_cache_blob(cache_dir, checksum)
+
+    if not os.path.isfile(blob):
+        return None
+
+    if get_file_hash(blob) != checksum:
+        debug("Removing corrupted cache entry: {0}".format(blob))
+        remove_file(blob)
+        return None
+
+    # mark as recently used for the eviction
+    os.utime(blob, None)
+
+    return blob
+
+
+def add_to_download_cache(url, filename, file, cache_dir, checksum, move=False):
+    """
+    Store a verified file in the download cache. With move the file is
+    renamed into the cache instead of copied.
+    """
+    blob = get_download_cache_blob(cache_dir, checksum)
+    index_file = get_download_cache_index(cache_dir, url)
+
+    create_dir(os.path.dirname(blob))
+    create_dir(os.path.dirname(index_file))
+
+    if move:
+        os.replace(file, blob)
+    else:
+        copy2(file, blob + ".tmp")
+        os.replace(blob + ".tmp", blob)
+
+    os.utime(blob, None)
+
+    write_json_file(index_file, {"url": url, "filename": filename, "sha256": checksum})
+
+    return blob
+
+
+def evict_download_cache(cache_dir, max_size):
+    """
+    Remove the least recently used cache entries until the cache fits
+    into max_size bytes.
+    """
+    blobs_dir = os.path.join(cache_dir, "sha256")
+
+    if not os.path.isdir(blobs_dir):
+        return
+
+    blobs = []
+
+    for name in os.listdir(blobs_dir):
+        blob = os.path.join(blobs_dir, name)
+        blob_stat = os.stat(blob)
+        blobs.append((blob_stat.st_mtime, blob_stat.st_size, blob))
+
+    blobs.sort()
+    total_size = sum([blob[1] for blob in blobs])
+
+    # keep at least the most recently used entry
+    for mtime, size, blob in blobs[:-1]:
+        if total_size <= max_size:
+            break
+
+        debug("Evicting cache entry: {0}".format(blob))
+        remove_file(blob)
+        total_size -= size
+
+
+def link_or_copy(from_file, to_file):
+    remove_file(to_file)
+
+    try:
+        os.link(from_file, to_file)
+    except OSError:
+        copy2(from_file, to_file)
+
+
+def get_local_artifact(url, target_dir, filename, name, download_options):
+    """
+    Return the artifact from target_dir or the download cache, verifying
+    its pinned checksum, or None when it must be downloaded.
+    """
+    dest_file = os.path.join(target_dir, filename)
+    cache_dir = download_options["cache_dir"]
+    checksum = get_pinned_checksum(filename, download_options)
+
+    # local file
+    if os.path.isfile(dest_file):
+        if not checksum:
+            pin_file_checksum(filename, dest_file, download_options)
+            debug("Downloaded: {0}".format(name))
+            return dest_file
+
+        if get_file_hash(dest_file) == checksum:
+            debug("Downloaded: {0}".format(name))
+            return dest_file
+
+        debug("Checksum mismatch, removing: {0}".format(dest_file))
+        remove_file(dest_file)
+
+    # download cache
+    blob = get_cached_download(url, cache_dir, checksum)
+
+    if blob:
+        link_or_copy(blob, dest_file)
+        debug("Downloaded: {0} (from cache)".format(name))
+        return dest_file
+
+    if download_options["offline"]:
+        error(
+            "{0} is not in the download cache and offline mode is enabled".format(
+                filename
+            )
+        )
+
+    return None
+
+
+def download_artifact(url, target_dir, filename, name, download_options):
+    """
+    Get an artifact into target_dir from the local file, the shared
+    download cache or the network, verifying its pinned checksum.
+    """
+    dest_file = get_local_artifact(url, target_dir, filename, name, download_options)
+
+    if dest_file:
+        return dest_file
+
+    dest_file = os.path.join(target_dir, filename)
+    cache_dir = download_options["cache_dir"]
+    checksum = get_pinned_checksum(filename, download_options)
+
+    # network
+    debug("Download: {0}".format(name))
+
+    try:
+        download_file(url, target_dir, filename, checksum=checksum)
+    except IOError as e:
+        error(str(e))
+
+    if checksum:
+        file_checksum = checksum
+    else:
+        file_checksum = pin_file_checksum(filename, dest_file, download_options)
+
+    add_to_download_cache(url, filename, dest_file, cache_dir, file_checksum)
+    evict_download_cache(cache_dir, download_options["cache_size"])
+
+    debug("Downloaded: {0}".format(name))
+
+    return dest_file
+
+
+class TeeReader:
+    """File-like reader that copies what is read to another file."""
+
+    def __init__(self, source, dest, on_data=None):
+        self.source = source
+        self.dest = dest
+        self.on_data = on_data
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+
+        if data:
+            self.dest.write(data)
+            self.sha256.update(data)
+
+            if self.on_data:
+                self.on_data(len(data))
+
+        return data
+
+    def drain(self):
+        # the tar end blocks may not be read by the extraction
+        while self.read(DOWNLOAD_MAX_BLOCK_SIZE):
+            pass
+
+
+def get_extract_filter(folder, download_options):
+    """
+    Return a function that tells if an archive member must be extracted,
+    following the manifest entry of the folder, or None to extract all.
+    """
+    manifest = EXTRACT_MANIFEST.get(folder)
+
+    if not manifest or download_options["extract_all"]:
+        return None
+
+    if not manifest["include"] and not manifest["exclude"]:
+        return None
+
+    include = manifest["include"]
+    exclude = manifest["exclude"]
+
+    def extract_filter(name):
+        name = name.rstrip("/")
+
+        if include and not any(
+            [fnmatch.fnmatchcase(name, pattern) for pattern in include]
+        ):
+            return False
+
+        return not any([fnmatch.fnmatchcase(name, pattern) for pattern in exclude])
+
+    return extract_filter
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024 or unit == "GB":
+            break
+
+        size /= 1024.0
+
+    return "{0:.1f} {1}".format(size, unit)
+
+
+def show_extract_skipped(skipped):
+    if skipped["files"]:
+        debug(
+            "Skipped: {0} files | {1}".format(
+                skipped["files"], format_size(skipped["bytes"])
+            )
+        )
+
+
+def extract_tar_member(tar, member, path):
+    """
+    Extract a tar member into path, rejecting members that would be
+    written, or link, outside of it.
+    """
+    import tarfile
+
+    # Python 3.12, and the security releases of 3.8 and later
+    if hasattr(tarfile, "data_filter"):
+        tar.extract(member, path, filter="data")
+        return
+
+    root = os.path.realpath(path)
+
+    def check(name, file):
+        file = os.path.realpath(file)
+
+        if file != root and not file.startswith(root + os.path.sep):
+            raise tarfile.TarError("Member outside the target dir: {0}".format(name))
+
+    if member.isdev():
+        raise tarfile.TarError("Device member: {0}".format(member.name))
+
+    member_file = os.path.join(path, member.name)
+    check(member.name, member_file)
+
+    if member.issym():
+        check(
+            member.name,
+            os.path.join(os.path.dirname(member_file), member.linkname),
+        )
+    elif member.islnk():
+        check(member.name, os.path.join(path, member.linkname))
+
+    tar.extract(member, path)
+
+
+def extract_tar_stream(fileobj, target_dir, extract_filter=None):
+    """
+    Extract a (compressed) tar stream into a temporary dir inside
+    target_dir and return it with the skipped files. The members are
+    extracted as they are read, so the stream can be a download in progress.
+    """
+    import tarfile
+    import tempfile
+
+    temp_dir = tempfile.mkdtemp(prefix=".extract-", dir=target_dir)
+    skipped = {"files": 0, "bytes": 0}
+
+    try:
+        with trace_span("extract tar", "extract"), tarfile.open(
+            fileobj=fileobj, mode="r|*"
+        ) as tar:
+            for member in tar:
+                if not extract_filter or extract_filter(member.name):
+                    extract_tar_member(tar, member, temp_dir)
+                elif not member.isdir():
+                    skipped["files"] += 1
+                    skipped["bytes"] += member.size
+    except BaseException:
+        remove_dir(temp_dir)
+        raise
+
+    return temp_dir, skipped
+
+
+def extract_zip(archive, target_dir, extract_filter=None, workers=1):
+    """
+    Extract a zip into a temporary dir inside target_dir with parallel
+    workers and return it with the skipped files and the phase timings.
+    """
+    import tempfile
+    from simple_zip import ZipFileWithPermissions
+
+    temp_dir = tempfile.mkdtemp(prefix=".extract-", dir=target_dir)
+    skipped = {"files": 0, "bytes": 0}
+
+    try:
+        with ZipFileWithPermissions(archive) as zip:
+            members = zip.infolist()
+
+            if extract_filter:
+                members = []
+
+                for member in zip.infolist():
+                    if extract_filter(member.filename):
+                        members.append(member)
+                    elif not member.is_dir():
+                        skipped["files"] += 1
+                        skipped["bytes"] += member.file_size
+
+            started = time.monotonic()
+            timings = zip.extractall_parallel(
+                temp_dir, members=members, workers=workers
+            )
+            add_trace_phases("extract", started, timings)
+    except BaseException:
+        remove_dir(temp_dir)
+        raise
+
+    return temp_dir, skipped, timings
+
+
+def commit_extract_dir(temp_dir, target_dir):
+    """
+    Move the extracted entries from the temporary dir into target_dir.
+    """
+    with trace_span("commit", "extract"):
+        for name in os.listdir(temp_dir):
+            dest = os.path.join(target_dir, name)
+
+            if os.path.isdir(dest):
+                remove_dir(dest)
+            else:
+                remove_file(dest)
+
+            os.replace(os.path.join(temp_dir, name), dest)
+
+        os.rmdir(temp_dir)
+
+
+def download_and_extract_tar(
+    url, target_dir, filename, download_options, extract_filter=None
+):
+    """
+    Extract a tarball while it is downloaded, writing the raw archive into
+    the download cache at the same time. The extracted tree is moved into
+    target_dir only after the archive checksum is verified.
+    """
+    import tarfile
+    import tempfile
+    import urllib.request as urllib2
+    from tqdm import tqdm
+
+    cache_dir = download_options["cache_dir"]
+    checksum = get_pinned_checksum(filename, download_options)
+
+    part_dir = os.path.join(cache_dir, "tmp")
+    create_dir(part_dir)
+
+    fd, part_file = tempfile.mkstemp(suffix=".part", dir=part_dir)
+    temp_dir = None
+
+    try:
+        with trace_span(filename, "download", {"url": url}), urllib2.urlopen(
+            url, timeout=60
+        ) as u, os.fdopen(fd, "wb") as f:
+            content_length = u.headers.get("Content-Length")
+            file_size = int(content_length) if content_length else None
+
+            message("")
+
+            with tqdm(total=file_size, unit="B", unit_scale=True) as pbar:
+                reader = TeeReader(u, f, pbar.update)
+                temp_dir, skipped = extract_tar_stream(
+                    reader, target_dir, extract_filter
+                )
+                reader.drain()
+
+            message("")
+
+        if file_size and os.path.getsize(part_file) != file_size:
+            raise IOError("Incomplete download of {0}".format(url))
+
+        file_checksum = reader.sha256.hexdigest()
+
+        if checksum and file_checksum != checksum:
+            raise IOError(
+                "Checksum mismatch for {0}: expected {1}, got {2}".format(
+                    url, checksum, file_checksum
+                )
+            )
+    except (IOError, tarfile.TarError) as e:
+        remove_file(part_file)
+
+        if temp_dir:
+            remove_dir(temp_dir)
+
+        error(str(e))
+
+    commit_extract_dir(temp_dir, target_dir)
+
+    if not checksum:
+        pin_new_checksum(filename, file_checksum, download_options)
+
+    blob = add_to_download_cache(
+        url, filename, part_file, cache_dir, file_checksum, move=True
+    )
+    link_or_copy(blob, os.path.join(target_dir, filename))
+    evict_download_cache(cache_dir, download_options["cache_size"])
+
+    return skipped
+
+
+def show_extract_timings(timings):
+    debug(
+        "Extract timings: "
+        + " | ".join(
+            ["{0}: {1:.2f}s".format(phase, timings[phase]) for phase in timings]
+        )
+    )
+
+
+def get_tar_artifact(url, target_dir, filename, folder, name, download_options):
+    """
+    Get and extract a tarball. When the archive is not available locally
+    it is extracted while it is downloaded.
+    """
+    if check_extracted_tree(url, target_dir, filename, folder, name, download_options):
+        return
+
+    archive = get_local_artifact(url, target_dir, filename, name, download_options)
+    extract_filter = get_extract_filter(folder, download_options)
+
+    if archive:
+        debug("Extract: {0}".format(name))
+
+        with open(archive, "rb") as f:
+            temp_dir, skipped = extract_tar_stream(f, target_dir, extract_filter)
+
+        commit_extract_dir(temp_dir, target_dir)
+    else:
+        debug("Download and extract: {0}".format(name))
+        skipped = download_and_extract_tar(
+            url, target_dir, filename, download_options, extract_filter
+        )
+        debug("Downloaded: {0}".format(name))
+
+    write_extract_stamp(target_dir, folder, filename, download_options)
+    show_extract_skipped(skipped)
+    debug("Extracted: {0}".format(name))
+
+
+def get_zip_artifact(url, target_dir, filename, folder, name, download_options):
+    """
+    Get and extract a zip with parallel workers.
+    """
+    if check_extracted_tree(url, target_dir, filename, folder, name, download_options):
+        return
+
+    archive = download_artifact(url, target_dir, filename, name, download_options)
+
+    debug("Extract: {0}".format(name))
+
+    temp_dir, skipped, timings = extract_zip(
+        archive,
+        target_dir,
+        get_extract_filter(folder, download_options),
+        download_options["extract_jobs"],
+    )
+
+    commit_extract_dir(temp_dir, target_dir)
+    write_extract_stamp(target_dir, folder, filename, download_options)
+    show_extract_timings(timings)
+    show_extract_skipped(skipped)
+    debug("Extracted: {0}".format(name))
+
+
+def get_extract_stamp_file(target_dir, folder):
+    return os.path.join(target_dir, folder, ".make-stamp.json")
+
+
+def get_extract_manifest_key(folder, download_options):
+    manifest = EXTRACT_MANIFEST.get(folder, {})
+
+    if download_options["extract_all"]:
+        manifest = dict(manifest, include=[], exclude=[])
+
+    return hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def is_make_file(name):
+    """
+    Return True for the files and dirs make.py keeps next to the extracted
+    files, the stamp, the pristine copies and the patch stamp.
+    """
+    return name.startswith(".make-")
+
+
+def write_extract_stamp(target_dir, folder, filename, download_options):
+    """
+    Record the extracted tree (file sizes, mtimes and symlinks) with the
+    archive checksum and the manifest used to extract it.
+    """
+    stamp_file = get_extract_stamp_file(target_dir, folder)
+    files = {}
+    links = {}
+
+    with trace_span("stamp", "extract", {"folder": folder}):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(target_dir, folder)):
+            # the stamp and the patch bookkeeping are not in the archive
+            dirnames[:] = [name for name in dirnames if not is_make_file(name)]
+            filenames = [name for name in filenames if not is_make_file(name)]
+
+            for name in dirnames + filenames:
+                file = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(file, target_dir).replace(os.path.sep, "/")
+
+                if os.path.islink(file):
+                    links[rel_path] = os.readlink(file)
+                elif name in filenames:
+                    file_stat = os.stat(file)
+                    files[rel_path] = [file_stat.st_size, file_stat.st_mtime_ns]
+
+    stamp = {
+        "archive": filename,
+        "sha256": read_checksums().get(filename),
+        "manifest": get_extract_manifest_key(folder, download_options),
+        "files": files,
+        "links": links,
+    }
+
+    write_json_file(stamp_file, stamp)
+
+    return stamp
+
+
+def verify_extract_stamp(stamp, target_dir, folder):
+    """
+    Return the files and symlinks of the stamp that are missing or changed,
+    comparing only stat data. Patched files are only checked to exist.
+    """
+    patched = EXTRACT_MANIFEST.get(folder, {}).get("patched", [])
+    damaged = []
+
+    for rel_path, (size, mtime_ns) in stamp["files"].items():
+        # stamps written before the bookkeeping was skipped
+        if any([is_make_file(name) for name in rel_path.split("/")]):
+            continue
+
+        try:
+            file_stat = os.lstat(os.path.join(target_dir, rel_path))
+        except OSError:
+            damaged.append(rel_path)
+            continue
+
+        if rel_path in patched:
+            continue
+
+        if file_stat.st_size != size or file_stat.st_mtime_ns != mtime_ns:
+            damaged.append(rel_path)
+
+    for rel_path, link in stamp["links"].items():
+        try:
+            if os.readlink(os.path.join(target_dir, rel_path)) != link:
+                damaged.append(rel_path)
+        except OSError:
+            damaged.append(rel_path)
+
+    return damaged
+
+
+def repair_extracted_tree(archive, target_dir, damaged, download_options):
+    """
+    Extract again only the damaged members from the archive.
+    """
+    import tarfile
+    from simple_zip import ZipFileWithPermissions
+
+    names = set(damaged)
+
+    for rel_path in damaged:
+        file = os.path.join(target_dir, rel_path)
+
+        if os.path.lexists(file):
+            os.remove(file)
+
+    if archive.endswith(".zip"):
+        with ZipFileWithPermissions(archive) as zip:
+            members = [
+                member
+                for member in zip.infolist()
+                if member.filename.rstrip("/") in names
+            ]
+            zip.extractall_parallel(
+                target_dir, members=members, workers=download_options["extract_jobs"]
+            )
+    else:
+        with tarfile.open(archive, "r|*") as tar:
+            for member in tar:
+                if member.name.rstrip("/") in names:
+                    extract_tar_member(tar, member, target_dir)
+
+
+def check_extracted_tree(url, target_dir, filename, folder, name, download_options):
+    """
+    Verify an extracted tree against its stamp and repair the missing or
+    changed files from the archive. Returns False when the tree must be
+    extracted again in full.
+    """
+    folder_dir = os.path.join(target_dir, folder)
+
+    if not os.path.isdir(folder_dir):
+        return False
+
+    stamp = read_json_file(get_extract_stamp_file(target_dir, folder))
+    checksum = read_checksums().get(filename)
+
+    if (
+        not stamp
+        or (checksum and stamp["sha256"] != checksum)
+        or stamp["manifest"] != get_extract_manifest_key(folder, download_options)
+    ):
+        debug("Extracted tree is incomplete or outdated: {0}".format(name))
+        remove_dir(folder_dir)
+        return False
+
+    started = time.monotonic()
+
+    with trace_span("verify", "extract", {"folder": folder}):
+        damaged = verify_extract_stamp(stamp, target_dir, folder)
+
+    debug(
+        "Verified: {0} files in {1:.1f} ms".format(
+            len(stamp["files"]) + len(stamp["links"]),
+            (time.monotonic() - started) * 1000,
+        )
+    )
+
+    if damaged:
+        debug("Repair: {0} ({1} files)".format(name, len(damaged)))
+
+        archive = download_artifact(url, target_dir, filename, name, download_options)
+
+        with trace_span("repair", "extract", {"files": len(damaged)}):
+            repair_extracted_tree(archive, target_dir, damaged, download_options)
+
+        write_extract_stamp(target_dir, folder, filename, download_options)
+
+        debug("Repaired: {0}".format(name))
+
+    debug("Extracted: {0}".format(name))
+
+    return True
+
+
+def get_download_filename(url):
+    import urllib.parse as urlparse
+
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    filename = os.path.basename(path)
+
+    if not filename:
+        filename = "downloaded.file"
+
+    return filename
+
+
+def list_subdirs(from_path):
+    dirs = filter(
+        lambda x: os.path.isdir(os.path.join(from_path, x)), os.listdir(from_path)
+    )
+    return dirs
+
+
+def remove_all_files(base_path, files_to_remove):
+    for file_to_remove in files_to_remove:
+        try:
+            file_to_remove = os.path.join(base_path, file_to_remove)
+
+            if os.path.isdir(file_to_remove):
+                shutil.rmtree(file_to_remove)
+            else:
+                os.remove(file_to_remove)
+        except IOError as e:
+            # we will ignore this message, is not important now
+            # debug('Error removing file: {0} - {1}'.format(file_to_remove, e.strerror))
+            pass
+        except OSError as e:
+            # we will ignore this message, is not important now
+            # debug('Error removing file: {0} - {1}'.format(file_to_remove, e.strerror))
+            pass
+
+
+def get_cur_dir():
+    import pathlib
+
+    return pathlib.Path().absolute()
+
+
+def create_dir(dir_path):
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+
+
+def remove_dir(dir_path):
+    if os.path.isdir(dir_path):
+        shutil.rmtree(dir_path)
+
+
+def remove_file(filename):
+    if os.path.isfile(filename):
+        os.remove(filename)
+
+
+def make_tarfile(output_filename, source_dir):
+    import tarfile
+
+    with tarfile.open(output_filename, "w:gz") as tar:
+        tar.add(source_dir, arcname=os.path.basename(source_dir))
+
+
+def write_to_file(dirname, filename, content):
+    full_file_path = os.path.join(dirname, filename)
+    remove_file(full_file_path)
+    create_dir(dirname)
+
+    with open(full_file_path, "w") as f:
+        f.write(content)
+        f.close()
+
+
+def find_files(directory, pattern):
+    files = [
+        f
+        for (dir, subdirs, fs) in os.walk(directory)
+        for f in fs
+        if f.endswith(pattern)
+    ]
+
+    return files
+
+
+def is_test_user():
+    user = pwd.getpwuid(os.getuid())[0]
+    return user == "paulo"
+
+
+def file_has_content(file, content):
+    with open(file) as f:
+        if content in f.read():
+            return True
+
+    return False
+
+
+def get_file_content(file):
+    file = open(file, mode="r")
+    content = file.read()
+    file.close()
+    return content
+
+
+def prepend_to_file(file, content):
+    file_content = content + "\n" + get_file_content(file)
+    file_dest = open(file, "w")
+    file_dest.write(file_content)
+    file_dest.close()
+
+
+def append_to_file(file, content):
+    file_content = get_file_content(file) + "\n" + content
+    file_dest = open(file, "w")
+    file_dest.write(file_content)
+    file_dest.close()
+
+
+def replace_in_file(filename, old_string, new_string):
+    with open(filename) as f:
+        s = f.read()
+        if old_string not in s:
+            # print('"{old_string}" not found in {filename}.'.format(**locals()))
+            return
+
+    # Safely write the changed content, if found in the file
+    with open(filename, "w") as f:
+        # print('Changing "{old_string}" to "{new_string}" in {filename}'.format(**locals()))
+        s = s.replace(old_string, new_string)
+        f.write(s)
+
+
+def apply_patch_rule(content, rule):
+    """
+    Apply one patch rule to the content, returning the new content, or None
+    when one of its replacements is not found.
+    """
+    for old_string, new_string in rule.get("replace", []):
+        if old_string not in content:
+            return None
+
+        content = content.replace(old_string, new_string)
+
+    for pattern, new_string in rule.get("regex", []):
+        content, count = re.subn(
+            pattern, lambda match: new_string, content, flags=re.DOTALL
+        )
+
+        if not count:
+            return None
+
+    if "prepend" in rule:
+        content = rule["prepend"] + "\n" + content
+
+    if "prepend_file" in rule:
+        content = (
+            get_file_content(os.path.join("patches", rule["prepend_file"]))
+            + "\n"
+            + content
+        )
+
+    if "append" in rule:
+        content = content + "\n" + rule["append"]
+
+    if "append_file" in rule:
+        content = (
+            content
+            + "\n"
+            + get_file_content(os.path.join("patches", rule["append_file"]))
+        )
+
+    return content
+
+
+def apply_patch_set(source_dir, rules, pristine_dir=None):
+    """
+    Apply the patch rules to the files in source_dir. Each file is read
+    once, all its rules are applied in memory and it is written back once,
+    atomically, only when it changes. When pristine_dir has a copy of a
+    file, the rules are applied to the copy, so they never stack onto
+    patched text. Returns the names of the rules applied, already applied
+    and failed.
+    """
+    result = {"applied": [], "already": [], "failed": []}
+
+    for file in get_patch_files(rules):
+        with trace_span(file, "patch"):
+            source_file = os.path.join(source_dir, file)
+            original = get_file_content(source_file)
+            content = original
+
+            if pristine_dir and os.path.isfile(os.path.join(pristine_dir, file)):
+                content = get_file_content(os.path.join(pristine_dir, file))
+
+            for rule in [rule for rule in rules if rule["file"] == file]:
+                if rule["guard"] in content:
+                    result["already"].append(rule["name"])
+                    continue
+
+                patched = apply_patch_rule(content, rule)
+
+                if patched is None:
+                    result["failed"].append(rule["name"])
+                    continue
+
+                content = patched
+                result["applied"].append(rule["name"])
+
+            if content != original:
+                write_file_atomic(source_file, content)
+
+    return result
+
+
+def get_patch_files(rules):
+    files = []
+
+    for rule in rules:
+        if rule["file"] not in files:
+            files.append(rule["file"])
+
+    return files
+
+
+def write_file_atomic(file, content):
+    import tempfile
+
+    fd, temp_file = tempfile.mkstemp(prefix=".patch-", dir=os.path.dirname(file) or ".")
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+
+        shutil.copymode(file, temp_file)
+        os.replace(temp_file, file)
+    except BaseException:
+        remove_file(temp_file)
+        raise
+
+
+def get_patch_dirs():
+    bossa_dir = os.path.join("build", "BOSSA-master")
+
+    return (
+        os.path.join(bossa_dir, "src"),
+        os.path.join(bossa_dir, ".make-pristine"),
+        os.path.join(bossa_dir, ".make-patch.json"),
+    )
+
+
+def get_patch_rules(sets):
+    return [rule for name in sets for rule in PATCH_SETS[name]]
+
+
+def get_file_stat(file):
+    try:
+        file_stat = os.stat(file)
+    except OSError:
+        return None
+
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def get_patch_fingerprint(sets, pristine_dir):
+    """
+    Return the hash of the patch rules of the sets, the patch files they
+    prepend or append and the pristine copies they are applied to.
+    """
+    rules = get_patch_rules(sets)
+    payloads = {}
+    pristine = {}
+
+    for rule in rules:
+        for key in ["prepend_file", "append_file"]:
+            if key in rule:
+                payloads[rule[key]] = get_file_hash(os.path.join("patches", rule[key]))
+
+    for file in get_patch_files(rules):
+        pristine[file] = get_file_stat(os.path.join(pristine_dir, file))
+
+    data = {"rules": rules, "payloads": payloads, "pristine": pristine}
+
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_patch_set_applied(name):
+    """
+    Return True when the patch set was applied with the current rules,
+    patch files and pristine sources, and the patched files were not
+    changed since, comparing only stat data.
+    """
+    source_dir, pristine_dir, stamp_file = get_patch_dirs()
+    stamp = read_json_file(stamp_file)
+
+    if not stamp or name not in stamp["sets"]:
+        return False
+
+    if get_patch_fingerprint(stamp["sets"], pristine_dir) != stamp["fingerprint"]:
+        return False
+
+    for file, file_stat in stamp["outputs"].items():
+        if get_file_stat(os.path.join(source_dir, file)) != file_stat:
+            return False
+
+    return True
+
+
+def update_pristine_copies(source_dir, pristine_dir, rules, outputs):
+    """
+    Keep a pristine copy of each file the rules patch. A file that changed
+    since it was patched and has none of the guards was extracted again,
+    so it becomes the new pristine copy.
+    """
+    for file in get_patch_files(rules):
+        source_file = os.path.join(source_dir, file)
+        pristine_file = os.path.join(pristine_dir, file)
+
+        if get_file_stat(source_file) == outputs.get(file):
+            continue
+
+        content = get_file_content(source_file)
+        guards = [
+            rule["guard"]
+            for name in PATCH_SETS
+            for rule in PATCH_SETS[name]
+            if rule["file"] == file
+        ]
+
+        if any([guard in content for guard in guards]):
+            if not os.path.isfile(pristine_file):
+                debug("No pristine copy of {0}, patching it in place".format(file))
+
+            continue
+
+        create_dir(os.path.dirname(pristine_file))
+        copy2(source_file, pristine_file)
+
+
+def run_patch_set(name):
+    """
+    Apply the bossa set and one platform set to the BOSSA sources. A
+    platform set replaces the platform set applied before, patch-bossa keeps
+    it. Nothing is read when the fingerprint matches; otherwise the sets are
+    applied again from the pristine copies.
+    """
+    source_dir, pristine_dir, stamp_file = get_patch_dirs()
+
+    if is_patch_set_applied(name):
+        debug("Up to date: patch set {0}".format(name))
+        return
+
+    stamp = read_json_file(stamp_file) or {"sets": [], "outputs": {}}
+    platforms = [platform for platform in stamp["sets"] if platform != "bossa"]
+    sets = ["bossa"] + (platforms if name == "bossa" else [name])
+    rules = get_patch_rules(sets)
+
+    update_pristine_copies(source_dir, pristine_dir, rules, stamp["outputs"])
+
+    # the guards of the platform sets are the same, so the previous platform
+    # can only be replaced from a pristine copy
+    if platforms and platforms != sets[1:]:
+        for file in get_patch_files(get_patch_rules(platforms + sets[1:])):
+            if not os.path.isfile(os.path.join(pristine_dir, file)):
+                error(
+                    "No pristine copy of {0} to patch for {1}, remove {2} and run get-bossa".format(
+                        file, name, os.path.dirname(source_dir)
+                    )
+                )
+
+    result = apply_patch_set(source_dir, rules, pristine_dir)
+
+    for rule_name in result["applied"]:
+        debug("Applied: {0}".format(rule_name))
+
+    for rule_name in result["already"]:
+        debug("Already applied: {0}".format(rule_name))
+
+    for rule_name in result["failed"]:
+        debug("Failed: {0}".format(rule_name))
+
+    if result["failed"]:
+        remove_file(stamp_file)
+        error("Patch failed: {0}".format(", ".join(result["failed"])))
+
+    outputs = {}
+
+    for file in get_patch_files(rules):
+        outputs[file] = get_file_stat(os.path.join(source_dir, file))
+
+    write_json_file(
+        stamp_file,
+        {
+            "sets": sets,
+            "fingerprint": get_patch_fingerprint(sets, pristine_dir),
+            "outputs": outputs,
+        },
+    )
+
+
+def get_file_hash(file):
+    sha256 = hashlib.sha256()
+
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def read_json_file(file):
+    if not os.path.isfile(file):
+        return None
+
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_json_file(file, data):
+    with open(file, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def run_command(command, cwd=None, capture=False):
+    """
+    Run a shell command, optionally capturing stdout and stderr together
+    so the output of parallel builds can be printed without interleaving.
+    The resources used by the command are recorded in COMMAND_USAGE.
+    """
+    from subprocess import Popen, PIPE, STDOUT, CalledProcessError
+
+    args = {"cwd": cwd}
+
+    with trace_span(command, "subprocess", args):
+        started = time.monotonic()
+
+        if capture:
+            proc = Popen(command, cwd=cwd, shell=True, stdout=PIPE, stderr=STDOUT)
+            output = proc.stdout.read().decode("utf-8", errors="replace")
+            proc.stdout.close()
+        else:
+            proc = Popen(command, cwd=cwd, shell=True)
+            output = ""
+
+        usage = wait_command(proc)
+        usage["wall"] = time.monotonic() - started
+
+        args.update(usage)
+        add_command_usage(command, cwd, usage)
+
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, command, output=output or None)
+
+    return output
+
+
+def wait_command(proc):
+    """
+    Wait for the process with wait4, returning its resource usage and the
+    usage of the children it waited for (the commands run by the shell).
+    """
+    usage = {"returncode": None}
+
+    if not hasattr(os, "wait4"):
+        usage["returncode"] = proc.wait()
+        return usage
+
+    pid, status, rusage = os.wait4(proc.pid, 0)
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    # ru_maxrss is in kilobytes on linux and in bytes on macos, and on linux
+    # it includes the memory of the python process forked to run the command
+    maxrss = rusage.ru_maxrss
+
+    if sys.platform != "darwin":
+        maxrss *= 1024
+
+    usage.update(
+        {
+            "returncode": proc.returncode,
+            "user": rusage.ru_utime,
+            "sys": rusage.ru_stime,
+            "maxrss": maxrss,
+            "inblock": rusage.ru_inblock,
+            "oublock": rusage.ru_oublock,
+        }
+    )
+
+    return usage
+
+
+def add_command_usage(command, cwd, usage):
+    with COMMAND_USAGE_LOCK:
+        COMMAND_USAGE.append(dict(usage, command=command, cwd=cwd or "."))
+
+
+def show_command_usage(usage_list):
+    """
+    Show the resources used by each command: wall and cpu time, peak
+    memory and blocks read and written.
+    """
+    if not usage_list:
+        return
+
+    message("")
+    debug("Commands:")
+    message(
+        "  {0:>8} {1:>8} {2:>8} {3:>9} {4:>9} {5:>9}  {6}".format(
+            "wall", "user", "sys", "max rss", "in blk", "out blk", "command"
+        )
+    )
+
+    for usage in usage_list:
+        command = "{0} ({1})".format(usage["command"], usage["cwd"])
+
+        if len(command) > 70:
+            command = command[:67] + "..."
+
+        message(
+            "  {0:>7.2f}s {1:>7.2f}s {2:>7.2f}s {3:>9} {4:>9} {5:>9}  {6}".format(
+                usage["wall"],
+                usage.get("user", 0.0),
+                usage.get("sys", 0.0),
+                format_size(usage.get("maxrss", 0)),
+                usage.get("inblock", 0),
+                usage.get("oublock", 0),
+                command,
+            )
+        )
+
+    peak = max(usage_list, key=lambda usage: usage.get("maxrss", 0))
+
+    debug(
+        "Commands: {0} | cpu: {1:.2f}s | peak rss: {2} ({3})".format(
+            len(usage_list),
+            sum(
+                [usage.get("user", 0.0) + usage.get("sys", 0.0) for usage in usage_list]
+            ),
+            format_size(peak.get("maxrss", 0)),
+            peak["command"],
+        )
+    )
+
+
+def get_build_config(command, generator):
+    """
+    Return what makes a configured CMake tree reusable: the configure
+    command, the toolchain from the environment and the CMakeLists.txt.
+    """
+    return {
+        "command": command,
+        "generator": generator,
+        "cc": os.environ.get("CC", ""),
+        "cxx": os.environ.get("CXX", ""),
+        "cmakelists": get_file_hash("CMakeLists.txt"),
+    }
+
+
+def get_cmake_generator(generator="auto"):
+    """
+    Return the CMake generator name, using Ninja when it is available.
+    """
+    if generator == "auto":
+        generator = "ninja" if shutil.which("ninja") else "make"
+
+    if generator == "ninja":
+        if not shutil.which("ninja"):
+            error("Generator ninja was not found in PATH")
+
+        return "Ninja"
+
+    return "Unix Makefiles"
+
+
+def get_compile_jobs(compile_jobs="auto", jobs=1, arch_count=1):
+    """
+    Return the compile jobs for each arch. When automatic, the cores are
+    split between the archs that are built at the same time.
+    """
+    if compile_jobs != "auto":
+        return compile_jobs
+
+    cpu_count = os.cpu_count() or 1
+    parallel_archs = max(1, min(jobs, arch_count))
+
+    return max(1, cpu_count // parallel_archs)
+
+
+def get_compiler_cache(compiler_cache="auto"):
+    """
+    Return the compiler cache tool to use as compiler launcher or None.
+    """
+    if compiler_cache == "none":
+        return None
+
+    if compiler_cache == "auto":
+        for tool in ["ccache", "sccache"]:
+            if shutil.which(tool):
+                return tool
+
+        return None
+
+    if not shutil.which(compiler_cache):
+        error("Compiler cache {0} was not found in PATH".format(compiler_cache))
+
+    return compiler_cache
+
+
+def setup_compiler_cache(tool, cache_dir=None, cache_size=None):
+    """
+    Configure the compiler cache through its environment variables, that
+    are inherited by cmake, the build tool and the compilers.
+    """
+    from subprocess import call, PIPE, STDOUT
+
+    if tool == "ccache":
+        if cache_dir:
+            os.environ["CCACHE_DIR"] = cache_dir
+
+        if cache_size:
+            os.environ["CCACHE_MAXSIZE"] = cache_size
+
+        # share cache entries between checkouts in different paths
+        os.environ.setdefault("CCACHE_BASEDIR", str(get_cur_dir()))
+    elif tool == "sccache":
+        if cache_dir:
+            os.environ["SCCACHE_DIR"] = cache_dir
+
+        if cache_size:
+            os.environ["SCCACHE_CACHE_SIZE"] = cache_size
+
+        # the server reads the settings only when it starts
+        if cache_dir or cache_size:
+            call("sccache --stop-server", shell=True, stdout=PIPE, stderr=STDOUT)
+
+
+def get_compiler_cache_stats(tool):
+    """
+    Return the compiler cache hit and miss counters, or None when the tool
+    doesn't report them.
+    """
+    from subprocess import run, PIPE
+
+    hits = 0
+    misses = 0
+
+    if tool == "ccache":
+        proc = run("ccache --print-stats", shell=True, stdout=PIPE, stderr=PIPE)
+        counters = 0
+
+        for line in proc.stdout.decode("utf-8", errors="replace").splitlines():
+            fields = line.split("\t")
+
+            if len(fields) != 2 or not fields[1].strip().isdigit():
+                continue
+
+            counters += 1
+
+            if fields[0] in ["direct_cache_hit", "preprocessed_cache_hit"]:
+                hits += int(fields[1])
+            elif fields[0] == "cache_miss":
+                misses += int(fields[1])
+
+        if proc.returncode != 0 or not counters:
+            return get_ccache_summary_stats()
+    elif tool == "sccache":
+        proc = run(
+            "sccache --show-stats --stats-format=json",
+            shell=True,
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+
+        try:
+            stats = json.loads(proc.stdout.decode("utf-8")).get("stats", {})
+        except ValueError:
+            return None
+
+        def count(value):
+            # newer versions split the counters by language
+            if isinstance(value, dict):
+                return sum(value.get("counts", {}).values())
+
+            return value or 0
+
+        hits = count(stats.get("cache_hits"))
+        misses = count(stats.get("cache_misses"))
+
+    return {"hits": hits, "misses": misses}
+
+
+def get_ccache_summary_stats():
+    """
+    Return the counters from the summary of ccache 3.x, which has no
+    --print-stats, or None when they are not found.
+    """
+    from subprocess import run, PIPE
+
+    proc = run("ccache -s", shell=True, stdout=PIPE, stderr=PIPE)
+    counters = {}
+
+    for line in proc.stdout.decode("utf-8", errors="replace").splitlines():
+        fields = line.rsplit(None, 1)
+
+        if len(fields) == 2 and fields[1].isdigit():
+            counters[fields[0].strip()] = int(fields[1])
+
+    if "cache miss" not in counters:
+        return None
+
+    return {
+        "hits": counters.get("cache hit (direct)", 0)
+        + counters.get("cache hit (preprocessed)", 0),
+        "misses": counters["cache miss"],
+    }
+
+
+def show_compiler_cache_stats(tool, stats_before):
+    stats_after = get_compiler_cache_stats(tool)
+
+    if stats_before is None or stats_after is None:
+        debug("Compiler cache ({0}): stats unavailable".format(tool))
+        return
+
+    hits = stats_after["hits"] - stats_before["hits"]
+    misses = stats_after["misses"] - stats_before["misses"]
+    total = hits + misses
+    hit_rate = (hits * 100.0 / total) if total else 0.0
+
+    debug(
+        "Compiler cache ({0}): {1} hits | {2} misses | {3:.1f}% hit rate".format(
+            tool, hits, misses, hit_rate
+        )
+    )
+
+
+def build_arch(
+    arch,
+    arch_dir,
+    install_dir,
+    cmake_args,
+    lib_file,
+    generator="Unix Makefiles",
+    compile_jobs=1,
+    capture=False,
+):
+    """
+    Configure, compile and install the library for a single arch.
+    """
+    output = []
+
+    # configure
+    create_dir(arch_dir)
+
+    source_dir = os.path.relpath(get_cur_dir(), os.path.abspath(arch_dir)) + "/"
+    command = " ".join(
+        ["cmake {0}".format(source_dir), '-G "{0}"'.format(generator)] + cmake_args
+    )
+    config = get_build_config(command, generator)
+    config_file = os.path.join(arch_dir, "make-config.json")
+    last_config = read_json_file(config_file)
+
+    if last_config == config and os.path.isfile(
+        os.path.join(arch_dir, "CMakeCache.txt")
+    ):
+        if capture:
+            output.append("> Configured: {0}\n".format(arch))
+        else:
+            debug("Configured: {0}".format(arch))
+    else:
+        if last_config and last_config.get("generator") != generator:
+            # cmake can't switch the generator of an existing tree
+            remove_dir(arch_dir)
+            create_dir(arch_dir)
+        else:
+            remove_file(os.path.join(arch_dir, "CMakeCache.txt"))
+
+        output.append(run_command(command, cwd=arch_dir, capture=capture))
+        write_json_file(config_file, config)
+
+    # compile
+
+    command = " ".join(["cmake", "--build", ".", "--parallel", str(compile_jobs)])
+    output.append(run_command(command, cwd=arch_dir, capture=capture))
+
+    # install
+    remove_dir(install_dir)
+    create_dir(install_dir)
+
+    from_file = os.path.join(arch_dir, lib_file)
+    to_file = os.path.join(install_dir, lib_file)
+
+    copy2(from_file, to_file)
+
+    # split debug info
+    if os.path.isfile(from_file + ".debug"):
+        copy2(from_file + ".debug", to_file + ".debug")
+    elif os.path.isdir(from_file + ".dSYM"):
+        copytree(from_file + ".dSYM", to_file + ".dSYM")
+
+    return "".join(output)
+
+
+def build_arch_worker(trace, build):
+    """
+    Build an arch in a worker process, returning its output with the trace
+    events and the command usage recorded in the worker.
+    """
+    if trace:
+        start_trace()
+
+    # a forked worker starts with a copy of the parent usage
+    del COMMAND_USAGE[:]
+
+    try:
+        with trace_span(
+            "build {0}".format(build["arch"]), "build", {"arch": build["arch"]}
+        ):
+            output = build_arch(capture=True, **build)
+    except Exception as e:
+        e.trace_events = TRACE_EVENTS or []
+        e.command_usage = list(COMMAND_USAGE)
+        raise
+
+    return output, TRACE_EVENTS or [], list(COMMAND_USAGE)
+
+
+def build_archs(builds, build_options):
+    """
+    Build a list of archs (dicts with the build_arch arguments). With more
+    than one job the archs are built at the same time in a process pool and
+    the output of each arch is printed as a block when it finishes.
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from subprocess import CalledProcessError
+
+    built = []
+    failed = []
+
+    jobs = build_options["jobs"]
+    keep_going = build_options["keep_going"]
+
+    generator = get_cmake_generator(build_options["generator"])
+    compile_jobs = get_compile_jobs(build_options["compile_jobs"], jobs, len(builds))
+
+    debug("Generator: {0} | Compile jobs per arch: {1}".format(generator, compile_jobs))
+    debug(
+        "Profile: {0}{1}{2}{3}".format(
+            build_options["profile"],
+            " (split debug info)" if build_options["split_debug"] else "",
+            " | unity build" if build_options["unity"] else "",
+            " | precompiled headers" if build_options["pch"] else "",
+        )
+    )
+
+    compiler_cache = get_compiler_cache(build_options["compiler_cache"])
+    compiler_cache_stats = None
+
+    if compiler_cache:
+        debug("Compiler cache: {0}".format(compiler_cache))
+
+        setup_compiler_cache(
+            compiler_cache, build_options["cache_dir"], build_options["cache_size"]
+        )
+
+        compiler_cache_stats = get_compiler_cache_stats(compiler_cache)
+
+    for build in builds:
+        build["generator"] = generator
+        build["compile_jobs"] = compile_jobs
+        build["cmake_args"] = build["cmake_args"] + get_build_cmake_args(build_options)
+
+        if compiler_cache:
+            build["cmake_args"] = build["cmake_args"] + [
+                "-DCMAKE_C_COMPILER_LAUNCHER={0}".format(compiler_cache),
+                "-DCMAKE_CXX_COMPILER_LAUNCHER={0}".format(compiler_cache),
+            ]
 
-def get_download_filename(url):
-    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
-    filename = os.path.basename(path)
+    if jobs <= 1 or len(builds) <= 1:
+        for build in builds:
+            debug("Building: {0}".format(build["arch"]))
 
-    if not filename:
-        filename = "downloaded.file"
+            try:
+                with trace_span(
+                    "build {0}".format(build["arch"]), "build", {"arch": build["arch"]}
+                ):
+                    build_arch(**build)
 
-    return filename
+                built.append(build["arch"])
+            except Exception as e:
+                if not isinstance(e, CalledProcessError):
+                    message("ERROR: {0}: {1}".format(build["arch"], e))
 
+                failed.append(build["arch"])
 
-def list_subdirs(from_path):
-    dirs = filter(
-        lambda x: os.path.isdir(os.path.join(from_path, x)), os.listdir(from_path)
-    )
-    return dirs
+                if not keep_going:
+                    break
+    else:
+        debug("Building {0} archs with {1} jobs...".format(len(builds), jobs))
 
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = list(builds)
+            futures = {}
 
-def remove_all_files(base_path, files_to_remove):
-    for file_to_remove in files_to_remove:
-        try:
-            file_to_remove = os.path.join(base_path, file_to_remove)
+            # an arch is submitted only when a worker is free, so after a
+            # failure no other arch starts and the archs still running
+            # finish and print their output
+            while pending or futures:
+                while pending and len(futures) < jobs and (keep_going or not failed):
+                    build = pending.pop(0)
+                    future = executor.submit(
+                        build_arch_worker, TRACE_EVENTS is not None, build
+                    )
+                    futures[future] = build["arch"]
 
-            if os.path.isdir(file_to_remove):
-                shutil.rmtree(file_to_remove)
-            else:
-                os.remove(file_to_remove)
-        except IOError as e:
-            # we will ignore this message, is not important now
-            # debug('Error removing file: {0} - {1}'.format(file_to_remove, e.strerror))
-            pass
-        except OSError as e:
-            # we will ignore this message, is not important now
-            # debug('Error removing file: {0} - {1}'.format(file_to_remove, e.strerror))
-            pass
+                if not futures:
+                    break
 
+                done, not_done = wait(list(futures), return_when=FIRST_COMPLETED)
 
-def get_cur_dir():
-    return pathlib.Path().absolute()
+                for future in done:
+                    arch = futures.pop(future)
 
+                    try:
+                        output, events, usage_list = future.result()
+                        add_trace_events(events)
 
-def create_dir(dir_path):
-    if not os.path.isdir(dir_path):
-        os.makedirs(dir_path)
+                        with COMMAND_USAGE_LOCK:
+                            COMMAND_USAGE.extend(usage_list)
 
+                        built.append(arch)
+                        debug("Built: {0}".format(arch))
+                    except Exception as e:
+                        add_trace_events(getattr(e, "trace_events", []))
 
-def remove_dir(dir_path):
-    if os.path.isdir(dir_path):
-        shutil.rmtree(dir_path)
+                        with COMMAND_USAGE_LOCK:
+                            COMMAND_USAGE.extend(getattr(e, "command_usage", []))
 
+                        if isinstance(e, CalledProcessError):
+                            output = e.output or ""
+                        else:
+                            output = "ERROR: {0}: {1}".format(arch, e)
 
-def remove_file(filename):
-    if os.path.isfile(filename):
-        os.remove(filename)
+                        failed.append(arch)
+                        debug("Failed: {0}".format(arch))
 
+                    message(output)
 
-def make_tarfile(output_filename, source_dir):
-    with tarfile.open(output_filename, "w:gz") as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
+    if compiler_cache:
+        show_compiler_cache_stats(compiler_cache, compiler_cache_stats)
 
+    show_lib_sizes([build for build in builds if build["arch"] in built])
 
-def write_to_file(dirname, filename, content):
-    full_file_path = os.path.join(dirname, filename)
-    remove_file(full_file_path)
-    create_dir(dirname)
+    if failed:
+        error("Build failed for: {0}".format(", ".join(failed)))
 
-    with open(full_file_path, "w") as f:
-        f.write(content)
-        f.close()
 
+def get_build_cmake_args(build_options):
+    """
+    Return the CMake arguments for the profile and compile modes.
+    """
 
-def find_files(directory, pattern):
-    files = [
-        f
-        for (dir, subdirs, fs) in os.walk(directory)
-        for f in fs
-        if f.endswith(pattern)
+    def on_off(value):
+        return "ON" if value else "OFF"
+
+    return [
+        "-DBOSSA_PROFILE={0}".format(build_options["profile"]),
+        "-DBOSSA_SPLIT_DEBUG={0}".format(on_off(build_options["split_debug"])),
+        "-DBOSSA_UNITY_BUILD={0}".format(on_off(build_options["unity"])),
+        "-DBOSSA_PCH={0}".format(on_off(build_options["pch"])),
     ]
 
-    return files
 
+def benchmark_builds(builds, build_options):
+    """
+    Time a cold build of each arch with and without the unity build and the
+    precompiled headers. The builds use their own dirs inside
+    build/benchmark-build, one arch at a time and without the compiler cache,
+    so every source is compiled again.
+    """
+    from subprocess import CalledProcessError
+
+    generator = get_cmake_generator(build_options["generator"])
+    compile_jobs = get_compile_jobs(build_options["compile_jobs"], 1, 1)
+    results = {}
+
+    debug("Generator: {0} | Compile jobs: {1}".format(generator, compile_jobs))
+
+    for mode, unity, pch in BUILD_BENCHMARK_MODES:
+        mode_options = dict(build_options, unity=unity, pch=pch)
+
+        for build in builds:
+            debug("Cold build: {0} | {1}".format(build["arch"], mode))
+
+            mode_dir = os.path.join(
+                "build",
+                "benchmark-build",
+                os.path.relpath(build["arch_dir"], "build"),
+                mode,
+            )
+            remove_dir(mode_dir)
+
+            started = time.monotonic()
+
+            try:
+                with trace_span(
+                    "build {0} {1}".format(build["arch"], mode),
+                    "build",
+                    {"arch": build["arch"], "mode": mode},
+                ):
+                    build_arch(
+                        arch=build["arch"],
+                        arch_dir=os.path.join(mode_dir, "build"),
+                        install_dir=os.path.join(mode_dir, "dist"),
+                        cmake_args=build["cmake_args"]
+                        + get_build_cmake_args(mode_options),
+                        lib_file=build["lib_file"],
+                        generator=generator,
+                        compile_jobs=compile_jobs,
+                        capture=True,
+                    )
+            except CalledProcessError as e:
+                message(e.output or "")
+                error("Build failed for: {0} | {1}".format(build["arch"], mode))
+
+            results[(build["arch"], mode)] = time.monotonic() - started
 
-def is_test_user():
-    user = pwd.getpwuid(os.getuid())[0]
-    return user == "paulo"
+    message("")
+    debug("Cold build time:")
 
+    modes = [mode for mode, unity, pch in BUILD_BENCHMARK_MODES]
+    message("  {0:<14}".format("arch") + "".join(["{0:>12}".format(m) for m in modes]))
 
-def file_has_content(file, content):
-    with open(file) as f:
-        if content in f.read():
-            return True
+    for build in builds:
+        baseline = results[(build["arch"], modes[0])]
+        row = "  {0:<14}".format(build["arch"])
 
-    return False
+        for mode in modes:
+            seconds = results[(build["arch"], mode)]
+            row += "{0:>12}".format(
+                "{0:.1f}s".format(seconds)
+                if mode == modes[0]
+                else "{0:.1f}s {1:+.0f}%".format(
+                    seconds, (seconds - baseline) * 100.0 / baseline
+                )
+            )
 
+        message(row)
 
-def get_file_content(file):
-    file = open(file, mode="r")
-    content = file.read()
-    file.close()
-    return content
 
+def get_path_size(path):
+    if os.path.isdir(path):
+        return sum(
+            [
+                os.path.getsize(os.path.join(dirpath, name))
+                for dirpath, dirnames, filenames in os.walk(path)
+                for name in filenames
+            ]
+        )
 
-def prepend_to_file(file, content):
-    file_content = content + "\n" + get_file_content(file)
-    file_dest = open(file, "w")
-    file_dest.write(file_content)
-    file_dest.close()
+    return os.path.getsize(path)
 
 
-def append_to_file(file, content):
-    file_content = get_file_content(file) + "\n" + content
-    file_dest = open(file, "w")
-    file_dest.write(file_content)
-    file_dest.close()
+def show_lib_sizes(builds):
+    """
+    Show the size of the installed library of each arch, and of its
+    separate debug info when it was split.
+    """
+    for build in builds:
+        lib = os.path.join(build["install_dir"], build["lib_file"])
 
+        if not os.path.isfile(lib):
+            continue
 
-def replace_in_file(filename, old_string, new_string):
-    with open(filename) as f:
-        s = f.read()
-        if old_string not in s:
-            # print('"{old_string}" not found in {filename}.'.format(**locals()))
-            return
+        debug_info = ""
 
-    # Safely write the changed content, if found in the file
-    with open(filename, "w") as f:
-        # print('Changing "{old_string}" to "{new_string}" in {filename}'.format(**locals()))
-        s = s.replace(old_string, new_string)
-        f.write(s)
+        for suffix in [".debug", ".dSYM"]:
+            if os.path.exists(lib + suffix):
+                debug_info = " | debug info: {0}".format(
+                    format_size(get_path_size(lib + suffix))
+                )
+
+        debug(
+            "Library size: {0}: {1}{2}".format(
+                build["arch"], format_size(os.path.getsize(lib)), debug_info
+            )
+        )
 
 
 def run_task_clear():
@@ -389,105 +3081,73 @@ def run_task_clear():
 
 
 def run_task_patch_android():
-    target_dir = os.path.join("build")
-
-    # patch
     debug("Patch: BOSSA")
-
-    source_dir = os.path.join(target_dir, "BOSSA-master", "src")
-
-    # android log
-    source_file = os.path.join(source_dir, "bossac.cpp")
-    if not file_has_content(source_file, "#include <android/log.h>"):
-        replace_in_file(
-            source_file,
-            "fprintf(stdout,",
-            '__android_log_print(ANDROID_LOG_DEBUG, "BOSSA",',
-        )
-
-        replace_in_file(
-            source_file,
-            "fprintf(stderr,",
-            '__android_log_print(ANDROID_LOG_ERROR, "BOSSA",',
-        )
-
-        content = "#include <android/log.h>"
-        prepend_to_file(source_file, content)
-
-        debug("Applied: Android Log")
-
-    # flutter functions
-    source_file = os.path.join(source_dir, "bossac.cpp")
-    if not file_has_content(source_file, 'extern "C"'):
-        content = get_file_content(os.path.join("patches", "bossac_android.cpp"))
-        append_to_file(source_file, content)
-
-        debug("Applied: Bossac Flutter Functions")
-
+    run_patch_set("android")
     debug("Patched: BOSSA")
 
 
-def run_task_build_android():
+def run_task_build_android(build_options):
     debug("Build for Android...")
 
-    cur_dir = get_cur_dir()
-    ndk_dir = os.path.join(cur_dir, "build", "android-ndk-r21d")
-
     build_dir = os.path.join("build", "android")
     dist_dir = os.path.join("dist", "android")
 
-    remove_dir(build_dir)
-    create_dir(build_dir)
+    if build_options["clean"]:
+        remove_dir(build_dir)
+        remove_dir(dist_dir)
 
-    remove_dir(dist_dir)
+    create_dir(build_dir)
     create_dir(dist_dir)
 
+    build_archs(get_android_builds(build_dir, dist_dir), build_options)
+
+
+def get_android_builds(build_dir, dist_dir):
+    ndk_dir = os.path.join(get_cur_dir(), "build", "android-ndk-r21d")
+
     archs = ["arm64-v8a", "armeabi-v7a", "x86", "x86_64"]
+    builds = []
 
     for arch in archs:
-        # compile
-        arch_dir = os.path.join(build_dir, arch)
-        create_dir(arch_dir)
-
-        command = " ".join(
-            [
-                "cmake ../../../",
-                "-DCMAKE_SYSTEM_NAME=Android",
-                "-DCMAKE_ANDROID_ARCH_ABI={0}".format(arch),
-                "-DCMAKE_ANDROID_NDK={0}".format(ndk_dir),
-                "-DCMAKE_ANDROID_STL_TYPE=c++_static",
-                "-DTARGET_SYSTEM=android",
-            ]
+        builds.append(
+            {
+                "arch": arch,
+                "arch_dir": os.path.join(build_dir, arch),
+                "install_dir": os.path.join(dist_dir, arch),
+                "cmake_args": [
+                    "-DCMAKE_SYSTEM_NAME=Android",
+                    "-DCMAKE_ANDROID_ARCH_ABI={0}".format(arch),
+                    "-DCMAKE_ANDROID_NDK={0}".format(ndk_dir),
+                    "-DCMAKE_ANDROID_STL_TYPE=c++_static",
+                    "-DTARGET_SYSTEM=android",
+                ],
+                "lib_file": "libbossac.so",
+            }
         )
-        check_call(command, cwd=arch_dir, shell=True)
 
-        command = " ".join(["make"])
-        check_call(command, cwd=arch_dir, shell=True)
+    return builds
 
-        # install
-        install_dir = os.path.join(dist_dir, arch)
-        remove_dir(install_dir)
-        create_dir(install_dir)
 
-        from_file = os.path.join(arch_dir, "libbossac.so")
-        to_file = os.path.join(install_dir, "libbossac.so")
+def run_task_benchmark_build_android(build_options):
+    debug("Benchmark build for Android...")
 
-        copy2(from_file, to_file)
+    benchmark_builds(
+        get_android_builds(
+            os.path.join("build", "android"), os.path.join("dist", "android")
+        ),
+        build_options,
+    )
 
 
-def run_task_test_android():
+def run_task_test_android(test_options):
     debug("Test for Android...")
 
-    archs = ["arm64-v8a", "armeabi-v7a", "x86", "x86_64"]
-
-    dist_dir = os.path.join("dist", "android")
-
-    for arch in archs:
-        install_dir = os.path.join(dist_dir, arch)
-        lib_file = "libbossac.so"
+    import library_check
 
-        command = " ".join(["file", lib_file])
-        check_call(command, cwd=install_dir, shell=True)
+    builds = get_android_builds(
+        os.path.join("build", "android"), os.path.join("dist", "android")
+    )
+    library_check.run("android", builds, test_options)
 
 
 def run_task_install_android():
@@ -515,73 +3175,63 @@ def run_task_install_android():
 
 
 def run_task_patch_macos():
-    target_dir = os.path.join("build")
-
-    # patch
     debug("Patch: BOSSA")
-
-    source_dir = os.path.join(target_dir, "BOSSA-master", "src")
-
-    # flutter functions
-    source_file = os.path.join(source_dir, "bossac.cpp")
-    if not file_has_content(source_file, 'extern "C"'):
-        content = get_file_content(os.path.join("patches", "bossac_macos.cpp"))
-        append_to_file(source_file, content)
-
-        debug("Applied: Bossac Flutter Functions")
-
+    run_patch_set("macos")
     debug("Patched: BOSSA")
 
 
-def run_task_build_macos():
+def run_task_build_macos(build_options):
     debug("Build for macOS...")
 
     build_dir = os.path.join("build", "macos")
     dist_dir = os.path.join("dist", "macos")
 
-    remove_dir(build_dir)
-    create_dir(build_dir)
+    if build_options["clean"]:
+        remove_dir(build_dir)
+        remove_dir(dist_dir)
 
-    remove_dir(dist_dir)
+    create_dir(build_dir)
     create_dir(dist_dir)
 
+    build_archs(get_macos_builds(build_dir, dist_dir), build_options)
+
+
+def get_macos_builds(build_dir, dist_dir):
     archs = ["x86_64"]
+    builds = []
 
     for arch in archs:
-        # compile
-        arch_dir = os.path.join(build_dir, arch)
-        create_dir(arch_dir)
-
-        command = " ".join(["cmake ../../../", "-DTARGET_SYSTEM=macos",])
-        check_call(command, cwd=arch_dir, shell=True)
+        builds.append(
+            {
+                "arch": arch,
+                "arch_dir": os.path.join(build_dir, arch),
+                "install_dir": os.path.join(dist_dir, arch),
+                "cmake_args": ["-DTARGET_SYSTEM=macos"],
+                "lib_file": "libbossac.dylib",
+            }
+        )
 
-        command = " ".join(["make"])
-        check_call(command, cwd=arch_dir, shell=True)
+    return builds
 
-        # install
-        install_dir = os.path.join(dist_dir, arch)
-        remove_dir(install_dir)
-        create_dir(install_dir)
 
-        from_file = os.path.join(arch_dir, "libbossac.dylib")
-        to_file = os.path.join(install_dir, "libbossac.dylib")
+def run_task_benchmark_build_macos(build_options):
+    debug("Benchmark build for macOS...")
 
-        copy2(from_file, to_file)
+    benchmark_builds(
+        get_macos_builds(os.path.join("build", "macos"), os.path.join("dist", "macos")),
+        build_options,
+    )
 
 
-def run_task_test_macos():
+def run_task_test_macos(test_options):
     debug("Test for macOS...")
 
-    archs = ["x86_64"]
-
-    dist_dir = os.path.join("dist", "macos")
-
-    for arch in archs:
-        install_dir = os.path.join(dist_dir, arch)
-        lib_file = "libbossac.dylib"
+    import library_check
 
-        command = " ".join(["file", lib_file])
-        check_call(command, cwd=install_dir, shell=True)
+    builds = get_macos_builds(
+        os.path.join("build", "macos"), os.path.join("dist", "macos")
+    )
+    library_check.run("macos", builds, test_options)
 
 
 def run_task_install_macos():
@@ -612,80 +3262,70 @@ def run_task_run_macos():
     project_dir = os.path.join("projects", "cli")
 
     command = " ".join(["pub", "get"])
-    check_call(command, cwd=project_dir, shell=True)
+    run_command(command, cwd=project_dir)
 
     command = " ".join(["dart", "cli.dart"])
-    check_call(command, cwd=project_dir, shell=True)
+    run_command(command, cwd=project_dir)
 
 
 def run_task_patch_linux():
-    target_dir = os.path.join("build")
-
-    # patch
     debug("Patch: BOSSA")
-
-    source_dir = os.path.join(target_dir, "BOSSA-master", "src")
-
-    # flutter functions
-    source_file = os.path.join(source_dir, "bossac.cpp")
-    if not file_has_content(source_file, 'extern "C"'):
-        content = get_file_content(os.path.join("patches", "bossac_linux.cpp"))
-        append_to_file(source_file, content)
-
-        debug("Applied: Bossac Flutter Functions")
-
+    run_patch_set("linux")
     debug("Patched: BOSSA")
 
 
-def run_task_build_linux():
+def run_task_build_linux(build_options):
     debug("Build for Linux...")
 
     build_dir = os.path.join("build", "linux")
     dist_dir = os.path.join("dist", "linux")
 
-    remove_dir(build_dir)
-    create_dir(build_dir)
+    if build_options["clean"]:
+        remove_dir(build_dir)
+        remove_dir(dist_dir)
 
-    remove_dir(dist_dir)
+    create_dir(build_dir)
     create_dir(dist_dir)
 
+    build_archs(get_linux_builds(build_dir, dist_dir), build_options)
+
+
+def get_linux_builds(build_dir, dist_dir):
     archs = ["x86_64"]
+    builds = []
 
     for arch in archs:
-        # compile
-        arch_dir = os.path.join(build_dir, arch)
-        create_dir(arch_dir)
-
-        command = " ".join(["cmake ../../../", "-DTARGET_SYSTEM=linux",])
-        check_call(command, cwd=arch_dir, shell=True)
+        builds.append(
+            {
+                "arch": arch,
+                "arch_dir": os.path.join(build_dir, arch),
+                "install_dir": os.path.join(dist_dir, arch),
+                "cmake_args": ["-DTARGET_SYSTEM=linux"],
+                "lib_file": "libbossac.so",
+            }
+        )
 
-        command = " ".join(["make"])
-        check_call(command, cwd=arch_dir, shell=True)
+    return builds
 
-        # install
-        install_dir = os.path.join(dist_dir, arch)
-        remove_dir(install_dir)
-        create_dir(install_dir)
 
-        from_file = os.path.join(arch_dir, "libbossac.so")
-        to_file = os.path.join(install_dir, "libbossac.so")
+def run_task_benchmark_build_linux(build_options):
+    debug("Benchmark build for Linux...")
 
-        copy2(from_file, to_file)
+    benchmark_builds(
+        get_linux_builds(os.path.join("build", "linux"), os.path.join("dist", "linux")),
+        build_options,
+    )
 
 
-def run_task_test_linux():
+def run_task_test_linux(test_options):
     debug("Test for Linux...")
 
-    archs = ["x86_64"]
-
-    dist_dir = os.path.join("dist", "linux")
-
-    for arch in archs:
-        install_dir = os.path.join(dist_dir, arch)
-        lib_file = "libbossac.so"
+    import library_check
 
-        command = " ".join(["file", lib_file])
-        check_call(command, cwd=install_dir, shell=True)
+    builds = get_linux_builds(
+        os.path.join("build", "linux"), os.path.join("dist", "linux")
+    )
+    library_check.run("linux", builds, test_options)
 
 
 def run_task_install_linux():
@@ -716,115 +3356,179 @@ def run_task_run_linux():
     project_dir = os.path.join("projects", "cli")
 
     command = " ".join(["pub", "get"])
-    check_call(command, cwd=project_dir, shell=True)
+    run_command(command, cwd=project_dir)
 
     command = " ".join(["dart", "cli.dart"])
-    check_call(command, cwd=project_dir, shell=True)
+    run_command(command, cwd=project_dir)
 
 
-def run_task_get_wx():
+def run_task_get_wx(download_options):
     wx_url = "https://github.com/wxWidgets/wxWidgets/releases/download/v3.1.4/wxWidgets-3.1.4.tar.bz2"
     target_dir = os.path.join("build")
 
     create_dir(target_dir)
 
-    # download
-    if os.path.isfile(os.path.join(target_dir, "wxWidgets-3.1.4.tar.bz2")):
-        debug("Downloaded: WXWIDGETS")
-    else:
-        debug("Download: WXWIDGETS")
-        download_file(wx_url, target_dir, "wxWidgets-3.1.4.tar.bz2")
-        debug("Downloaded: WXWIDGETS")
-
-    # extract
-    if os.path.isdir(os.path.join(target_dir, "wxWidgets-3.1.4")):
-        debug("Extracted: WXWIDGETS")
-    else:
-        debug("Extract: WXWIDGETS")
-        tar = tarfile.open(os.path.join(target_dir, "wxWidgets-3.1.4.tar.bz2"), "r:bz2")
-        tar.extractall(target_dir)
-        tar.close()
-        debug("Extracted: WXWIDGETS")
+    # download and extract
+    get_tar_artifact(
+        wx_url,
+        target_dir,
+        "wxWidgets-3.1.4.tar.bz2",
+        "wxWidgets-3.1.4",
+        "WXWIDGETS",
+        download_options,
+    )
 
 
-def run_task_get_bossa():
+def run_task_get_bossa(download_options):
     bossa_url = "https://github.com/shumatech/BOSSA/archive/master.tar.gz"
     target_dir = os.path.join("build")
 
     create_dir(target_dir)
 
-    # download
-    if os.path.isfile(os.path.join(target_dir, "BOSSA-master.tar.gz")):
-        debug("Downloaded: BOSSA")
-    else:
-        debug("Download: BOSSA")
-        download_file(bossa_url, target_dir, "BOSSA-master.tar.gz")
-        debug("Downloaded: BOSSA")
-
-    # extract
-    if os.path.isdir(os.path.join(target_dir, "BOSSA-master")):
-        debug("Extracted: BOSSA")
-    else:
-        debug("Extract: BOSSA")
-        tar = tarfile.open(os.path.join(target_dir, "BOSSA-master.tar.gz"), "r:gz")
-        tar.extractall(target_dir)
-        tar.close()
-        debug("Extracted: BOSSA")
+    # download and extract
+    get_tar_artifact(
+        bossa_url,
+        target_dir,
+        "BOSSA-master.tar.gz",
+        "BOSSA-master",
+        "BOSSA",
+        download_options,
+    )
 
 
 def run_task_patch_bossa():
+    debug("Patching...")
+    run_patch_set("bossa")
+    debug("Patched")
+
+
+def run_task_remove_bossa():
     target_dir = os.path.join("build")
+    source_dir = os.path.join(target_dir, "BOSSA-master")
+    remove_dir(source_dir)
 
-    # patch
-    debug("Patching...")
 
-    source_dir = os.path.join(target_dir, "BOSSA-master", "src")
+def run_task_benchmark(benchmark_options):
+    debug("Benchmark...")
 
-    # version
-    source_file = os.path.join(source_dir, "bossac.cpp")
-    if not file_has_content(source_file, "(BOSSA) 1.9.1"):
-        replace_in_file(
-            source_file, 'Version " VERSION "', "Version 1.9.1",
-        )
+    import benchmark
 
-        debug("Applied: Bossac Version")
+    benchmark.run(benchmark_options)
 
-    # extra arguments log
-    source_file = os.path.join(source_dir, "bossac.cpp")
-    if not file_has_content(
-        source_file, "extra arguments found (parsed: %d | sent: %d)"
-    ):
-        replace_in_file(
-            source_file,
-            'fprintf(stderr, "%s: extra arguments found\\n", argv[0]);',
-            'fprintf(stderr, "%s: extra arguments found (parsed: %d | sent: %d)\\n", argv[0], args, argc);',
-        )
 
-        debug("Applied: Extra arguments found")
+def run_task_benchmark_flash(benchmark_options):
+    debug("Benchmark flash...")
 
-    # reset cmd parse
-    source_file = os.path.join(source_dir, "CmdOpts.cpp")
-    if not file_has_content(
-        source_file, "optind = 1;"
-    ):
-        replace_in_file(
-            source_file,
-            'struct option long_opts[_numOpts + 1];',
-            'optind = 1;\n    struct option long_opts[_numOpts + 1];',
-        )
+    import flash_benchmark
 
-        debug("Applied: Reset cmd parse")
+    flash_benchmark.run(benchmark_options)
 
-    debug("Patched")
 
+def run_task_flash_devices(flash_options):
+    debug("Flash devices...")
 
-def run_task_remove_bossa():
-    target_dir = os.path.join("build")
-    source_dir = os.path.join(target_dir, "BOSSA-master")
-    remove_dir(source_dir)
+    import flash_devices
+
+    flash_devices.run(flash_options)
+
+
+def run_task_benchmark_flash_devices(benchmark_options):
+    debug("Benchmark flash devices...")
+
+    import flash_devices
+
+    flash_devices.run_emulated(benchmark_options)
+
+
+def get_import_times(output, module):
+    """
+    Parse the output of python -X importtime, returning the cumulative
+    import time of the module and of each module it imports, in seconds.
+    """
+    children = {}
+
+    for line in output.splitlines():
+        fields = line.split("|")
+
+        if not line.startswith("import time:") or not fields[1].strip().isdigit():
+            continue
+
+        # children are printed before their parent, indented by two spaces
+        name = fields[2][1:]
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        elapsed = int(fields[1]) / 1000000.0
+
+        if depth == 1:
+            children[name.strip()] = elapsed
+        elif depth == 0 and name.strip() == module:
+            return elapsed, children
+        elif depth == 0:
+            children = {}
+
+    return None, {}
+
+
+def run_task_check_startup():
+    debug("Check startup...")
+
+    from subprocess import run, PIPE
+
+    # the bytecode cache must be written, like in repeated calls
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    commands = {
+        "import": [sys.executable, "-X", "importtime", "-c", "import make"],
+        "help": [sys.executable, "-m", "make", "--help"],
+    }
+    times = {}
+    imports = {}
 
+    for name in commands:
+        # warm up
+        run(commands[name], stdout=PIPE, stderr=PIPE, env=env)
+
+        for i in range(STARTUP_RUNS):
+            started = time.monotonic()
+            proc = run(commands[name], stdout=PIPE, stderr=PIPE, env=env)
+            elapsed = time.monotonic() - started
+
+            if proc.returncode != 0:
+                error("Startup command failed: {0}".format(" ".join(commands[name])))
+
+            if name == "import":
+                elapsed, children = get_import_times(
+                    proc.stderr.decode("utf-8"), "make"
+                )
+
+                if name not in times or elapsed < times[name]:
+                    imports = children
+
+            times[name] = min(times.get(name, elapsed), elapsed)
+
+    # the modules imported by make, slowest first
+    for module in sorted(imports, key=imports.get, reverse=True)[:10]:
+        message("  {0:<30} {1:8.1f} ms".format(module, imports[module] * 1000))
+
+    failed = []
+
+    for name in times:
+        debug(
+            "Startup {0}: {1:.1f} ms (budget: {2:.1f} ms)".format(
+                name, times[name] * 1000, STARTUP_BUDGET[name] * 1000
+            )
+        )
+
+        if times[name] > STARTUP_BUDGET[name]:
+            failed.append(name)
+
+    if failed:
+        error("Startup over budget: {0}".format(", ".join(failed)))
+
+
+def run_task_get_ndk(download_options):
+    import platform
 
-def run_task_get_ndk():
     system_name = platform.system().lower()
     ndk_url = ""
     ndk_filename = ""
@@ -845,26 +3549,265 @@ def run_task_get_ndk():
 
     create_dir(target_dir)
 
-    # download
-    if os.path.isfile(os.path.join(target_dir, ndk_filename)):
-        debug("Downloaded: NDK")
-    else:
-        debug("Download: NDK")
-        download_file(ndk_url, target_dir, ndk_filename)
-        debug("Downloaded: NDK")
+    # download and extract
+    get_zip_artifact(
+        ndk_url, target_dir, ndk_filename, ndk_folder, "NDK", download_options
+    )
 
-    # extract
-    if os.path.isdir(os.path.join(target_dir, ndk_folder)):
-        debug("Extracted: NDK")
-    else:
-        debug("Extract: NDK")
-        zip = ZipFileWithPermissions(os.path.join(target_dir, ndk_filename))
-        zip.extractall(target_dir)
-        zip.close()
-        debug("Extracted: NDK")
+
+def is_extracted(folder):
+    return os.path.isfile(get_extract_stamp_file("build", folder))
+
+
+def is_built(platform, archs, lib_file, build_options):
+    """
+    Return True when every library of the platform in dist is newer than
+    the BOSSA sources, the patches and CMakeLists.txt, and was configured
+    with the same profile and compile modes.
+    """
+    if build_options["clean"]:
+        return False
+
+    build_dir = os.path.join("build", platform)
+    dist_dir = os.path.join("dist", platform)
+    inputs = [os.path.join(get_cur_dir(), "CMakeLists.txt")]
+
+    for source_dir in [os.path.join("build", "BOSSA-master", "src"), "patches"]:
+        if not os.path.isdir(source_dir):
+            return False
+
+        for name in os.listdir(source_dir):
+            inputs.append(os.path.join(source_dir, name))
+
+    inputs_mtime = max([os.path.getmtime(file) for file in inputs])
+
+    for arch in archs:
+        lib = os.path.join(dist_dir, arch, lib_file)
+
+        if not os.path.isfile(lib) or os.path.getmtime(lib) < inputs_mtime:
+            return False
+
+        config = read_json_file(os.path.join(build_dir, arch, "make-config.json"))
+        command = config["command"].split(" ") if config else []
+
+        if not all([arg in command for arg in get_build_cmake_args(build_options)]):
+            return False
+
+    return True
+
+
+TASKS = {
+    "clear": {
+        "help": "Remove the build dir.",
+        "func": run_task_clear,
+        "options": None,
+        "deps": [],
+    },
+    "get-wx": {
+        "help": "Download and extract wxWidgets.",
+        "func": run_task_get_wx,
+        "options": "download",
+        "deps": [],
+        "up_to_date": lambda task_options: is_extracted("wxWidgets-3.1.4"),
+    },
+    "get-bossa": {
+        "help": "Download and extract BOSSA.",
+        "func": run_task_get_bossa,
+        "options": "download",
+        "deps": [],
+        "up_to_date": lambda task_options: is_extracted("BOSSA-master"),
+        "lock": "bossa-sources",
+    },
+    "get-ndk": {
+        "help": "Download and extract the Android NDK.",
+        "func": run_task_get_ndk,
+        "options": "download",
+        "deps": [],
+        "up_to_date": lambda task_options: is_extracted("android-ndk-r21d"),
+    },
+    "patch-bossa": {
+        "help": "Apply the common patches to BOSSA.",
+        "func": run_task_patch_bossa,
+        "options": None,
+        "deps": ["get-bossa"],
+        "up_to_date": lambda task_options: is_patch_set_applied("bossa"),
+        "lock": "bossa-sources",
+    },
+    "remove-bossa": {
+        "help": "Remove the BOSSA sources.",
+        "func": run_task_remove_bossa,
+        "options": None,
+        "deps": [],
+        "lock": "bossa-sources",
+    },
+    "patch-android": {
+        "help": "Apply the Android patches to BOSSA.",
+        "func": run_task_patch_android,
+        "options": None,
+        "deps": ["patch-bossa"],
+        "up_to_date": lambda task_options: is_patch_set_applied("android"),
+        "lock": "bossa-sources",
+    },
+    "build-android": {
+        "help": "Build the library for each Android arch.",
+        "func": run_task_build_android,
+        "options": "build",
+        "deps": ["get-wx", "get-ndk", "patch-android"],
+        "up_to_date": lambda task_options: is_built(
+            "android",
+            ["arm64-v8a", "armeabi-v7a", "x86", "x86_64"],
+            "libbossac.so",
+            task_options["build"],
+        ),
+    },
+    "benchmark-build-android": {
+        "help": "Compare cold Android builds with and without unity build and PCH.",
+        "func": run_task_benchmark_build_android,
+        "options": "build",
+        "deps": ["get-wx", "get-ndk", "patch-android"],
+    },
+    "test-android": {
+        "help": "Check the Android libraries.",
+        "func": run_task_test_android,
+        "options": "test",
+        "deps": ["build-android"],
+    },
+    "install-android": {
+        "help": "Copy the Android libraries to the sample project.",
+        "func": run_task_install_android,
+        "options": None,
+        "deps": ["build-android"],
+    },
+    "patch-macos": {
+        "help": "Apply the macOS patches to BOSSA.",
+        "func": run_task_patch_macos,
+        "options": None,
+        "deps": ["patch-bossa"],
+        "up_to_date": lambda task_options: is_patch_set_applied("macos"),
+        "lock": "bossa-sources",
+    },
+    "build-macos": {
+        "help": "Build the library for macOS.",
+        "func": run_task_build_macos,
+        "options": "build",
+        "deps": ["get-wx", "patch-macos"],
+        "up_to_date": lambda task_options: is_built(
+            "macos", ["x86_64"], "libbossac.dylib", task_options["build"]
+        ),
+    },
+    "benchmark-build-macos": {
+        "help": "Compare cold macOS builds with and without unity build and PCH.",
+        "func": run_task_benchmark_build_macos,
+        "options": "build",
+        "deps": ["get-wx", "patch-macos"],
+    },
+    "test-macos": {
+        "help": "Check the macOS library.",
+        "func": run_task_test_macos,
+        "options": "test",
+        "deps": ["build-macos"],
+    },
+    "install-macos": {
+        "help": "Copy the macOS library to the cli project.",
+        "func": run_task_install_macos,
+        "options": None,
+        "deps": ["build-macos"],
+    },
+    "run-macos": {
+        "help": "Run the cli project on macOS.",
+        "func": run_task_run_macos,
+        "options": None,
+        "deps": ["install-macos"],
+    },
+    "patch-linux": {
+        "help": "Apply the Linux patches to BOSSA.",
+        "func": run_task_patch_linux,
+        "options": None,
+        "deps": ["patch-bossa"],
+        "up_to_date": lambda task_options: is_patch_set_applied("linux"),
+        "lock": "bossa-sources",
+    },
+    "build-linux": {
+        "help": "Build the library for Linux.",
+        "func": run_task_build_linux,
+        "options": "build",
+        "deps": ["get-wx", "patch-linux"],
+        "up_to_date": lambda task_options: is_built(
+            "linux", ["x86_64"], "libbossac.so", task_options["build"]
+        ),
+    },
+    "benchmark-build-linux": {
+        "help": "Compare cold Linux builds with and without unity build and PCH.",
+        "func": run_task_benchmark_build_linux,
+        "options": "build",
+        "deps": ["get-wx", "patch-linux"],
+    },
+    "test-linux": {
+        "help": "Check the Linux library.",
+        "func": run_task_test_linux,
+        "options": "test",
+        "deps": ["build-linux"],
+    },
+    "install-linux": {
+        "help": "Copy the Linux library to the cli project.",
+        "func": run_task_install_linux,
+        "options": None,
+        "deps": ["build-linux"],
+    },
+    "run-linux": {
+        "help": "Run the cli project on Linux.",
+        "func": run_task_run_linux,
+        "options": None,
+        "deps": ["install-linux"],
+    },
+    "check-startup": {
+        "help": "Check the startup time of make.py against its budget.",
+        "func": run_task_check_startup,
+        "options": None,
+        "deps": [],
+    },
+    "benchmark": {
+        "help": "Benchmark the download, extraction and patch helpers.",
+        "func": run_task_benchmark,
+        "options": "benchmark",
+        "deps": [],
+    },
+    "benchmark-flash": {
+        "help": "Benchmark erase, write and verify against an emulated device.",
+        "func": run_task_benchmark_flash,
+        "options": "benchmark",
+        "deps": ["build-macos" if sys.platform == "darwin" else "build-linux"],
+    },
+    "flash-devices": {
+        "help": "Flash the image to each port at the same time.",
+        "func": run_task_flash_devices,
+        "options": "flash",
+        "deps": ["build-macos" if sys.platform == "darwin" else "build-linux"],
+    },
+    "benchmark-flash-devices": {
+        "help": "Benchmark flashing several emulated devices at the same time.",
+        "func": run_task_benchmark_flash_devices,
+        "options": "benchmark",
+        "deps": ["build-macos" if sys.platform == "darwin" else "build-linux"],
+    },
+}
+
+
+def get_usage():
+    """
+    Return the usage with the list of tasks from the registry.
+    """
+    width = max([len(name) for name in TASKS])
+    tasks = [
+        "  {0:<{1}}  {2}".format(name, width, TASKS[name]["help"]) for name in TASKS
+    ]
+
+    return __doc__.replace("{tasks}", "\n".join(tasks))
 
 
 if __name__ == "__main__":
+    from docopt import docopt
+
     # main CLI entrypoint
-    args = docopt(__doc__, version="1.0.0")
+    args = docopt(get_usage(), version="1.0.0")
     main(args)
@@ -1,5 +1,4 @@
 extern "C" {
-    #include <android/log.h>
     #include <string>
     
     __attribute__((visibility("default"))) __attribute__((used))
@@ -23,16 +22,14 @@ extern "C" {
     __attribute__((visibility("default"))) __attribute__((used))
     void test_flutter_void() 
     {
-        fprintf(stdout, "Function [test_flutter_void] was called\n");
-        __android_log_print(ANDROID_LOG_DEBUG, "BOSSA", "Function [test_flutter_void] was called");
+        bossa_log(BOSSA_LOG_INFO, "Function [test_flutter_void] was called\n");
     }
 
     __attribute__((visibility("default"))) __attribute__((used))
     char * test_flutter_pointer(int argc, char* args) 
     {
-        fprintf(stdout, "Function [test_flutter_pointer] was called\n");
-        __android_log_print(ANDROID_LOG_DEBUG, "BOSSA", "Function [test_flutter_pointer] was called");
-        __android_log_print(ANDROID_LOG_DEBUG, "BOSSA", "Function [test_flutter_pointer] Value send: %d | %s", argc, args);
+        bossa_log(BOSSA_LOG_INFO, "Function [test_flutter_pointer] was called\n");
+        bossa_log(BOSSA_LOG_INFO, "Function [test_flutter_pointer] Value send: %d | %s\n", argc, args);
 
         return args;
     }
@@ -40,9 +37,8 @@ extern "C" {
     __attribute__((visibility("default"))) __attribute__((used))
     int bossa_main(int argc, char* args)
     {
-        fprintf(stdout, "Function [bossa_main] was called\n");
-        __android_log_print(ANDROID_LOG_DEBUG, "BOSSA", "Function [bossa_main] was called");
-        __android_log_print(ANDROID_LOG_DEBUG, "BOSSA", "Function [bossa_main] Value send: %d | %s", argc, args);
+        bossa_log(BOSSA_LOG_DEBUG, "Function [bossa_main] was called\n");
+        bossa_log(BOSSA_LOG_DEBUG, "Function [bossa_main] Value send: %d | %s\n", argc, args);
 
         // convert string to array of params
         int nargc = 0;
@@ -55,7 +51,7 @@ extern "C" {
 
         for (i = 0; i < nargc; i++) 
         {
-            __android_log_print(ANDROID_LOG_DEBUG, "BOSSA", "Function [bossa_main] Value %d parsed: %s", (i + 1), nargv[i]);
+            bossa_log(BOSSA_LOG_DEBUG, "Function [bossa_main] Value %d parsed: %s\n", (i + 1), nargv[i]);
         }
         
         // call main with new params
@@ -0,0 +1,273 @@
+#include <atomic>
+#include <chrono>
+#include <mutex>
+#include <stdexcept>
+#include <thread>
+
+// exit code of a cancelled job
+#define BOSSA_ASYNC_CANCELLED -1
+
+// event of a job: phase, bytes done and total bytes; the last event has the
+// phase BOSSA_PHASE_DONE and the exit code as done
+typedef void (*BossaProgressCallback)(void* user, int phase, int64_t done, int64_t total);
+
+// Dart_PostCObject from dart_native_api.h (NativeApi.postCObject in dart:ffi),
+// with the part of Dart_CObject used to post a list of integers
+enum BossaCObjectType
+{
+    BOSSA_COBJECT_INT64 = 3,
+    BOSSA_COBJECT_ARRAY = 6,
+};
+
+struct BossaCObject
+{
+    int32_t type;
+    union
+    {
+        int64_t as_int64;
+        struct
+        {
+            intptr_t length;
+            BossaCObject** values;
+        } as_array;
+    } value;
+};
+
+typedef bool (*BossaPostCObject)(int64_t port, BossaCObject* message);
+
+struct BossaAsyncJob
+{
+    string args;
+    BossaProgressCallback callback;
+    void* user;
+    BossaPostCObject post;
+    int64_t port;
+    chrono::milliseconds interval;
+
+    thread worker;
+    mutex joinMutex;
+    atomic<int> phase;
+    atomic<uint32_t> done;
+    atomic<uint32_t> total;
+    atomic<bool> cancelled;
+    atomic<bool> finished;
+    int code;
+
+    // used only by the worker
+    uint32_t pageSize;
+    int lastPhase;
+    chrono::steady_clock::time_point lastEvent;
+
+    BossaAsyncJob() : callback(NULL), user(NULL), post(NULL), port(0), interval(0), phase(0), done(0),
+        total(0), cancelled(false), finished(false), code(0), pageSize(0), lastPhase(0) {}
+};
+
+// job of the worker thread running bossa_main, NULL on the other threads
+static thread_local BossaAsyncJob* bossa_async_job = NULL;
+
+static void
+bossa_async_send(BossaAsyncJob* job, int phase, int64_t done, int64_t total)
+{
+    if (job->callback != NULL)
+        job->callback(job->user, phase, done, total);
+
+    if (job->post != NULL)
+    {
+        int64_t fields[3] = {phase, done, total};
+        BossaCObject values[3];
+        BossaCObject* items[3];
+        BossaCObject message;
+
+        for (int i = 0; i < 3; i++)
+        {
+            values[i].type = BOSSA_COBJECT_INT64;
+            values[i].value.as_int64 = fields[i];
+            items[i] = &values[i];
+        }
+
+        message.type = BOSSA_COBJECT_ARRAY;
+        message.value.as_array.length = 3;
+        message.value.as_array.values = items;
+
+        job->post(job->port, &message);
+    }
+}
+
+// sends the progress when the phase starts or completes, or when the
+// interval passed since the last event, so a flash of thousands of pages
+// doesn't flood the isolate with messages
+static void
+bossa_async_update(BossaAsyncJob* job, bool force)
+{
+    int phase = job->phase;
+    uint32_t done = job->done;
+    uint32_t total = job->total;
+    chrono::steady_clock::time_point now = chrono::steady_clock::now();
+
+    if (!force && phase == job->lastPhase && done != total && now - job->lastEvent < job->interval)
+        return;
+
+    job->lastPhase = phase;
+    job->lastEvent = now;
+
+    bossa_async_send(job, phase, done, total);
+}
+
+void
+bossa_async_phase(int phase)
+{
+    BossaAsyncJob* job = bossa_async_job;
+
+    if (job == NULL)
+        return;
+
+    if (job->cancelled)
+        throw runtime_error("Cancelled");
+
+    job->done = 0;
+    job->total = 0;
+    job->phase = phase;
+
+    bossa_async_update(job, true);
+}
+
+void
+bossa_async_page_size(uint32_t size)
+{
+    if (bossa_async_job != NULL)
+        bossa_async_job->pageSize = size;
+}
+
+void
+bossa_async_progress(int num, int div)
+{
+    BossaAsyncJob* job = bossa_async_job;
+
+    if (job == NULL)
+        return;
+
+    // the exception stops the operation at the current page, bossa_main
+    // catches it and returns
+    if (job->cancelled)
+        throw runtime_error("Cancelled");
+
+    job->total = div * job->pageSize;
+    job->done = num * job->pageSize;
+
+    bossa_async_update(job, false);
+}
+
+static void
+bossa_async_run(BossaAsyncJob* job)
+{
+    bossa_async_job = job;
+    job->code = bossa_main(0, &job->args[0]);
+    bossa_async_job = NULL;
+
+    if (job->cancelled && job->code != 0)
+        job->code = BOSSA_ASYNC_CANCELLED;
+
+    job->phase = BOSSA_PHASE_DONE;
+    job->finished = true;
+
+    bossa_async_send(job, BOSSA_PHASE_DONE, job->code, 0);
+}
+
+extern "C" {
+    // runs bossa_main with the args on a worker thread and returns the job,
+    // or NULL when the thread can't start; the events go to the callback,
+    // on the worker thread, and to the Dart port when post is
+    // NativeApi.postCObject, at most one every interval milliseconds
+    __attribute__((visibility("default"))) __attribute__((used))
+    void* bossa_main_async(const char* args, BossaProgressCallback callback, void* user,
+        BossaPostCObject post, int64_t port, uint32_t interval)
+    {
+        BossaAsyncJob* job = new BossaAsyncJob();
+
+        job->args = args != NULL ? args : "";
+        job->callback = callback;
+        job->user = user;
+        job->post = post;
+        job->port = port;
+        job->interval = chrono::milliseconds(interval);
+
+        try
+        {
+            job->worker = thread(bossa_async_run, job);
+        }
+        catch (...)
+        {
+            delete job;
+            return NULL;
+        }
+
+        return job;
+    }
+
+    // latest progress of the job, returns 1 while it runs and 0 when it
+    // finished
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_async_poll(void* handle, int* phase, uint32_t* done, uint32_t* total)
+    {
+        BossaAsyncJob* job = (BossaAsyncJob*) handle;
+
+        if (job == NULL)
+            return 0;
+
+        if (phase != NULL)
+            *phase = job->phase;
+
+        if (done != NULL)
+            *done = job->done;
+
+        if (total != NULL)
+            *total = job->total;
+
+        return job->finished ? 0 : 1;
+    }
+
+    // stops the job at the next page or phase, it finishes with the exit
+    // code BOSSA_ASYNC_CANCELLED
+    __attribute__((visibility("default"))) __attribute__((used))
+    void bossa_async_cancel(void* handle)
+    {
+        BossaAsyncJob* job = (BossaAsyncJob*) handle;
+
+        if (job != NULL)
+            job->cancelled = true;
+    }
+
+    // waits for the job and returns the exit code of bossa_main
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_async_wait(void* handle)
+    {
+        BossaAsyncJob* job = (BossaAsyncJob*) handle;
+
+        if (job == NULL)
+            return 1;
+
+        // the join is guarded, waiting from two threads at once is allowed
+        {
+            lock_guard<mutex> lock(job->joinMutex);
+
+            if (job->worker.joinable())
+                job->worker.join();
+        }
+
+        return job->code;
+    }
+
+    // waits for the job and frees it
+    __attribute__((visibility("default"))) __attribute__((used))
+    void bossa_async_free(void* handle)
+    {
+        BossaAsyncJob* job = (BossaAsyncJob*) handle;
+
+        if (job == NULL)
+            return;
+
+        bossa_async_wait(job);
+
+        delete job;
+    }
+}
@@ -22,14 +22,14 @@ extern "C" {
     __attribute__((visibility("default"))) __attribute__((used))
     void test_flutter_void() 
     {
-        fprintf(stdout, "Function [test_flutter_void] was called\n");
+        bossa_log(BOSSA_LOG_INFO, "Function [test_flutter_void] was called\n");
     }
 
     __attribute__((visibility("default"))) __attribute__((used))
     char * test_flutter_pointer(int argc, char* args) 
     {
-        fprintf(stdout, "Function [test_flutter_pointer] was called\n");
-        fprintf(stdout, "Function [test_flutter_pointer] Value send: %d | %s\n", argc, args);
+        bossa_log(BOSSA_LOG_INFO, "Function [test_flutter_pointer] was called\n");
+        bossa_log(BOSSA_LOG_INFO, "Function [test_flutter_pointer] Value send: %d | %s\n", argc, args);
 
         return args;
     }
@@ -37,8 +37,8 @@ extern "C" {
     __attribute__((visibility("default"))) __attribute__((used))
     int bossa_main(int argc, char* args)
     {
-        fprintf(stdout, "Function [bossa_main] was called\n");
-        fprintf(stdout, "Function [bossa_main] Value send: %d | %s\n", argc, args);
+        bossa_log(BOSSA_LOG_DEBUG, "Function [bossa_main] was called\n");
+        bossa_log(BOSSA_LOG_DEBUG, "Function [bossa_main] Value send: %d | %s\n", argc, args);
 
         // convert string to array of params
         int nargc = 0;
@@ -51,7 +51,7 @@ extern "C" {
 
         for (i = 0; i < nargc; i++) 
         {
-            fprintf(stdout, "Function [bossa_main] Value %d parsed: %s\n", (i + 1), nargv[i]);
+            bossa_log(BOSSA_LOG_DEBUG, "Function [bossa_main] Value %d parsed: %s\n", (i + 1), nargv[i]);
         }
         
         // call main with new params
@@ -0,0 +1,205 @@
+#include <atomic>
+#include <stdarg.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <string.h>
+
+#ifdef __ANDROID__
+#include <android/log.h>
+#endif
+
+enum BossaLogLevel
+{
+    BOSSA_LOG_DEBUG = 0,
+    BOSSA_LOG_INFO,
+    BOSSA_LOG_WARNING,
+    BOSSA_LOG_ERROR,
+    BOSSA_LOG_NONE,
+};
+
+#define BOSSA_LOG_RECORDS 1024
+#define BOSSA_LOG_MESSAGE 240
+
+// smallest drain buffer that fits any message: level, message and NUL
+#define BOSSA_LOG_DRAIN_MIN (BOSSA_LOG_MESSAGE + 1)
+
+// a slot of the ring buffer; the sequence tells the producers and the
+// consumers whose turn it is, stored relative to the slot index so the
+// zero-initialized buffer is ready before any constructor runs
+struct BossaLogRecord
+{
+    std::atomic<uint32_t> sequence;
+    int level;
+    char message[BOSSA_LOG_MESSAGE];
+};
+
+static BossaLogRecord bossa_log_records[BOSSA_LOG_RECORDS];
+static std::atomic<uint32_t> bossa_log_head(0);
+static std::atomic<uint32_t> bossa_log_tail(0);
+static std::atomic<uint32_t> bossa_log_dropped(0);
+static std::atomic<int> bossa_log_level(BOSSA_LOG_INFO);
+static std::atomic<int> bossa_log_echo(1);
+
+static void
+bossa_log_write_echo(int level, const char* message)
+{
+#ifdef __ANDROID__
+    int priority = level >= BOSSA_LOG_ERROR ? ANDROID_LOG_ERROR
+        : level == BOSSA_LOG_WARNING ? ANDROID_LOG_WARN
+        : level == BOSSA_LOG_INFO ? ANDROID_LOG_INFO : ANDROID_LOG_DEBUG;
+
+    __android_log_write(priority, "BOSSA", message);
+#else
+    FILE* stream = level >= BOSSA_LOG_ERROR ? stderr : stdout;
+    size_t length = strlen(message);
+
+    fputs(message, stream);
+
+    // progress lines end without a new line
+    if (length == 0 || message[length - 1] != '\n')
+        fflush(stream);
+#endif
+}
+
+// stores the message in the ring buffer without blocking or allocating;
+// when the consumer is behind and the buffer is full the message is
+// dropped and counted, the flash never waits for the log
+static void
+bossa_log_push(int level, const char* message)
+{
+    uint32_t pos = bossa_log_head.load(std::memory_order_relaxed);
+
+    for (;;)
+    {
+        uint32_t slot = pos % BOSSA_LOG_RECORDS;
+        BossaLogRecord* record = &bossa_log_records[slot];
+        int32_t diff = (int32_t) (record->sequence.load(std::memory_order_acquire) + slot - pos);
+
+        if (diff == 0)
+        {
+            if (bossa_log_head.compare_exchange_weak(pos, pos + 1, std::memory_order_relaxed))
+            {
+                record->level = level;
+                snprintf(record->message, BOSSA_LOG_MESSAGE, "%s", message);
+                record->sequence.store(pos + 1 - slot, std::memory_order_release);
+                return;
+            }
+        }
+        else if (diff < 0)
+        {
+            bossa_log_dropped.fetch_add(1, std::memory_order_relaxed);
+            return;
+        }
+        else
+        {
+            pos = bossa_log_head.load(std::memory_order_relaxed);
+        }
+    }
+}
+
+void
+bossa_vlog(int level, const char* format, va_list ap)
+{
+    char message[BOSSA_LOG_MESSAGE];
+
+    // filtered before formatting, so the debug messages cost a load
+    if (level < bossa_log_level.load(std::memory_order_relaxed))
+        return;
+
+    vsnprintf(message, sizeof(message), format, ap);
+
+    if (bossa_log_echo.load(std::memory_order_relaxed))
+        bossa_log_write_echo(level, message);
+
+    bossa_log_push(level, message);
+}
+
+void
+bossa_log(int level, const char* format, ...)
+{
+    va_list ap;
+
+    va_start(ap, format);
+    bossa_vlog(level, format, ap);
+    va_end(ap);
+}
+
+extern "C" {
+    // messages under the level are discarded, BOSSA_LOG_NONE discards all
+    __attribute__((visibility("default"))) __attribute__((used))
+    void bossa_log_set_level(int level)
+    {
+        bossa_log_level.store(level, std::memory_order_relaxed);
+    }
+
+    // also writes the messages to stdout and stderr, or to the Android
+    // log, as they are logged; on by default
+    __attribute__((visibility("default"))) __attribute__((used))
+    void bossa_log_set_echo(int echo)
+    {
+        bossa_log_echo.store(echo, std::memory_order_relaxed);
+    }
+
+    // moves the buffered messages to the buffer, as many as fit, each as
+    // the level digit, the message and a NUL; returns the bytes written.
+    // A buffer of BOSSA_LOG_DRAIN_MIN bytes fits any message, the messages
+    // that don't fit a smaller buffer are dropped
+    __attribute__((visibility("default"))) __attribute__((used))
+    uint32_t bossa_log_drain(char* buffer, uint32_t size)
+    {
+        uint32_t written = 0;
+        uint32_t pos = bossa_log_tail.load(std::memory_order_relaxed);
+
+        if (buffer == NULL)
+            return 0;
+
+        for (;;)
+        {
+            uint32_t slot = pos % BOSSA_LOG_RECORDS;
+            BossaLogRecord* record = &bossa_log_records[slot];
+            int32_t diff = (int32_t) (record->sequence.load(std::memory_order_acquire) + slot - (pos + 1));
+
+            if (diff < 0)
+                break;
+
+            if (diff > 0)
+            {
+                pos = bossa_log_tail.load(std::memory_order_relaxed);
+                continue;
+            }
+
+            uint32_t length = strlen(record->message);
+            bool fits = written + length + 2 <= size;
+
+            // left for the next call, unless it can't fit even an empty
+            // buffer, then it is skipped so it doesn't block the others
+            if (!fits && written > 0)
+                break;
+
+            if (fits)
+            {
+                buffer[written] = '0' + record->level;
+                memcpy(buffer + written + 1, record->message, length + 1);
+            }
+
+            if (!bossa_log_tail.compare_exchange_weak(pos, pos + 1, std::memory_order_relaxed))
+                continue;
+
+            record->sequence.store(pos + BOSSA_LOG_RECORDS - slot, std::memory_order_release);
+
+            if (fits)
+                written += length + 2;
+            else
+                bossa_log_dropped.fetch_add(1, std::memory_order_relaxed);
+        }
+
+        return written;
+    }
+
+    // messages dropped because the buffer was full since the last call
+    __attribute__((visibility("default"))) __attribute__((used))
+    uint32_t bossa_log_dropped_count()
+    {
+        return bossa_log_dropped.exchange(0, std::memory_order_relaxed);
+    }
+}
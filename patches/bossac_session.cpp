@@ -0,0 +1,327 @@
+class BossaSessionObserver : public FlasherObserver
+{
+public:
+    BossaSessionObserver() {}
+    virtual ~BossaSessionObserver() {}
+
+    virtual void onStatus(const char *message, ...) {}
+    virtual void onProgress(int num, int div) {}
+};
+
+struct BossaSession
+{
+    Samba samba;
+    Device device;
+    BossaSessionObserver observer;
+    Flasher flasher;
+    bool open;
+    bool erased;
+    string error;
+
+    BossaSession() : device(samba), flasher(samba, device, observer), open(false), erased(false) {}
+};
+
+static int
+bossa_session_check(BossaSession* session)
+{
+    if (session == NULL)
+        return 1;
+
+    if (!session->open)
+    {
+        session->error = "Session is not open";
+        return 1;
+    }
+
+    session->error.clear();
+
+    return 0;
+}
+
+extern "C" {
+    // creates a session, open it with bossa_session_open and free it with
+    // bossa_session_close; returns NULL when it can't be created
+    __attribute__((visibility("default"))) __attribute__((used))
+    void* bossa_session_create()
+    {
+        try
+        {
+            return new BossaSession();
+        }
+        catch (...)
+        {
+            return NULL;
+        }
+    }
+
+    // connects to the port and identifies the device once for all the
+    // operations of the session; usb is 1 for USB, 0 for RS-232 or -1 to
+    // detect it from the port name
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_session_open(void* handle, const char* port, int usb)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (session == NULL)
+            return 1;
+
+        try
+        {
+            PortFactory portFactory;
+            string portName = (port != NULL && port[0] != '\0') ? port : portFactory.def();
+            bool res;
+
+            if (portName.empty())
+            {
+                session->error = "No serial ports available";
+                return 1;
+            }
+
+            if (usb < 0)
+                res = session->samba.connect(portFactory.create(portName));
+            else
+                res = session->samba.connect(portFactory.create(portName, usb != 0));
+
+            if (!res)
+            {
+                session->error = "No device found on " + portName;
+                return 1;
+            }
+
+            session->device.create();
+            session->open = true;
+            session->error.clear();
+        }
+        catch (exception& e)
+        {
+            session->error = e.what();
+            return 1;
+        }
+        catch (...)
+        {
+            session->error = "Unhandled exception";
+            return 1;
+        }
+
+        return 0;
+    }
+
+    // name of the flash of the identified device
+    __attribute__((visibility("default"))) __attribute__((used))
+    const char* bossa_session_device(void* handle)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (session == NULL || !session->open)
+            return "";
+
+        return session->device.getFlash()->name().c_str();
+    }
+
+    __attribute__((visibility("default"))) __attribute__((used))
+    uint32_t bossa_session_flash_size(void* handle)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (session == NULL || !session->open)
+            return 0;
+
+        Device::FlashPtr& flash = session->device.getFlash();
+
+        return flash->numPages() * flash->pageSize();
+    }
+
+    __attribute__((visibility("default"))) __attribute__((used))
+    uint32_t bossa_session_page_size(void* handle)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (session == NULL || !session->open)
+            return 0;
+
+        return session->device.getFlash()->pageSize();
+    }
+
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_session_erase(void* handle, uint32_t offset)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (bossa_session_check(session))
+            return 1;
+
+        try
+        {
+            session->flasher.erase(offset);
+            session->erased = true;
+        }
+        catch (exception& e)
+        {
+            session->error = e.what();
+            return 1;
+        }
+        catch (...)
+        {
+            session->error = "Unhandled exception";
+            return 1;
+        }
+
+        return 0;
+    }
+
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_session_write(void* handle, const char* file, uint32_t offset)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (bossa_session_check(session))
+            return 1;
+
+        try
+        {
+            // the pages are erased before writing, unless the flash was
+            // just erased by bossa_session_erase
+            session->device.getFlash()->eraseAuto(!session->erased);
+            session->flasher.write(file, offset);
+            session->erased = false;
+        }
+        catch (exception& e)
+        {
+            session->error = e.what();
+            return 1;
+        }
+        catch (...)
+        {
+            session->error = "Unhandled exception";
+            return 1;
+        }
+
+        return 0;
+    }
+
+    // returns 2 when the flash doesn't match the file, like bossac
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_session_verify(void* handle, const char* file, uint32_t offset)
+    {
+        BossaSession* session = (BossaSession*) handle;
+        uint32_t pageErrors;
+        uint32_t totalErrors;
+
+        if (bossa_session_check(session))
+            return 1;
+
+        try
+        {
+            if (!session->flasher.verify(file, pageErrors, totalErrors, offset))
+            {
+                char error[64];
+
+                snprintf(error, sizeof(error), "Verify failed (page errors: %u, byte errors: %u)",
+                    pageErrors, totalErrors);
+                session->error = error;
+
+                return 2;
+            }
+        }
+        catch (exception& e)
+        {
+            session->error = e.what();
+            return 1;
+        }
+        catch (...)
+        {
+            session->error = "Unhandled exception";
+            return 1;
+        }
+
+        return 0;
+    }
+
+    // reads size bytes (the whole flash when 0) from the offset to the file
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_session_read(void* handle, const char* file, uint32_t size, uint32_t offset)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (bossa_session_check(session))
+            return 1;
+
+        try
+        {
+            session->flasher.read(file, size, offset);
+        }
+        catch (exception& e)
+        {
+            session->error = e.what();
+            return 1;
+        }
+        catch (...)
+        {
+            session->error = "Unhandled exception";
+            return 1;
+        }
+
+        return 0;
+    }
+
+    __attribute__((visibility("default"))) __attribute__((used))
+    int bossa_session_reset(void* handle)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (bossa_session_check(session))
+            return 1;
+
+        try
+        {
+            session->device.reset();
+        }
+        catch (exception& e)
+        {
+            session->error = e.what();
+            return 1;
+        }
+        catch (...)
+        {
+            session->error = "Unhandled exception";
+            return 1;
+        }
+
+        return 0;
+    }
+
+    // message of the last failed call of the session
+    __attribute__((visibility("default"))) __attribute__((used))
+    const char* bossa_session_error(void* handle)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (session == NULL)
+            return "Invalid session";
+
+        return session->error.c_str();
+    }
+
+    // writes the pending flash options, closes the port and frees the session
+    __attribute__((visibility("default"))) __attribute__((used))
+    void bossa_session_close(void* handle)
+    {
+        BossaSession* session = (BossaSession*) handle;
+
+        if (session == NULL)
+            return;
+
+        if (session->open)
+        {
+            try
+            {
+                session->device.getFlash()->writeOptions();
+            }
+            catch (...)
+            {
+            }
+        }
+
+        delete session;
+    }
+}
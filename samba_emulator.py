@@ -0,0 +1,438 @@
+"""
+SAM-BA device emulator
+
+Serves the SAM-BA monitor protocol used by bossac on a pseudo-terminal, so
+the library can erase, write and verify a simulated device without a board.
+It emulates a SAMD21 with the Arduino bootloader in binary (USB) mode: the
+N, V, T, w/W, o/O, h/H, S, R and G commands, the X, Y and Z Arduino
+extensions, the DSU and CPUID registers used to identify the device, the
+NVMCTRL registers used to erase and write pages and the WordCopy applet.
+The RS-232 auto-baud sequence and XMODEM transfers are not supported, so
+bossac must be run with --usb-port=1.
+"""
+
+import os
+import select
+import threading
+import time
+import binascii
+
+SAMBA_DEVICES = {
+    "samd21g18a": {
+        "name": "ATSAMD21G18A",
+        "did": 0x10010005,
+        "cpuid": 0x410CC601,
+        "flash_addr": 0x00000000,
+        "flash_size": 256 * 1024,
+        "page_size": 64,
+        "row_pages": 4,
+        "lock_regions": 16,
+        "sram_addr": 0x20000000,
+        "sram_size": 32 * 1024,
+        "applet_addr": 0x20004000,
+        "user_row_addr": 0x00804000,
+        "user_row": bytes([0xFA, 0xC7, 0xE0, 0xD8, 0x5D, 0xFC, 0xFF, 0xFF]),
+    },
+}
+
+SAMBA_VERSION = "v1.1 {0}Nov 27 2019 16:38:28\n\r"
+
+# WordCopy applet parameters, relative to the applet address
+APPLET_STACK = 0x20
+APPLET_RESET = 0x24
+APPLET_DST_ADDR = 0x28
+APPLET_SRC_ADDR = 0x2C
+APPLET_WORDS = 0x30
+
+CPUID_ADDR = 0xE000ED00
+AIRCR_ADDR = 0xE000ED0C
+DSU_DID_ADDR = 0x41002018
+
+NVM_REG_BASE = 0x41004000
+NVM_REG_CTRLA = 0x00
+NVM_REG_CTRLB = 0x04
+NVM_REG_PARAM = 0x08
+NVM_REG_INTFLAG = 0x14
+NVM_REG_STATUS = 0x18
+NVM_REG_ADDR = 0x1C
+NVM_REG_LOCK = 0x20
+NVM_REG_SIZE = 0x24
+
+NVM_CMD_KEY = 0xA5
+NVM_CMD_ER = 0x02
+NVM_CMD_WP = 0x04
+NVM_CMD_EAR = 0x05
+NVM_CMD_WAP = 0x06
+NVM_CMD_LR = 0x40
+NVM_CMD_UR = 0x41
+NVM_CMD_PBC = 0x44
+NVM_CMD_SSB = 0x45
+
+NVM_INTFLAG_READY = 0x1
+NVM_INTFLAG_ERROR = 0x2
+NVM_STATUS_SB = 0x100
+
+# bytes bossac sends between commands (padding and line ends)
+SAMBA_IGNORED = b"\x00\r\n "
+
+
+class SambaEmulator:
+    """
+    A simulated device on a pty. The latency is added before each command
+    is handled and, with a baud rate, each transfer takes the time it would
+    take on a serial line (10 bits per byte). The time between commands is
+    split in phases (connect, erase, write, verify, read) from the commands
+    seen, in stats.
+    """
+
+    def __init__(self, device="samd21g18a", latency=0.0, baud=0, extensions="XYZ"):
+        self.device = SAMBA_DEVICES[device]
+        self.latency = latency
+        self.baud = baud
+        self.extensions = extensions
+
+        self.flash = bytearray(b"\xff" * self.device["flash_size"])
+        self.sram = bytearray(self.device["sram_size"])
+        self.user_row = bytearray(b"\xff" * self.device["page_size"] * 4)
+        self.user_row[: len(self.device["user_row"])] = self.device["user_row"]
+        self.memory = {}
+
+        self.page_buffer = bytearray(b"\xff" * self.device["page_size"])
+        self.nvm = {
+            NVM_REG_CTRLB: 0,
+            NVM_REG_INTFLAG: NVM_INTFLAG_READY,
+            NVM_REG_STATUS: 0,
+            NVM_REG_ADDR: 0,
+            NVM_REG_LOCK: (1 << self.device["lock_regions"]) - 1,
+        }
+        self.copy_src = 0
+        self.resets = 0
+
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.running = False
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            "commands": {},
+            "phases": {},
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+        self.phase = "connect"
+        self.last_time = None
+
+    def start(self):
+        import tty
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+        return self.port
+
+    def stop(self):
+        self.running = False
+
+        if self.thread:
+            self.thread.join()
+
+        for fd in [self.master, self.slave]:
+            if fd is not None:
+                os.close(fd)
+
+        self.master = None
+        self.slave = None
+
+    def serve(self):
+        buffer = bytearray()
+
+        while self.running:
+            ready = select.select([self.master], [], [], 0.05)[0]
+
+            if not ready:
+                continue
+
+            try:
+                data = os.read(self.master, 64 * 1024)
+            except OSError:
+                continue
+
+            self.stats["bytes_in"] += len(data)
+            self.throttle(len(data))
+            buffer += data
+
+            while buffer:
+                consumed = self.handle(buffer)
+
+                if not consumed:
+                    break
+
+                del buffer[:consumed]
+
+    def throttle(self, size):
+        if self.baud:
+            time.sleep(size * 10.0 / self.baud)
+
+    def respond(self, data):
+        if isinstance(data, str):
+            data = data.encode("ascii")
+
+        self.throttle(len(data))
+        self.stats["bytes_out"] += len(data)
+
+        while data:
+            written = os.write(self.master, data)
+            data = data[written:]
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def add_phase_time(self):
+        now = time.monotonic()
+
+        if self.last_time is not None:
+            phases = self.stats["phases"]
+            phases[self.phase] = phases.get(self.phase, 0.0) + now - self.last_time
+
+        self.last_time = now
+
+    def handle(self, buffer):
+        """
+        Handle the command at the start of the buffer and return the number
+        of bytes used, or 0 when the command is not complete yet.
+        """
+        if buffer[0] in SAMBA_IGNORED:
+            return 1
+
+        end = buffer.find(b"#")
+
+        if end < 0:
+            return 0
+
+        command = chr(buffer[0])
+        args = [int(arg, 16) for arg in buffer[1:end].decode("ascii").split(",") if arg]
+        consumed = end + 1
+
+        if command == "S":
+            addr, size = args
+
+            if len(buffer) < consumed + size:
+                return 0
+
+            data = bytes(buffer[consumed : consumed + size])
+            consumed += size
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        commands = self.stats["commands"]
+        commands[command] = commands.get(command, 0) + 1
+
+        if command in ["N", "T"]:
+            self.respond("\n\r")
+        elif command == "V":
+            extensions = ""
+
+            if self.extensions:
+                extensions = "[Arduino:{0}] ".format(self.extensions)
+
+            self.respond(SAMBA_VERSION.format(extensions))
+        elif command == "w":
+            self.respond(self.read_word(args[0]).to_bytes(4, "little"))
+        elif command == "h":
+            self.respond(self.read_memory(args[0], 2))
+        elif command == "o":
+            self.respond(self.read_memory(args[0], 1))
+        elif command == "W":
+            self.write_word(args[0], args[1])
+        elif command == "H":
+            self.write_memory(args[0], args[1].to_bytes(2, "little"))
+        elif command == "O":
+            self.write_memory(args[0], bytes([args[1] & 0xFF]))
+        elif command == "S":
+            if self.phase != "connect" or addr != self.device["applet_addr"]:
+                self.set_phase("write")
+
+            self.write_memory(addr, data)
+        elif command == "R":
+            addr, size = args
+
+            if self.is_flash(addr):
+                if self.phase in ["write", "verify"]:
+                    self.set_phase("verify")
+                else:
+                    self.set_phase("read")
+
+            self.respond(self.read_memory(addr, size))
+        elif command == "G":
+            self.go(args[0])
+        elif command == "X" and "X" in self.extensions:
+            self.set_phase("erase")
+            self.erase_flash(args[0], self.device["flash_size"] - args[0])
+            self.respond("X\n\r")
+        elif command == "Y" and "Y" in self.extensions:
+            self.set_phase("write")
+
+            if args[1] == 0:
+                self.copy_src = args[0]
+            else:
+                self.program_flash(args[0], self.read_memory(self.copy_src, args[1]))
+
+            self.respond("Y\n\r")
+        elif command == "Z" and "Z" in self.extensions:
+            self.set_phase("verify")
+            crc = binascii.crc_hqx(self.read_memory(args[0], args[1]), 0)
+            self.respond("Z{0:08X}#\n\r".format(crc))
+
+        self.add_phase_time()
+
+        return consumed
+
+    def is_flash(self, addr):
+        start = self.device["flash_addr"]
+
+        return start <= addr < start + self.device["flash_size"]
+
+    def get_region(self, addr):
+        for start, data in [
+            (self.device["flash_addr"], self.flash),
+            (self.device["sram_addr"], self.sram),
+            (self.device["user_row_addr"], self.user_row),
+        ]:
+            if start <= addr < start + len(data):
+                return start, data
+
+        return None, None
+
+    def read_memory(self, addr, size):
+        start, data = self.get_region(addr)
+
+        if data is not None and addr + size <= start + len(data):
+            return bytes(data[addr - start : addr - start + size])
+
+        return bytes([self.memory.get(addr + i, 0) for i in range(size)])
+
+    def write_memory(self, addr, data):
+        start, region = self.get_region(addr)
+
+        if region is self.flash or region is self.user_row:
+            # flash writes go to the page buffer, a command programs it
+            page_size = self.device["page_size"]
+
+            for i in range(len(data)):
+                self.page_buffer[(addr + i) % page_size] = data[i]
+        elif region is not None:
+            region[addr - start : addr - start + len(data)] = data
+        else:
+            for i in range(len(data)):
+                self.memory[addr + i] = data[i]
+
+    def read_word(self, addr):
+        if addr == CPUID_ADDR:
+            return self.device["cpuid"]
+
+        if addr == DSU_DID_ADDR:
+            return self.device["did"]
+
+        if NVM_REG_BASE <= addr < NVM_REG_BASE + NVM_REG_SIZE:
+            return self.read_nvm(addr - NVM_REG_BASE)
+
+        return int.from_bytes(self.read_memory(addr, 4), "little")
+
+    def write_word(self, addr, value):
+        if NVM_REG_BASE <= addr < NVM_REG_BASE + NVM_REG_SIZE:
+            self.write_nvm(addr - NVM_REG_BASE, value)
+        elif addr == AIRCR_ADDR:
+            self.resets += 1
+        else:
+            self.write_memory(addr, value.to_bytes(4, "little"))
+
+    def read_nvm(self, reg):
+        if reg == NVM_REG_PARAM:
+            pages = self.device["flash_size"] // self.device["page_size"]
+            page_size_code = self.device["page_size"].bit_length() - 4
+
+            return pages | (page_size_code << 16)
+
+        return self.nvm.get(reg, 0)
+
+    def write_nvm(self, reg, value):
+        if reg == NVM_REG_CTRLA:
+            self.nvm_command(value)
+        elif reg in [NVM_REG_INTFLAG, NVM_REG_STATUS]:
+            # error flags are cleared by writing one
+            self.nvm[reg] &= ~(value & 0xFE)
+        elif reg in [NVM_REG_CTRLB, NVM_REG_ADDR]:
+            self.nvm[reg] = value
+
+    def nvm_command(self, value):
+        command = value & 0x7F
+        addr = self.nvm[NVM_REG_ADDR] * 2
+        page_size = self.device["page_size"]
+        row_size = page_size * self.device["row_pages"]
+
+        if (value >> 8) & 0xFF != NVM_CMD_KEY:
+            self.nvm[NVM_REG_INTFLAG] |= NVM_INTFLAG_ERROR
+            return
+
+        if command == NVM_CMD_ER:
+            if self.phase == "connect":
+                self.set_phase("erase")
+
+            self.erase_flash(addr - addr % row_size, row_size)
+        elif command == NVM_CMD_WP:
+            self.set_phase("write")
+            self.program_flash(addr - addr % page_size, self.page_buffer)
+        elif command == NVM_CMD_EAR:
+            self.user_row[:] = b"\xff" * len(self.user_row)
+        elif command == NVM_CMD_WAP:
+            offset = (addr - self.device["user_row_addr"]) % len(self.user_row)
+            offset -= offset % page_size
+
+            for i in range(page_size):
+                self.user_row[offset + i] &= self.page_buffer[i]
+        elif command == NVM_CMD_PBC:
+            self.page_buffer[:] = b"\xff" * page_size
+        elif command in [NVM_CMD_LR, NVM_CMD_UR]:
+            region_size = self.device["flash_size"] // self.device["lock_regions"]
+            bit = 1 << (addr // region_size)
+
+            if command == NVM_CMD_LR:
+                self.nvm[NVM_REG_LOCK] &= ~bit
+            else:
+                self.nvm[NVM_REG_LOCK] |= bit
+        elif command == NVM_CMD_SSB:
+            self.nvm[NVM_REG_STATUS] |= NVM_STATUS_SB
+
+    def erase_flash(self, addr, size):
+        start = addr - self.device["flash_addr"]
+        self.flash[start : start + size] = b"\xff" * size
+
+    def program_flash(self, addr, data):
+        # programming only clears bits, an erase sets them again
+        start = addr - self.device["flash_addr"]
+        size = len(data)
+        value = int.from_bytes(self.flash[start : start + size], "little")
+        value &= int.from_bytes(data, "little")
+        self.flash[start : start + size] = value.to_bytes(size, "little")
+
+    def go(self, addr):
+        applet = self.device["applet_addr"]
+
+        if addr != applet + APPLET_STACK and not applet <= addr < applet + APPLET_STACK:
+            return
+
+        dst = self.read_word(applet + APPLET_DST_ADDR)
+        src = self.read_word(applet + APPLET_SRC_ADDR)
+        words = self.read_word(applet + APPLET_WORDS)
+
+        self.write_memory(dst, self.read_memory(src, words * 4))